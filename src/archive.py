@@ -0,0 +1,258 @@
+"""Columnar archive of AIS history for the TMB (Traffic Monitoring Backend)
+
+   Position reports and static data are exported from mongo into Parquet (or
+   Arrow IPC) datasets partitioned by date and by a hash of the MMSI, and can be
+   loaded back into mongo or straight into the in-memory position snapshot
+   without parsing json. pyarrow is an optional dependency.
+"""
+
+import os
+import uuid
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+import main
+
+DEFAULT_MMSI_BUCKETS = 16
+EXPORT_BATCH_SIZE = 100000
+
+# (field, arrow type name) of the flat columns of each message type, the
+# Position of position reports is split into lat and lon
+COLUMNS = {
+    "position_report": [("Class", "string"), ("Status", "string"), ("RoT", "float64"), ("SoG", "float64"),
+                        ("CoG", "float64"), ("Heading", "int16")],
+    "static_data": [("Class", "string"), ("IMO", "int64"), ("CallSign", "string"), ("Name", "string"),
+                    ("VesselType", "string"), ("CargoTye", "string"), ("Length", "int32"), ("Breadth", "int32"),
+                    ("Draught", "float64"), ("Destination", "string"), ("ETA", "string"), ("A", "int32"),
+                    ("B", "int32"), ("C", "int32"), ("D", "int32")],
+}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for the columnar AIS archive")
+
+
+def to_column(values, arrow_type):
+    """converts the values of a field into an arrow array, a value that does not fit the type becomes null
+
+    real static data holds e.g. an IMO of 'Unknown', one such vessel must not fail the export.
+    :param values: values of the field, None when missing
+    :type values: list
+    :param arrow_type: type of the column
+    :type arrow_type: pyarrow.DataType
+    :rtype: pyarrow.Array
+    """
+
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return pa.array([fitting_value(value, arrow_type) for value in values], type=arrow_type)
+
+
+def fitting_value(value, arrow_type):
+    """the value if arrow can store it in a column of arrow_type, None otherwise"""
+
+    try:
+        pa.array([value], type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return None
+    return value
+
+
+def to_table(documents, msg_type, mmsi_buckets=DEFAULT_MMSI_BUCKETS):
+    """converts AIS documents of one message type into an arrow table
+
+    a document without a Timestamp, e.g. a vessel stored before vessels were
+    dated, gets a null Timestamp and date.
+    :param documents: AIS documents
+    :type documents: list
+    :param msg_type: 'position_report' or 'static_data'
+    :type msg_type: str
+    :param mmsi_buckets: number of MMSI hash partitions
+    :type mmsi_buckets: int
+    :return: table with the partition columns date and mmsi_bucket
+    :rtype: pyarrow.Table
+    """
+
+    _require_pyarrow()
+    mmsi = pa.array([document["MMSI"] for document in documents], type=pa.int64())
+    timestamp = pc.cast(pa.array([document.get("Timestamp") for document in documents], type=pa.string()),
+                        pa.timestamp("ms", tz="UTC"))
+    columns = {"Timestamp": timestamp, "MMSI": mmsi}
+    if msg_type == "position_report":
+        coordinates = [document.get("Position", {}).get("coordinates", [None, None]) for document in documents]
+        columns["lat"] = pa.array([coordinate[0] for coordinate in coordinates], type=pa.float64())
+        columns["lon"] = pa.array([coordinate[1] for coordinate in coordinates], type=pa.float64())
+    for field, type_name in COLUMNS[msg_type]:
+        columns[field] = to_column([document.get(field) for document in documents], pa.type_for_alias(type_name))
+    columns["date"] = pc.strftime(timestamp, format="%Y-%m-%d")
+    columns["mmsi_bucket"] = pc.cast(pc.subtract(mmsi, pc.multiply(pc.divide(mmsi, mmsi_buckets), mmsi_buckets)),
+                                     pa.int16())
+    return pa.table(columns)
+
+
+def to_documents(record_batch, msg_type):
+    """converts archived rows back into AIS documents
+
+    :param record_batch: rows read from the archive
+    :type record_batch: pyarrow.RecordBatch
+    :param msg_type: 'position_report' or 'static_data'
+    :type msg_type: str
+    :return: AIS documents shaped like the ingested json
+    :rtype: list
+    """
+
+    timestamps = pc.strftime(record_batch.column("Timestamp"), format="%Y-%m-%dT%H:%M:%S").to_pylist()
+    columns = {name: record_batch.column(name).to_pylist() for name, _ in COLUMNS[msg_type]
+               if name in record_batch.schema.names}
+    mmsi = record_batch.column("MMSI").to_pylist()
+    if msg_type == "position_report":
+        lat = record_batch.column("lat").to_pylist()
+        lon = record_batch.column("lon").to_pylist()
+    documents = []
+    for row in range(record_batch.num_rows):
+        document = {"MMSI": mmsi[row], "MsgType": msg_type}
+        if timestamps[row] is not None:
+            document["Timestamp"] = timestamps[row] + "Z"
+        if msg_type == "position_report" and lat[row] is not None:
+            document["Position"] = {"type": "Point", "coordinates": [lat[row], lon[row]]}
+        for name, values in columns.items():
+            if values[row] is not None:
+                document[name] = values[row]
+        documents.append(document)
+    return documents
+
+
+def export_archive(directory, msg_type="position_report", query=None, collection=None,
+                   mmsi_buckets=DEFAULT_MMSI_BUCKETS, batch_size=EXPORT_BATCH_SIZE, file_format="parquet"):
+    """exports AIS messages of one type into a dataset partitioned by date and MMSI hash
+
+    the dataset is written below directory/msg_type, existing files are kept so
+    several exports can add to the same archive. Static data is exported from
+    the vessels collection, the latest static data of every vessel.
+    :param directory: root directory of the archive
+    :type directory: str
+    :param msg_type: 'position_report' or 'static_data'
+    :type msg_type: str
+    :param query: extra filter selecting the exported messages
+    :type query: dict
+    :param collection: AIS collection, or vessels collection for static data
+    :type collection: pymongo.collection.Collection
+    :param mmsi_buckets: number of MMSI hash partitions
+    :type mmsi_buckets: int
+    :param batch_size: number of messages converted and written at a time
+    :type batch_size: int
+    :param file_format: 'parquet' or 'ipc' (Arrow IPC / feather)
+    :type file_format: str
+    :return: number of exported messages
+    :rtype: int
+    """
+
+    _require_pyarrow()
+    if msg_type not in COLUMNS:
+        raise ValueError("msg_type must be 'position_report' or 'static_data'")
+    if msg_type == "static_data":
+        # the vessels hold one document per MMSI and no MsgType
+        collection = collection if collection is not None else main.vessels
+        query = dict(query or {})
+    else:
+        collection = collection if collection is not None else main.myCollection
+        query = dict(query or {}, MsgType=msg_type)
+    cursor = collection.find(query, {"_id": 0}).batch_size(main.DEFAULT_BATCH_SIZE)
+    options = ds.ParquetFileFormat().make_write_options(compression="zstd") if file_format == "parquet" else None
+    exported = 0
+    for batch in main.iter_batches(cursor, batch_size):
+        ds.write_dataset(to_table(batch, msg_type, mmsi_buckets), os.path.join(directory, msg_type),
+                         format=file_format, file_options=options, partitioning=["date", "mmsi_bucket"],
+                         partitioning_flavor="hive", existing_data_behavior="overwrite_or_ignore",
+                         basename_template="part-" + uuid.uuid4().hex + "-{i}." + file_format)
+        exported += len(batch)
+    return exported
+
+
+def open_archive(directory, msg_type="position_report", file_format="parquet"):
+    """opens the dataset of one message type of an archive
+
+    :return: the dataset, with date and mmsi_bucket as partition columns
+    :rtype: pyarrow.dataset.Dataset
+    """
+
+    _require_pyarrow()
+    return ds.dataset(os.path.join(directory, msg_type), format=file_format, partitioning="hive")
+
+
+def iter_archive(directory, msg_type="position_report", dates=None, file_format="parquet"):
+    """yields the archived messages as lists of AIS documents
+
+    :param dates: only read these dates (YYYY-MM-DD), reading skips the other partitions
+    :type dates: list
+    :return: generator of document lists
+    :rtype: generator
+    """
+
+    dataset = open_archive(directory, msg_type, file_format)
+    row_filter = ds.field("date").isin(dates) if dates else None
+    for record_batch in dataset.to_batches(filter=row_filter, batch_size=main.DEFAULT_BATCH_SIZE):
+        if record_batch.num_rows:
+            yield to_documents(record_batch, msg_type)
+
+
+def import_archive(directory, msg_type="position_report", dates=None, collection=None, file_format="parquet"):
+    """loads archived messages back into mongo, maintaining the latest positions and the vessels
+
+    :param directory: root directory of the archive
+    :type directory: str
+    :param msg_type: 'position_report' or 'static_data'
+    :type msg_type: str
+    :param dates: only load these dates (YYYY-MM-DD)
+    :type dates: list
+    :param collection: AIS collection
+    :type collection: pymongo.collection.Collection
+    :return: number of inserted messages and number of failed messages
+    :rtype: tuple
+    """
+
+    collection = collection if collection is not None else main.ingestCollection
+    inserted = failed = 0
+    for documents in iter_archive(directory, msg_type, dates, file_format):
+        batch_inserted, batch_failed, stored = main.store_messages(collection, documents)
+        main.update_latest_positions(stored)
+        inserted += batch_inserted
+        failed += batch_failed
+    return inserted, failed
+
+
+def load_snapshot(directory, snapshot, dates=None, file_format="parquet"):
+    """replays archived position reports straight into a PositionSnapshot, column by column
+
+    :param directory: root directory of the archive
+    :type directory: str
+    :param snapshot: the in-memory snapshot to be filled
+    :type snapshot: spatial.PositionSnapshot
+    :param dates: only replay these dates (YYYY-MM-DD)
+    :type dates: list
+    :return: number of vessels in the snapshot
+    :rtype: int
+    """
+
+    dataset = open_archive(directory, "position_report", file_format)
+    row_filter = ds.field("lat").is_valid()
+    if dates:
+        row_filter = row_filter & ds.field("date").isin(dates)
+    columns = ["MMSI", "lat", "lon", "Timestamp", "SoG", "CoG"]
+    for record_batch in dataset.to_batches(columns=columns, filter=row_filter):
+        if not record_batch.num_rows:
+            continue
+        snapshot.update_arrays(record_batch.column("MMSI").to_numpy(),
+                               record_batch.column("lat").to_numpy(),
+                               record_batch.column("lon").to_numpy(),
+                               pc.cast(record_batch.column("Timestamp"), pa.int64()).to_numpy(),
+                               pc.fill_null(record_batch.column("SoG"), float("nan")).to_numpy(),
+                               pc.fill_null(record_batch.column("CoG"), float("nan")).to_numpy())
+    return len(snapshot)
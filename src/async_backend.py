@@ -0,0 +1,529 @@
+"""An asyncio variant of the TMB (Traffic Monitoring Backend)
+
+   Uses pymongo's AsyncMongoClient so many concurrent tile and vessel requests
+   can be multiplexed on one event loop. The queries have the same semantics as
+   the blocking TrafficMonitoringBackEnd in main, cursor results are returned as
+   lists since async cursors must be awaited.
+"""
+
+import asyncio
+import sys
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from pymongo import AsyncMongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
+
+import main
+import metrics
+
+
+class AsyncTrafficMonitoringBackEnd:
+    """A class that stores the async methods for the TMB
+
+    settings that are not given are taken from main.backendSettings, see main.configure.
+    :param uri: mongodb connection string
+    :type uri: str
+    :param database: name of the database
+    :type database: str
+    :param collection: name of the AIS collection
+    :type collection: str
+    """
+
+    def __init__(self, uri=None, database=None, collection=None):
+        settings = main.backendSettings
+        self.client = AsyncMongoClient(uri or settings["uri"], minPoolSize=settings["min_pool_size"],
+                                       maxPoolSize=settings["max_pool_size"],
+                                       connectTimeoutMS=settings["connect_timeout_ms"],
+                                       serverSelectionTimeoutMS=settings["server_selection_timeout_ms"],
+                                       event_listeners=[metrics.commandListener])
+        data_base = self.client.get_database(database or settings["database"],
+                                             read_preference=main.READ_PREFERENCES[settings["read_preference"]])
+        self.collection = data_base[collection or settings["collection"]]
+        self.ingest = data_base.get_collection(collection or settings["collection"],
+                                               write_concern=WriteConcern(w=settings["ingest_w"],
+                                                                          j=settings["ingest_j"]))
+        self.latest = data_base[settings["latest"]]
+        self.ports = data_base[settings["ports"]]
+        self.mapviews = data_base[settings["mapviews"]]
+        self.vessels = data_base[settings["vessels"]]
+        self._unique_mmsi_ready = set()
+
+    async def close(self):
+        """closes the connections of the client"""
+
+        await self.client.close()
+
+    async def _ensure_unique_mmsi(self, collection):
+        # the guarded upserts rely on it to reject stale reports, see main.ensure_unique_mmsi
+        if collection.name in self._unique_mmsi_ready:
+            return
+        for name, index in (await collection.index_information()).items():
+            if [tuple(field) for field in index["key"]] == [("MMSI", pymongo.ASCENDING)] \
+                    and not index.get("unique"):
+                await collection.drop_index(name)
+        await collection.create_index([("MMSI", pymongo.ASCENDING)], unique=True)
+        self._unique_mmsi_ready.add(collection.name)
+
+    async def _cached(self, reference_cache, key, load):
+        # shares the reference caches of main, a coroutine cannot go through get_or_load
+        value = reference_cache.get(key, reference_cache)
+        if value is reference_cache:
+            value = await load()
+            reference_cache.put(key, value)
+        return value
+
+    async def insert_batch_of_ais(self, ais_data, batch_size=main.DEFAULT_BATCH_SIZE):
+        """takes a batch of AIS data (json file) and inserts this data into mongoDB
+
+        :param ais_data: path of the file that stores the to be inserted AIS data
+        :type ais_data: str
+        :param batch_size: maximum number of documents sent in one insert_many
+        :type batch_size: int
+        :return: the number of documents inserted into the collection
+        :rtype: str
+        """
+
+        insertion_number = 0
+        batches = main.iter_batches(main.iter_ais_file(ais_data), batch_size)
+        while True:
+            # the file is read and decoded on a worker thread, not on the event loop
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            # a MalformedRecord is not inserted
+            positions, statics = main.split_messages([document for document in batch if isinstance(document, Mapping)])
+            stored_statics, _ = await self.store_statics(statics)
+            insertion_number += stored_statics
+            stored, _ = await self.insert_stored_documents(positions)
+            insertion_number += len(stored)
+            if stored:
+                await self.update_latest_positions(stored)
+        return "Number of Insertions: " + str(insertion_number)
+
+    async def insert_stored_documents(self, documents):
+        """inserts position reports unordered, deduplicated like main.insert_stored_documents
+
+        :param documents: position reports
+        :type documents: list
+        :return: the inserted documents, without failures and copies, and number of failed documents
+        :rtype: tuple
+        """
+
+        window = main.reportWindow
+        if window is not None:
+            documents = window.filter(documents)
+        if not documents:
+            return [], 0
+        try:
+            await self.ingest.insert_many(main.add_dates(documents), ordered=False)
+            return documents, 0
+        except BulkWriteError as error:
+            return main.stored_despite(error, documents, window)
+        except Exception:
+            if window is not None:
+                window.forget(documents)
+            raise
+
+    async def insert_single_ais(self, ais_data):
+        """inserts an AIS report (static data or position) into the collection.
+
+        static data goes to the vessels collection, see update_vessels.
+        :param ais_data: the AIS document to be inserted
+        :type ais_data: dict
+        :return: 'Success: 1' for successful insertion or 'Failure: 0' for failure, a copy of a stored
+            report is a success when deduplication is on
+        :rtype: str
+        """
+
+        positions, statics = main.split_messages([ais_data])
+        window = main.reportWindow
+        try:
+            if statics:
+                await self.update_vessels(statics)
+                return "Success: 1"
+            if window is not None and window.is_duplicate(positions[0]):
+                return "Success: 1"
+            await self.ingest.insert_one(main.add_dates(positions)[0])
+        except DuplicateKeyError:
+            if window is None:
+                return "Failure: 0"
+            window.count_rejected(1)
+            return "Success: 1"
+        except Exception:
+            if window is not None:
+                window.forget(positions)
+            return "Failure: 0"
+        try:
+            await self.update_latest_positions(positions)
+        except Exception:
+            main.ingestLog.exception("latest position of MMSI %s not updated", positions[0].get("MMSI"))
+        return "Success: 1"
+
+    async def store_statics(self, statics):
+        """upserts static data messages into the vessels like main.store_statics, a failure only fails the static data
+
+        :param statics: static_data messages
+        :type statics: list
+        :return: number of stored messages and number of failed messages
+        :rtype: tuple
+        """
+
+        if not statics:
+            return 0, 0
+        try:
+            await self.update_vessels(statics)
+            return len(statics), 0
+        except Exception:
+            main.ingestLog.exception("static data of %d messages not stored", len(statics))
+            return 0, len(statics)
+
+    async def update_vessels(self, statics):
+        """upserts static data messages into the vessels collection, writing only the vessels that changed
+
+        main.vesselCache is shared with the blocking backend when both use the same vessels collection.
+        :param statics: static_data messages
+        :type statics: list
+        :return: number of vessels written
+        :rtype: int
+        """
+
+        await self._ensure_unique_mmsi(self.vessels)
+        cached = self.vessels.full_name == main.vessels.full_name
+        known, missing = main.cached_vessels(statics, cached)
+        if missing:
+            async for vessel in self.vessels.find({"MMSI": {"$in": missing}}, main.VESSEL_STATIC_PROJECTION):
+                known.setdefault(vessel.pop("MMSI"), vessel)
+        operations, changed = main.vessel_updates(statics, known)
+        stale = []
+        if operations:
+            try:
+                await self.vessels.bulk_write(operations, ordered=False)
+            except BulkWriteError as error:
+                stale = main.stale_vessels(error, changed)
+        if cached:
+            main.cache_vessels(known, missing, changed, stale)
+        return len(operations) - len(stale)
+
+    async def update_latest_positions(self, documents):
+        """upserts the newest position report of every vessel into the latest positions collection
+
+        :param documents: AIS documents that were just stored
+        :type documents: list
+        :return: number of vessels whose latest position changed
+        :rtype: int
+        """
+
+        try:
+            await self._ensure_unique_mmsi(self.latest)
+            operations = main.latest_position_updates(documents)
+            if not operations:
+                return 0
+            try:
+                result = await self.latest.bulk_write(operations, ordered=False)
+                return result.upserted_count + result.modified_count
+            except BulkWriteError as error:
+                return main.stale_upserts_only(error)
+        finally:
+            main.notify_ingest(documents)
+
+    async def delete_ais_by_timestamp(self, current_time):
+        """deletes all AIS messages whose timestamp is 5 min older than current time
+
+        :param current_time: current time formatted in UTC ISO
+        :type current_time: str
+        :return: numbers of deletions
+        :rtype: str
+        """
+
+        result = await self.collection.delete_many(main.expired_filter(main.deletion_cutoff(current_time)))
+        return "Number of Deletions: " + str(result.deleted_count)
+
+    async def get_recent_vessel_positions(self):
+        """gets the latest position report of every vessel, most recent first
+
+        :return: array of position documents
+        :rtype: array
+        """
+
+        return await self.latest.find({}, {"_id": 0, "MMSI": 1, "Position.coordinates": 1}) \
+            .sort('Timestamp', pymongo.DESCENDING).to_list()
+
+    async def get_recent_vessel_position_mmsi(self, mmsi):
+        """gets the latest position report of a vessel
+
+        :param mmsi: MMSI of the vessel
+        :type mmsi: int
+        :return: array with the position document
+        :rtype: array
+        """
+
+        if not isinstance(mmsi, int):
+            raise TypeError('MMSI must be an integer')
+        return await self.latest.find({"MMSI": {"$eq": mmsi}},
+                                      {"_id": 0, "MMSI": 1, "Position.coordinates": 1}).limit(1).to_list()
+
+    async def find_all_ports(self, port_name, country=None):
+        """finds all ports with the given port name and optional country
+
+        :param port_name: port name to be searched
+        :type port_name: str
+        :param country: country of port to be searched
+        :type country: str
+        :return: an array that contains all documents that fit the criteria
+        :rtype: array
+        """
+
+        port_filter = {"port_location": port_name}
+        if country is not None:
+            port_filter["country"] = country
+        return await self.ports.find(port_filter, {"_id": 0}).to_list()
+
+    async def get_permanent_vessel_information(self, mmsi, imo=None, name=None):
+        """given an MMSI and optional IMO and name values, get permanent vessel information
+
+        :param mmsi: MMSI of the vessel
+        :type mmsi: int
+        :param imo: IMO of the vessel
+        :type imo: int
+        :param name: name of the vessel
+        :type name: str
+        :return: array of vessel documents
+        :rtype: array
+        """
+
+        return await self.vessels.find(main.vessel_filter(mmsi, imo, name), main.VESSEL_PROJECTION).to_list()
+
+    async def find_tile(self, mapview_id):
+        """gets the bounds of a mapview tile, cached after the first lookup
+
+        :param mapview_id: id of the mapview tile
+        :type mapview_id: int
+        :return: west, south, east and north of the tile or None
+        :rtype: dict
+        """
+
+        return await self._cached(main.tileCache, mapview_id,
+                                  lambda: self.mapviews.find_one({"id": mapview_id}, main.TILE_BOUNDS))
+
+    async def find_port_tile(self, port_filter):
+        """gets the bounds of the mapview tile of scale 3 containing a port
+
+        :param port_filter: filter selecting the port
+        :type port_filter: dict
+        :return: west, south, east and north of the tile or None if the port has no tile
+        :rtype: dict
+        """
+
+        async def load():
+            port = await self.ports.find_one(port_filter, {"mapview_3": 1, "_id": 0})
+            if not port or port.get("mapview_3") is None:
+                return None
+            return await self.find_tile(port["mapview_3"])
+
+        return await self._cached(main.portTileCache, main.port_key(port_filter), load)
+
+    async def _ports_or_positions(self, port_filter):
+        tile = await self.find_port_tile(port_filter)
+        if tile is None:
+            return await self.ports.find({}, main.PORT_LISTING_PROJECTION).to_list()
+        return await self.latest.find(main.tile_filter(tile), main.POSITION_PROJECTION).to_list()
+
+    async def read_all_ship_positions(self, port_name, country):
+        """read all ship positions in the tile of scale 3 containing given port
+
+        :param port_name: the port name of port to be searched
+        :type port_name: str
+        :param country: country of port to be searched
+        :type country: str
+        :return: array of position reports, otherwise, an array or port docs
+        :rtype: array
+        """
+
+        return await self._ports_or_positions({"port_location": port_name, "country": country})
+
+    async def read_positions_with_port_name(self, port_name, country):
+        """read the recent positions of ships in the tile of the port with port name and country
+
+        :param port_name: the port name
+        :type port_name: str
+        :param country: country of port
+        :type country: str
+        :return: array with all the ship positions found within the given port
+        :rtype: array
+        """
+
+        return await self._ports_or_positions({"port_location": port_name, "country": country})
+
+    async def read_positions_with_id(self, port_id):
+        """read most recent positions of ships in the tile of the port with port id
+
+        :param port_id: id of the port
+        :type port_id: str
+        :return: array containing all the ship positions found within the searched port
+        :rtype: array
+        """
+
+        tile = await self.find_port_tile({"id": port_id})
+        if tile is None:
+            return []
+        return await self.latest.find(main.tile_filter(tile), main.POSITION_PROJECTION).to_list()
+
+    async def get_recent_vessel_position_tile(self, tileId):
+        """given a tile id, get the recent vessel positions within the tile
+
+        :param tileId: id of the mapview tile
+        :type tileId: int
+        :return: array of ship documents
+        :rtype: array
+        """
+
+        if not isinstance(tileId, int):
+            raise TypeError('tileId must be an integer')
+        tile = await self.find_tile(tileId)
+        if tile is None:
+            return []
+        return await self.latest.find(main.tile_filter(tile), main.POSITION_PROJECTION).to_list()
+
+    async def get_tile_png(self, mapview_id):
+        """given a tile id, gets the PNG data of the tile from the tile store of main
+
+        hot tiles come from memory, the others are read on a worker thread.
+        :param mapview_id: id of the mapview tile
+        :type mapview_id: int
+        :return: PNG data or None if no PNG is stored for the tile
+        :rtype: bytes
+        """
+
+        if not isinstance(mapview_id, int):
+            raise TypeError("mapview_id must be an integer")
+        tile = await asyncio.to_thread(main.tileStore.get, mapview_id)
+        return tile.data if tile is not None else None
+
+    async def get_last_five_positions_mmsi(self, mmsi):
+        """gets the last five position reports of a vessel, most recent first
+
+        :param mmsi: MMSI of the vessel
+        :type mmsi: int
+        :return: array of position documents
+        :rtype: array
+        """
+
+        return await self.collection.find({"MMSI": {"$eq": mmsi}}, {"_id": 0, "MMSI": 1, "Position.coordinates": 1}) \
+            .sort('Timestamp', pymongo.DESCENDING).limit(5).to_list()
+
+    async def get_tiles_of_map_tile(self, mapview_id):
+        """given a mapview id, gets the tiles contained in the mapview id's map tile
+
+        :param mapview_id: id of the parent mapview tile
+        :type mapview_id: int
+        :return: array of mapview documents
+        :rtype: array
+        """
+
+        if not isinstance(mapview_id, int):
+            raise TypeError("mapview_id must be an integer")
+        tiles = await self._cached(main.childTileCache, mapview_id, lambda: self.mapviews.find(
+            {"contained_by": mapview_id}, main.CHILD_TILE_PROJECTION).to_list())
+        return [dict(tile) for tile in tiles]
+
+    async def get_viewport(self, tiles):
+        """given a parent mapview id or a list of tile ids, gets every tile with the vessels inside it
+
+        :param tiles: id of the parent mapview tile or list of mapview tile ids
+        :type tiles: int or list
+        :return: array of mapview documents, each with a vessels array of MMSI and Position documents
+        :rtype: array
+        """
+
+        if isinstance(tiles, int):
+            # fills the reference caches main.viewport_tiles reads without a query
+            await self.find_tile(tiles)
+            await self.get_tiles_of_map_tile(tiles)
+        else:
+            for tile_id in tiles:
+                if isinstance(tile_id, int):
+                    await self.find_tile(tile_id)
+        tiles, query = main.viewport_tiles(tiles)
+        if query is None:
+            return []
+        return main.partition_by_tile(tiles, await self.latest.find(query, main.POSITION_PROJECTION).to_list())
+
+    async def get_inbound_traffic(self, port_id=None, port_name=None, country=None, eta_from=None, eta_to=None):
+        """given a port id, or a port name and country, gets the vessels headed to the port
+
+        :param port_id: id of the port
+        :type port_id: str
+        :param port_name: the port name
+        :type port_name: str
+        :param country: country of the port
+        :type country: str
+        :param eta_from: earliest ETA, None for no lower bound
+        :type eta_from: datetime or str
+        :param eta_to: latest ETA, None for no upper bound
+        :type eta_to: datetime or str
+        :return: array of vessel documents with their latest Position, sorted by ETA
+        :rtype: array
+        """
+
+        if port_id is not None:
+            port_filter = {"id": port_id}
+        elif isinstance(port_name, str) and isinstance(country, str):
+            port_filter = {"port_location": port_name, "country": country}
+        else:
+            raise TypeError("a port id or a port name and country are required")
+        # the port tables are cached by main, only their first load blocks
+        code = await asyncio.to_thread(main.find_port_code, port_filter)
+        if code is None:
+            return []
+        return await (await self.vessels.aggregate(main.inbound_traffic_pipeline(code, eta_from, eta_to))).to_list()
+
+
+def benchmark_concurrency(tile_ids, levels=(10, 100, 1000), threads=32):
+    """compares sync queries on a thread pool with async queries on one event loop
+
+    every request is a get_recent_vessel_position_tile call for one of tile_ids.
+    :param tile_ids: mapview ids the requests are spread over
+    :type tile_ids: list
+    :param levels: numbers of concurrent requests to measure
+    :type levels: tuple
+    :param threads: size of the thread pool used for the sync backend
+    :type threads: int
+    :return: seconds and requests per second of both backends for every level
+    :rtype: dict
+    """
+
+    tmb = main.TrafficMonitoringBackEnd
+
+    def sync_request(tile_id):
+        return list(tmb.get_recent_vessel_position_tile(tile_id))
+
+    async def run_async(requests):
+        backend = AsyncTrafficMonitoringBackEnd()
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*(backend.get_recent_vessel_position_tile(tile_id) for tile_id in requests))
+            return time.perf_counter() - start
+        finally:
+            await backend.close()
+
+    results = {}
+    for level in levels:
+        requests = [tile_ids[index % len(tile_ids)] for index in range(level)]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            start = time.perf_counter()
+            list(executor.map(sync_request, requests))
+            sync_seconds = time.perf_counter() - start
+        async_seconds = asyncio.run(run_async(requests))
+        results[level] = {"sync_seconds": sync_seconds, "sync_per_sec": level / sync_seconds,
+                          "async_seconds": async_seconds, "async_per_sec": level / async_seconds}
+    return results
+
+
+if __name__ == '__main__':
+    for concurrency, result in benchmark_concurrency([int(tile_id) for tile_id in sys.argv[1:]]).items():
+        print(str(concurrency) + " concurrent: sync " + str(round(result["sync_per_sec"])) + " req/s, async "
+              + str(round(result["async_per_sec"])) + " req/s")
@@ -0,0 +1,358 @@
+"""Benchmark suite for the TMB (Traffic Monitoring Backend)
+
+   Generates synthetic AIS traffic over a grid of mapview tiles, loads it into
+   a local mongod or an in-process mongomock stand-in, and measures ingest
+   throughput, per-query latency percentiles and memory for every
+   TrafficMonitoringBackEnd method. Results are written as json so runs can be
+   compared to find regressions.
+
+   The queries mongomock cannot answer are marked unsupported in --mock runs.
+
+   usage: python benchmark.py [--mock] [--vessels N] [--output results.json] [--baseline old.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pymongo
+
+import main
+
+DEFAULT_BOUNDS = {"west": 7.0, "south": 54.5, "east": 15.0, "north": 58.0}
+START_TIME = datetime(2020, 11, 18)
+TILE_PNG_BYTES = 4096
+# the tile and port queries rely on $geoWithin, which mongomock does not implement
+MOCK_UNSUPPORTED = {"read_all_ship_positions", "read_positions_with_port_name", "read_positions_with_id",
+                    "get_recent_vessel_position_tile", "get_viewport"}
+
+
+def bind(client, database="AISBenchmark", collection="aisdk_20201118"):
+    """points the backend in main at another client and database
+
+    :param client: a pymongo.MongoClient or a mongomock.MongoClient
+    :param database: name of the database
+    :type database: str
+    :param collection: name of the AIS collection
+    :type collection: str
+    """
+
+    main.configure(client, database=database, collection=collection)
+
+
+def generate_tiles(bounds=DEFAULT_BOUNDS, rows=4, columns=4):
+    """generates a two level mapview grid below one root tile, named like the real mapviews
+
+    the root tile has id 1, the tiles of scale 2 are rows x columns tiles with ids
+    from 1000, and every one of them contains four tiles of scale 3 whose ids add
+    a quadrant digit 1-4.
+    :return: mapview documents
+    :rtype: list
+    """
+
+    tiles = [dict(bounds, id=1, contained_by=None, filename="1.png")]
+    height = (bounds["north"] - bounds["south"]) / rows
+    width = (bounds["east"] - bounds["west"]) / columns
+    for row in range(rows):
+        for column in range(columns):
+            tile_id = 1000 + row * columns + column
+            north = bounds["north"] - row * height
+            west = bounds["west"] + column * width
+            tiles.append({"id": tile_id, "west": west, "south": north - height, "east": west + width,
+                          "north": north, "contained_by": 1, "filename": str(tile_id) + ".png"})
+            for quadrant in range(4):
+                child_north = north - (quadrant // 2) * height / 2
+                child_west = west + (quadrant % 2) * width / 2
+                child_id = tile_id * 10 + quadrant + 1
+                tiles.append({"id": child_id, "west": child_west, "south": child_north - height / 2,
+                              "east": child_west + width / 2, "north": child_north, "contained_by": tile_id,
+                              "filename": str(child_id) + ".png"})
+    return tiles
+
+
+def generate_ports(tiles, count=50, rng=None):
+    """generates ports placed inside random tiles of scale 3
+
+    :return: port documents
+    :rtype: list
+    """
+
+    rng = rng or random.Random(0)
+    leaves = [tile for tile in tiles if tile["id"] >= 10000]
+    ports = []
+    for index in range(count):
+        tile = rng.choice(leaves)
+        ports.append({"id": str(index), "port_location": "Port" + str(index), "country": "Denmark",
+                      "un/locode": "DK" + format(index, "03d"), "website": "",
+                      "latitude": str(rng.uniform(tile["south"], tile["north"])),
+                      "longitude": str(rng.uniform(tile["west"], tile["east"])),
+                      "mapview_1": 1, "mapview_2": tile["contained_by"], "mapview_3": tile["id"]})
+    return ports
+
+
+def generate_ais(vessel_count=1000, minutes=10, rate=6, bounds=DEFAULT_BOUNDS, static_every=30, seed=0):
+    """generates realistic AIS traffic: vessels sail steady courses and report at a fixed rate
+
+    :param vessel_count: number of vessels
+    :type vessel_count: int
+    :param minutes: length of the generated period
+    :type minutes: int
+    :param rate: position reports per vessel per minute
+    :type rate: int
+    :param bounds: area the vessels start in
+    :type bounds: dict
+    :param static_every: one static_data message every this many position reports of a vessel
+    :type static_every: int
+    :param seed: seed of the random generator
+    :type seed: int
+    :return: generator of AIS documents in time order
+    :rtype: generator
+    """
+
+    rng = random.Random(seed)
+    fleet = []
+    for index in range(vessel_count):
+        fleet.append({"MMSI": 200000000 + index, "lat": rng.uniform(bounds["south"], bounds["north"]),
+                      "lon": rng.uniform(bounds["west"], bounds["east"]), "SoG": rng.uniform(0, 20),
+                      "CoG": rng.uniform(0, 360), "IMO": 9000000 + index, "Name": "VESSEL " + str(index),
+                      "reports": 0})
+    step = timedelta(seconds=60 / rate)
+    for tick in range(minutes * rate):
+        now = START_TIME + tick * step
+        timestamp = now.isoformat(timespec="milliseconds") + "Z"
+        for vessel in fleet:
+            # SoG knots over one step, one nautical mile is one minute of latitude
+            distance = vessel["SoG"] * step.total_seconds() / 3600 / 60
+            vessel["lat"] += distance * math.cos(math.radians(vessel["CoG"]))
+            vessel["lon"] += distance * math.sin(math.radians(vessel["CoG"])) / math.cos(math.radians(vessel["lat"]))
+            yield {"Timestamp": timestamp, "Class": "Class A", "MMSI": vessel["MMSI"], "MsgType": "position_report",
+                   "Position": {"type": "Point", "coordinates": [round(vessel["lat"], 6), round(vessel["lon"], 6)]},
+                   "Status": "Under way using engine", "RoT": 0.0, "SoG": round(vessel["SoG"], 1),
+                   "CoG": round(vessel["CoG"], 1), "Heading": int(vessel["CoG"])}
+            if vessel["reports"] % static_every == 0:
+                yield {"Timestamp": timestamp, "Class": "Class A", "MMSI": vessel["MMSI"], "MsgType": "static_data",
+                       "IMO": vessel["IMO"], "CallSign": "CS" + str(vessel["MMSI"] % 10000), "Name": vessel["Name"],
+                       "VesselType": "Cargo", "Length": 100, "Breadth": 20, "Draught": 6.0,
+                       "Destination": "DK" + format(vessel["IMO"] % 50, "03d"),
+                       "ETA": (now + timedelta(hours=6)).isoformat(timespec="milliseconds") + "Z"}
+            vessel["reports"] += 1
+
+
+def percentiles(samples):
+    """summarizes latency samples in milliseconds
+
+    :param samples: durations in seconds
+    :type samples: list
+    :return: count, mean, p50, p90, p99 and max in milliseconds
+    :rtype: dict
+    """
+
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {"count": len(ordered), "mean_ms": sum(ordered) / len(ordered) * 1000, "p50_ms": at(0.5),
+            "p90_ms": at(0.9), "p99_ms": at(0.99), "max_ms": ordered[-1] * 1000}
+
+
+def measure(call, iterations):
+    """runs a call repeatedly and records its latencies and peak traced memory
+
+    cursors returned by the call are consumed so the query really runs.
+    :return: latency percentiles, peak memory in bytes and the first error if any
+    :rtype: dict
+    """
+
+    samples = []
+    tracemalloc.start()
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            result = call()
+            if result is not None and not isinstance(result, (str, dict, list)):
+                result = list(result)
+            samples.append(time.perf_counter() - start)
+    except Exception as error:
+        return {"error": type(error).__name__ + ": " + str(error)}
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    report = percentiles(samples)
+    report["peak_bytes"] = peak
+    return report
+
+
+def run(vessel_count=1000, minutes=10, rate=6, iterations=50, seed=0, mock=False):
+    """loads synthetic traffic through the ingest paths and measures every TMB method
+
+    the database main is bound to is cleared first, use bind to point it at a
+    scratch one, the default database of main is refused. With mock the
+    MOCK_UNSUPPORTED queries are reported as unsupported instead of measured.
+    :return: benchmark results
+    :rtype: dict
+    """
+
+    if main.myDataBase.name == main.DEFAULT_SETTINGS["database"]:
+        raise ValueError("the benchmark clears " + main.myDataBase.name + ", bind it to a scratch database first")
+    rng = random.Random(seed)
+    tmb = main.TrafficMonitoringBackEnd
+    for collection in (main.myCollection, main.latestPositions, main.myPorts, main.myMapViews, main.vessels):
+        collection.drop()
+    main.invalidate_reference_cache()
+    tiles = generate_tiles()
+    ports = generate_ports(tiles, rng=rng)
+    main.myMapViews.insert_many([dict(tile) for tile in tiles])
+    main.myPorts.insert_many([dict(port) for port in ports])
+    main.ensure_indexes()
+    leaves = [tile["id"] for tile in tiles if tile["id"] >= 10000]
+    # one stored PNG so get_tile_png is measured on the hit path as well as the miss path
+    stored_tile = leaves[0]
+    main.tileStore.put(stored_tile, bytes(rng.getrandbits(8) for _ in range(TILE_PNG_BYTES)))
+
+    results = {"parameters": {"vessels": vessel_count, "minutes": minutes, "rate": rate, "iterations": iterations,
+                              "seed": seed},
+               "started": datetime.now().isoformat(), "ingest": {}, "queries": {}}
+
+    documents = list(generate_ais(vessel_count, minutes, rate, seed=seed))
+    handle, path = tempfile.mkstemp(suffix=".ndjson")
+    with os.fdopen(handle, "w") as file:
+        for document in documents:
+            file.write(json.dumps(document) + "\n")
+    try:
+        tracemalloc.start()
+        start = time.perf_counter()
+        report = tmb.stream_batch_of_ais(path)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results["ingest"]["stream_batch_of_ais"] = {"documents": report["inserted"], "seconds": seconds,
+                                                    "docs_per_sec": report["inserted"] / seconds,
+                                                    "peak_bytes": peak}
+    finally:
+        os.remove(path)
+
+    singles = [dict(document, Timestamp="2020-11-19T00:00:00.000Z") for document in documents[:2000]]
+    start = time.perf_counter()
+    for document in singles:
+        tmb.insert_single_ais(document)
+    seconds = time.perf_counter() - start
+    results["ingest"]["insert_single_ais"] = {"documents": len(singles), "seconds": seconds,
+                                              "docs_per_sec": len(singles) / seconds}
+
+    buffered = [dict(document, Timestamp="2020-11-19T00:01:00.000Z") for document in documents[:2000]]
+    start = time.perf_counter()
+    with main.BufferedAISWriter() as writer:
+        for document in buffered:
+            writer.write(document)
+    seconds = time.perf_counter() - start
+    results["ingest"]["buffered_writer"] = {"documents": len(buffered), "seconds": seconds,
+                                            "docs_per_sec": len(buffered) / seconds}
+
+    mmsis = [200000000 + index for index in range(vessel_count)]
+    parents = [tile["id"] for tile in tiles if tile["contained_by"] == 1]
+    port = rng.choice(ports)
+    queries = {
+        "get_recent_vessel_positions": lambda: tmb.get_recent_vessel_positions(None),
+        "get_recent_vessel_position_mmsi": lambda: tmb.get_recent_vessel_position_mmsi(rng.choice(mmsis)),
+        "get_last_five_positions_mmsi": lambda: tmb.get_last_five_positions_mmsi(rng.choice(mmsis)),
+        "get_permanent_vessel_information": lambda: tmb.get_permanent_vessel_information(rng.choice(mmsis)),
+        "find_all_ports": lambda: tmb.find_all_ports(port["port_location"], port["country"]),
+        "read_all_ship_positions": lambda: tmb.read_all_ship_positions(port["port_location"], port["country"]),
+        "read_positions_with_port_name":
+            lambda: tmb.read_positions_with_port_name(port["port_location"], port["country"]),
+        "read_positions_with_id": lambda: tmb.read_positions_with_id(port["id"]),
+        "get_recent_vessel_position_tile": lambda: tmb.get_recent_vessel_position_tile(rng.choice(leaves)),
+        "get_tiles_of_map_tile": lambda: tmb.get_tiles_of_map_tile(rng.choice(parents)),
+        "get_viewport": lambda: tmb.get_viewport(rng.choice(parents)),
+        "get_inbound_traffic": lambda: tmb.get_inbound_traffic(port["id"]),
+        "get_tile_png": lambda: tmb.get_tile_png(stored_tile),
+        "get_tile_png_missing": lambda: tmb.get_tile_png(rng.choice(leaves[1:])),
+        "get_vessel_card": lambda: tmb.get_vessel_card(rng.choice(mmsis)),
+        "get_vessel_cards": lambda: tmb.get_vessel_cards(rng.sample(mmsis, min(50, len(mmsis)))),
+    }
+    for name, call in queries.items():
+        if mock and name in MOCK_UNSUPPORTED:
+            results["queries"][name] = {"unsupported": "$geoWithin is not implemented by mongomock"}
+        else:
+            results["queries"][name] = measure(call, iterations)
+
+    results["queries"]["delete_ais_by_timestamp"] = measure(
+        lambda: tmb.delete_ais_by_timestamp("2020-11-18 00:05:00.000000"), 1)
+    results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def compare(baseline, current, tolerance=0.2):
+    """lists the measurements that got worse by more than tolerance
+
+    :param baseline: results of an earlier run
+    :type baseline: dict
+    :param current: results of this run
+    :type current: dict
+    :param tolerance: allowed relative slowdown
+    :type tolerance: float
+    :return: regressions as (name, metric, baseline value, current value)
+    :rtype: list
+    """
+
+    regressions = []
+    for name, before in baseline.get("ingest", {}).items():
+        after = current.get("ingest", {}).get(name)
+        if after and after["docs_per_sec"] < before["docs_per_sec"] * (1 - tolerance):
+            regressions.append((name, "docs_per_sec", before["docs_per_sec"], after["docs_per_sec"]))
+    for name, before in baseline.get("queries", {}).items():
+        after = current.get("queries", {}).get(name)
+        if after and "p50_ms" in before and "p50_ms" in after:
+            for metric in ("p50_ms", "p99_ms"):
+                if after[metric] > before[metric] * (1 + tolerance):
+                    regressions.append((name, metric, before[metric], after[metric]))
+    return regressions
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="benchmark the Traffic Monitoring Backend")
+    parser.add_argument("--uri", default="mongodb://localhost:27017", help="mongod to benchmark against")
+    parser.add_argument("--database", default="AISBenchmark", help="scratch database, it is cleared")
+    parser.add_argument("--mock", action="store_true", help="use an in-process mongomock instead of mongod")
+    parser.add_argument("--vessels", type=int, default=1000)
+    parser.add_argument("--minutes", type=int, default=10)
+    parser.add_argument("--rate", type=int, default=6, help="position reports per vessel per minute")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file the json results are written to")
+    parser.add_argument("--baseline", help="json results of an earlier run to compare with")
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    options = parse_arguments(sys.argv[1:])
+    if options.mock:
+        import mongomock
+        import mongomock.gridfs
+        # the tile store keeps its PNGs in GridFS
+        mongomock.gridfs.enable_gridfs_integration()
+        bind(mongomock.MongoClient(), options.database)
+    else:
+        bind(pymongo.MongoClient(options.uri), options.database)
+    benchmark_results = run(options.vessels, options.minutes, options.rate, options.iterations, options.seed,
+                            options.mock)
+    output = json.dumps(benchmark_results, indent=2)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            for regression in compare(json.load(baseline_file), benchmark_results):
+                print("regression: " + regression[0] + " " + regression[1] + " " + str(regression[2]) + " -> "
+                      + str(regression[3]), file=sys.stderr)
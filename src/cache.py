@@ -0,0 +1,102 @@
+"""A small read-through cache for the TMB (Traffic Monitoring Backend) reference data
+
+   Ports and mapview tiles essentially never change, so their lookups are kept in
+   process in size-bounded LRU caches with an optional time to live.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """a thread-safe least recently used cache with an optional time to live
+
+    :param maxsize: maximum number of entries kept, the least recently used is evicted first
+    :type maxsize: int
+    :param ttl: number of seconds an entry stays valid, None keeps entries until evicted
+    :type ttl: float
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """gets a cached value and marks it as recently used
+
+        :param key: key of the entry
+        :param default: value returned when the key is missing or expired
+        :return: the cached value or default
+        """
+
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """stores a value, evicting the least recently used entries when full
+
+        :param key: key of the entry
+        :param value: value to be cached, None is a valid value
+        """
+
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """gets a cached value or loads, caches and returns it
+
+        :param key: key of the entry
+        :param loader: function without arguments producing the value on a miss
+        :type loader: function
+        :return: the cached or loaded value
+        """
+
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key=_MISSING):
+        """drops one entry, or every entry when no key is given
+
+        :param key: key of the entry to be dropped
+        """
+
+        with self._lock:
+            if key is _MISSING:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        """reports the hit and miss counters and the current size
+
+        :return: hits, misses and size
+        :rtype: dict
+        """
+
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
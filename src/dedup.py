@@ -0,0 +1,130 @@
+"""Deduplication of repeated AIS reports for the TMB (Traffic Monitoring Backend)
+
+   Feeds from several receivers deliver the same report more than once. A
+   report is identified by its MMSI, Timestamp and MsgType; the keys of the
+   recently stored reports are kept in a bounded in-memory window so most copies
+   are dropped before reaching mongo, and a unique index on the same keys
+   rejects the copies that arrive after their original left the window.
+"""
+
+import threading
+from collections.abc import Mapping
+
+import pymongo
+
+DEDUP_KEYS = [("MMSI", pymongo.ASCENDING), ("Timestamp", pymongo.DESCENDING), ("MsgType", pymongo.ASCENDING)]
+DUPLICATE_KEY_ERROR = 11000
+
+
+def report_key(document):
+    """identity of an AIS report, None for something that is not a report"""
+
+    if not isinstance(document, Mapping):
+        return None
+    return document.get("MMSI"), document.get("Timestamp"), document.get("MsgType")
+
+
+class ReportWindow:
+    """remembers the keys of the last reports so their copies can be dropped
+
+    the keys live in two generations of at most capacity / 2 keys each; when the
+    current generation is full the older one is forgotten, so memory stays
+    bounded and a key is remembered for at least capacity / 2 reports.
+    :param capacity: maximum number of remembered keys
+    :type capacity: int
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.seen = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._current = set()
+        self._previous = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def is_duplicate(self, document):
+        """checks a report against the window and remembers it
+
+        :param document: AIS document
+        :type document: dict
+        :return: True when the same report was seen recently
+        :rtype: bool
+        """
+
+        key = report_key(document)
+        if key is None:
+            return False
+        with self._lock:
+            self.seen += 1
+            if key in self._current or key in self._previous:
+                self.dropped += 1
+                return True
+            if len(self._current) >= self.capacity // 2:
+                self._previous = self._current
+                self._current = set()
+            self._current.add(key)
+            return False
+
+    def filter(self, documents):
+        """drops the reports seen recently, including copies inside the list
+
+        :param documents: AIS documents
+        :type documents: list
+        :return: the documents that are new
+        :rtype: list
+        """
+
+        return [document for document in documents if not self.is_duplicate(document)]
+
+    def forget(self, documents):
+        """removes reports whose insert failed from the window so they can be sent again
+
+        :param documents: AIS documents
+        :type documents: list
+        """
+
+        with self._lock:
+            for document in documents:
+                key = report_key(document)
+                self._current.discard(key)
+                self._previous.discard(key)
+
+    def count_rejected(self, count):
+        """counts copies that were rejected by the unique index"""
+
+        with self._lock:
+            self.rejected += count
+
+    def stats(self):
+        """reports the checked reports and the copies dropped by the window and by the index
+
+        :rtype: dict
+        """
+
+        with self._lock:
+            return {"seen": self.seen, "dropped": self.dropped, "rejected": self.rejected,
+                    "size": len(self._current) + len(self._previous), "capacity": self.capacity}
+
+
+def remove_duplicate_reports(collection):
+    """deletes the stored copies of every report, keeping the first one, so the unique index can be built
+
+    :param collection: AIS collection
+    :type collection: pymongo.collection.Collection
+    :return: number of deleted copies
+    :rtype: int
+    """
+
+    copies = collection.aggregate([
+        {"$group": {"_id": {field: "$" + field for field, _ in DEDUP_KEYS}, "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    deleted = 0
+    for group in copies:
+        deleted += collection.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count
+    return deleted
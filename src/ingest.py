@@ -0,0 +1,365 @@
+"""Parallel ingest pipeline for the TMB (Traffic Monitoring Backend)
+
+   Byte ranges of newline delimited json files are parsed and validated in a
+   pool of processes. The workers hand their documents back BSON encoded, the
+   parent only wraps them in RawBSONDocuments that insert_many sends as they are,
+   so no document is unpickled or encoded again on the parent's single thread.
+   Json arrays cannot be split, each one is parsed incrementally by one worker.
+   A worker puts every batch on a bounded queue as soon as it is full, the
+   batches are then drained by writer threads sharing one MongoClient. A full
+   queue blocks the workers so parsers can never outrun mongo, and a worker
+   holds at most one batch.
+"""
+
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+import main
+
+DEFAULT_RANGE_SIZE = 16 << 20
+RAW_BSON_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+# seconds the receiver waits for a batch before checking whether the parse tasks are over
+RECEIVE_TIMEOUT = 0.1
+
+# queue of a worker process the encoded batches are put on, set by init_worker
+resultQueue = None
+
+
+def is_valid_ais(document):
+    """checks that a document carries the fields every AIS message needs
+
+    :param document: decoded AIS message
+    :type document: dict
+    :return: True if the document can be stored
+    :rtype: bool
+    """
+
+    return isinstance(document, dict) and isinstance(document.get("MMSI"), int) \
+        and isinstance(document.get("Timestamp"), str) and isinstance(document.get("MsgType"), str)
+
+
+def is_ndjson(path):
+    """tells if a file is newline delimited json rather than a json array
+
+    :param path: path of the AIS file
+    :type path: str
+    :rtype: bool
+    """
+
+    with open(path, "rb") as file:
+        while True:
+            char = file.read(1)
+            if not char:
+                return True
+            if not char.isspace():
+                return char != b"["
+
+
+def split_file(path, range_size=DEFAULT_RANGE_SIZE):
+    """splits an AIS file into parse tasks
+
+    an ndjson file is cut into byte ranges of about range_size bytes. A json
+    array cannot be split and gives one (path, 0, None) task for the whole file.
+    :param path: path of the AIS file
+    :type path: str
+    :param range_size: number of bytes parsed by one task
+    :type range_size: int
+    :return: list of (path, start, end) tasks
+    :rtype: list
+    """
+
+    if not is_ndjson(path):
+        return [(path, 0, None)]
+    size = os.path.getsize(path)
+    return [(path, start, min(start + range_size, size)) for start in range(0, max(size, 1), range_size)]
+
+
+def iter_ndjson_range(path, start, end):
+    """yields the documents of the lines of an ndjson file that start inside [start, end)
+
+    :param path: path of the AIS file
+    :type path: str
+    :param start: first byte of the range
+    :type start: int
+    :param end: byte after the last byte of the range
+    :type end: int
+    :return: generator of AIS documents
+    :rtype: generator
+    """
+
+    with open(path, "rb") as file:
+        if start > 0:
+            # the line containing start - 1 belongs to the previous range
+            file.seek(start - 1)
+            file.readline()
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                return
+            if line.strip():
+                yield main.decode_record(line)
+
+
+def encode_batch(documents):
+    """prepares a batch of valid AIS documents for the writers, in the worker processes
+
+    the position reports are slimmed, dated and BSON encoded, and so is the newest
+    position of every vessel, so the parent never decodes them.
+    :param documents: valid AIS documents
+    :type documents: list
+    :return: encoded position reports, static_data messages and encoded newest positions
+    :rtype: tuple
+    """
+
+    positions, statics = main.split_messages(documents)
+    main.add_dates(positions)
+    return (b"".join(bson.encode(document) for document in positions), statics,
+            b"".join(bson.encode(document) for document in main.newest_positions(positions)))
+
+
+def decode_batch(batch):
+    """wraps an encoded batch in RawBSONDocuments, their fields are only decoded when read
+
+    :param batch: encoded batch made by encode_batch
+    :type batch: tuple
+    :return: position reports, static_data messages and newest positions
+    :rtype: tuple
+    """
+
+    positions, statics, newest = batch
+    return bson.decode_all(positions, RAW_BSON_OPTIONS), statics, bson.decode_all(newest, RAW_BSON_OPTIONS)
+
+
+def init_worker(results):
+    """binds a worker process to the queue of the pipeline, the initializer of the process pool
+
+    :param results: bounded queue the encoded batches are put on
+    :type results: multiprocessing.Queue
+    """
+
+    global resultQueue
+    resultQueue = results
+
+
+def parse_task(task, batch_size=main.DEFAULT_BATCH_SIZE):
+    """parses, validates and encodes one task, runs inside the worker processes
+
+    a task without an end is a whole json array file. Every batch is put on the
+    queue of init_worker as soon as it is full, blocking while the queue is full.
+    :param task: (path, start, end) tuple created by split_file
+    :type task: tuple
+    :param batch_size: maximum number of documents in a batch
+    :type batch_size: int
+    :return: number of batches put on the queue, number of rejected documents and
+        the error that ended the task or None
+    :rtype: tuple
+    """
+
+    path, start, end = task
+    put = invalid = 0
+    batch = []
+    try:
+        documents = main.iter_ais_file(path) if end is None else iter_ndjson_range(path, start, end)
+        for document in documents:
+            if not is_valid_ais(document):
+                invalid += 1
+                continue
+            batch.append(document)
+            if len(batch) >= batch_size:
+                resultQueue.put(encode_batch(batch))
+                put += 1
+                batch = []
+        if batch:
+            resultQueue.put(encode_batch(batch))
+            put += 1
+    except Exception as error:
+        # the batches already put are written, the parent must still count them
+        return put, invalid, str(error)
+    return put, invalid, None
+
+
+class IngestPipeline:
+    """fans AIS files out over a process pool and funnels them into mongo
+
+    the ingest listeners of main get the newest stored position of every vessel of a batch.
+
+    :param workers: number of parser processes
+    :type workers: int
+    :param writers: number of writer threads sharing the collection's client
+    :type writers: int
+    :param batch_size: maximum number of documents sent in one insert_many
+    :type batch_size: int
+    :param queue_size: maximum number of batches waiting for a writer
+    :type queue_size: int
+    :param range_size: number of bytes of an ndjson file parsed by one task
+    :type range_size: int
+    :param collection: collection the documents are inserted into
+    :type collection: pymongo.collection.Collection
+    :param latest: collection holding the latest position of every vessel, False to skip it
+    :type latest: pymongo.collection.Collection
+    """
+
+    def __init__(self, workers=None, writers=4, batch_size=main.DEFAULT_BATCH_SIZE, queue_size=None,
+                 range_size=DEFAULT_RANGE_SIZE, collection=None, latest=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.writers = writers
+        self.batch_size = batch_size
+        self.queue_size = queue_size or 2 * writers
+        self.range_size = range_size
+        self.collection = collection if collection is not None else main.ingestCollection
+        self.latest = latest if latest is not None else main.latestPositions
+
+    def run(self, paths):
+        """ingests every given file and reports the totals
+
+        :param paths: paths of the AIS files (json arrays or ndjson)
+        :type paths: list
+        :return: inserted, failed and invalid counts, seconds and docs_per_sec
+        :rtype: dict
+        """
+
+        if isinstance(paths, str):
+            paths = [paths]
+        tasks = [task for path in paths for task in split_file(path, self.range_size)]
+        # the workers are not forked from this process, whose writer threads could hold locks
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+        results = context.Queue(maxsize=self.queue_size)
+        batches = queue.Queue(maxsize=self.writers)
+        lock = threading.Lock()
+        totals = {"inserted": 0, "failed": 0, "invalid": 0, "batches": 0}
+        errors = []
+        # expected is the number of batches the finished tasks put, lost when a worker died uncounted
+        parsing = {"expected": None, "lost": False}
+
+        def receive_batches():
+            received = 0
+            while True:
+                expected = parsing["expected"]
+                if expected is not None and not parsing["lost"] and received >= expected:
+                    break
+                try:
+                    batch = results.get(timeout=RECEIVE_TIMEOUT)
+                except queue.Empty:
+                    # without a count the batches still on their way are taken until the queue stays empty
+                    if expected is not None and parsing["lost"]:
+                        break
+                    continue
+                batches.put(decode_batch(batch))
+                received += 1
+            for _ in threads:
+                batches.put(None)
+
+        def write_batches():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                positions, statics, newest = batch
+                try:
+                    stored, failed = main.insert_stored_documents(self.collection, positions) \
+                        if positions else ([], 0)
+                except Exception as error:
+                    errors.append(error)
+                    stored, failed = [], len(positions)
+                if len(stored) < len(positions):
+                    # the newest positions of the workers may not all have been stored
+                    newest = main.newest_positions(stored)
+                written, failed_statics = main.store_statics(statics)
+                if self.latest is not False:
+                    try:
+                        main.update_latest_positions(newest, self.latest)
+                    except Exception as error:
+                        errors.append(error)
+                with lock:
+                    totals["inserted"] += len(stored) + written
+                    totals["failed"] += failed + failed_statics
+                    totals["batches"] += 1
+
+        threads = [threading.Thread(target=write_batches, daemon=True) for _ in range(self.writers)]
+        receiver = threading.Thread(target=receive_batches, daemon=True)
+
+        start = time.perf_counter()
+        expected = 0
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_worker,
+                                     initargs=(results,)) as executor:
+                for thread in threads + [receiver]:
+                    thread.start()
+                remaining = iter(tasks)
+                running = set()
+                while True:
+                    # only keep one parse task per worker in flight, the workers
+                    # block on the full queue while the writers lag behind
+                    while len(running) < self.workers:
+                        task = next(remaining, None)
+                        if task is None:
+                            break
+                        running.add(executor.submit(parse_task, task, self.batch_size))
+                    if not running:
+                        break
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            put, invalid, error = future.result()
+                        except Exception as error:
+                            # a worker died, the batches it put can no longer be counted
+                            errors.append(error)
+                            parsing["lost"] = True
+                            continue
+                        expected += put
+                        if error is not None:
+                            # e.g. an unreadable file, the other tasks go on
+                            errors.append(error)
+                        with lock:
+                            totals["invalid"] += invalid
+        except BaseException:
+            parsing["lost"] = True
+            raise
+        finally:
+            parsing["expected"] = expected
+            if receiver.is_alive():
+                receiver.join()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+            results.close()
+        seconds = time.perf_counter() - start
+
+        totals["seconds"] = seconds
+        totals["docs_per_sec"] = totals["inserted"] / seconds if seconds else 0.0
+        totals["errors"] = [str(error) for error in errors]
+        return totals
+
+
+def benchmark_ingest(paths, worker_counts=(1, 2, 4, 8), **options):
+    """measures the ingest throughput of the pipeline for several worker counts
+
+    every run inserts the same files again, use a scratch collection.
+    :param paths: paths of the AIS files
+    :type paths: list
+    :param worker_counts: numbers of parser processes to measure
+    :type worker_counts: tuple
+    :return: msgs/s for each worker count
+    :rtype: dict
+    """
+
+    results = {}
+    for workers in worker_counts:
+        report = IngestPipeline(workers=workers, **options).run(paths)
+        results[workers] = report["docs_per_sec"]
+    return results
+
+
+if __name__ == '__main__':
+    for worker_count, rate in benchmark_ingest(sys.argv[1:]).items():
+        print(str(worker_count) + " workers: " + str(round(rate)) + " msgs/s")
@@ -0,0 +1,347 @@
+"""Live position push for the TMB (Traffic Monitoring Backend)
+
+   Instead of polling get_recent_vessel_position_tile, a client subscribes to a
+   mapview tile, a bounding box or a set of MMSIs and receives the position
+   reports matching it. One reader tails a change stream on the AIS collection
+   (or listens to the ingest path of main when the server has no change streams)
+   and fans the reports out through a grid index, so every report only touches
+   the subscriptions of its cell. Each subscription keeps at most one pending
+   update per vessel in a bounded buffer, a slow client gets the newest position
+   and never holds up the reader.
+"""
+
+import math
+import threading
+from collections import OrderedDict
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import main
+from spatial import CELL_LAT, CELL_LON
+
+# subscriptions covering more grid cells than this are checked against every report instead
+MAX_INDEXED_CELLS = 4096
+UPDATE_FIELDS = ("MMSI", "Timestamp", "Position", "SoG", "CoG", "Heading")
+CHANGE_STREAM_PIPELINE = [
+    {"$match": {"operationType": "insert", "fullDocument.MsgType": "position_report",
+                "fullDocument.Position": {"$exists": True}}},
+    {"$project": {"fullDocument." + field: 1 for field in UPDATE_FIELDS}},
+]
+
+
+def position_update(document):
+    """slims an AIS position report down to what subscribers receive
+
+    :param document: AIS document
+    :type document: dict
+    :return: MMSI, Timestamp, Position coordinates (latitude first), SoG, CoG and Heading
+    :rtype: dict
+    """
+
+    update = {field: document[field] for field in UPDATE_FIELDS if field in document}
+    update["Position"] = {"coordinates": list(document["Position"]["coordinates"])}
+    return update
+
+
+class Subscription:
+    """a client's interest in an area or in vessels, with a buffer of pending updates
+
+    updates are coalesced per vessel: a newer report replaces the pending one.
+    When maxsize vessels are pending the oldest one is dropped and counted.
+    :param bbox: west, south, east, north of the area, None for every position
+    :type bbox: tuple
+    :param mmsis: MMSIs of the vessels, None for every vessel
+    :type mmsis: set
+    :param maxsize: maximum number of vessels with a pending update
+    :type maxsize: int
+    """
+
+    def __init__(self, bbox=None, mmsis=None, maxsize=1000):
+        self.bbox = bbox
+        self.mmsis = frozenset(mmsis) if mmsis is not None else None
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._pending = OrderedDict()
+        self._ready = threading.Condition()
+
+    def __iter__(self):
+        while True:
+            updates = self.get()
+            if not updates:
+                return
+            yield from updates
+
+    def matches(self, mmsi, lat, lon):
+        """whether a position of a vessel belongs to this subscription"""
+
+        if self.mmsis is not None and mmsi not in self.mmsis:
+            return False
+        if self.bbox is not None:
+            west, south, east, north = self.bbox
+            return south <= lat <= north and west <= lon <= east
+        return True
+
+    def offer(self, update):
+        """queues an update, replacing a pending one of the same vessel unless it is older"""
+
+        with self._ready:
+            if self.closed:
+                return
+            mmsi = update["MMSI"]
+            pending = self._pending.pop(mmsi, None)
+            if pending is not None and pending["Timestamp"] > update["Timestamp"]:
+                update = pending
+            elif pending is None and len(self._pending) >= self.maxsize:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._pending[mmsi] = update
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """takes every pending update, waiting for one if there is none
+
+        :param timeout: seconds to wait, None waits until an update or close
+        :type timeout: float
+        :return: updates in the order the vessels first became pending, empty on timeout or close
+        :rtype: list
+        """
+
+        with self._ready:
+            if not self._pending and not self.closed:
+                self._ready.wait(timeout)
+            updates = list(self._pending.values())
+            self._pending.clear()
+            return updates
+
+    def close(self):
+        """wakes up the reader of the subscription, later updates are ignored"""
+
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+
+
+class PositionHub:
+    """fans position reports out to the subscriptions they match
+
+    :param cell_lat: height of a grid cell in degrees
+    :type cell_lat: float
+    :param cell_lon: width of a grid cell in degrees
+    :type cell_lon: float
+    """
+
+    def __init__(self, cell_lat=CELL_LAT, cell_lon=CELL_LON):
+        self.cell_lat = cell_lat
+        self.cell_lon = cell_lon
+        self.published = 0
+        self._cells = {}
+        self._by_mmsi = {}
+        self._everywhere = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._following_ingest = False
+        self.resume_token = None
+
+    def __len__(self):
+        with self._lock:
+            subscriptions = set(self._everywhere)
+            for cell in self._cells.values():
+                subscriptions.update(cell)
+            for vessel in self._by_mmsi.values():
+                subscriptions.update(vessel)
+            return len(subscriptions)
+
+    def _cell(self, lat, lon):
+        return math.floor((lat + 90) / self.cell_lat), math.floor((lon + 180) / self.cell_lon)
+
+    def _bbox_cells(self, bbox):
+        west, south, east, north = bbox
+        first_row, first_column = self._cell(south, west)
+        last_row, last_column = self._cell(north, east)
+        if (last_row - first_row + 1) * (last_column - first_column + 1) > MAX_INDEXED_CELLS:
+            return None
+        return [(row, column) for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1)]
+
+    def subscribe(self, bbox=None, mmsis=None, maxsize=1000):
+        """registers a subscription to an area, to vessels or to both
+
+        :param bbox: west, south, east, north of the area
+        :type bbox: tuple
+        :param mmsis: MMSIs of the vessels
+        :type mmsis: list
+        :param maxsize: maximum number of vessels with a pending update
+        :type maxsize: int
+        :return: the subscription, read it with get or by iterating
+        :rtype: Subscription
+        """
+
+        if mmsis is not None and not all(isinstance(mmsi, int) for mmsi in mmsis):
+            raise TypeError('MMSI must be an integer')
+        subscription = Subscription(tuple(bbox) if bbox is not None else None, mmsis, maxsize)
+        with self._lock:
+            if subscription.mmsis is not None:
+                for mmsi in subscription.mmsis:
+                    self._by_mmsi.setdefault(mmsi, set()).add(subscription)
+            elif subscription.bbox is not None and self._bbox_cells(subscription.bbox) is not None:
+                for cell in self._bbox_cells(subscription.bbox):
+                    self._cells.setdefault(cell, set()).add(subscription)
+            else:
+                self._everywhere.add(subscription)
+        return subscription
+
+    def subscribe_tile(self, tileId, maxsize=1000):
+        """registers a subscription to the vessels inside a mapview tile
+
+        :param tileId: id of the mapview tile
+        :type tileId: int
+        :param maxsize: maximum number of vessels with a pending update
+        :type maxsize: int
+        :return: the subscription
+        :rtype: Subscription
+        :raises ValueError: when no mapview tile has the id
+        """
+
+        if not isinstance(tileId, int):
+            raise TypeError('tileId must be an integer')
+        tile = main.find_tile(tileId)
+        if tile is None:
+            raise ValueError("unknown mapview tile " + str(tileId))
+        return self.subscribe((tile["west"], tile["south"], tile["east"], tile["north"]), maxsize=maxsize)
+
+    def unsubscribe(self, subscription):
+        """removes a subscription and closes it
+
+        :param subscription: a subscription returned by this hub
+        :type subscription: Subscription
+        """
+
+        with self._lock:
+            self._everywhere.discard(subscription)
+            if subscription.mmsis is not None:
+                for mmsi in subscription.mmsis:
+                    self._discard(self._by_mmsi, mmsi, subscription)
+            elif subscription.bbox is not None:
+                for cell in self._bbox_cells(subscription.bbox) or ():
+                    self._discard(self._cells, cell, subscription)
+        subscription.close()
+
+    @staticmethod
+    def _discard(index, key, subscription):
+        subscriptions = index.get(key)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[key]
+
+    def publish(self, documents):
+        """hands AIS documents to the matching subscriptions, messages without a Position in range are skipped
+
+        a position that is not available (91/181) is not sent, like it does not
+        move the latest position of main.
+
+        :param documents: AIS documents
+        :type documents: list
+        :return: number of updates delivered
+        :rtype: int
+        """
+
+        delivered = 0
+        with self._lock:
+            for document in documents:
+                if "MMSI" not in document or main.position_location(document) is None:
+                    continue
+                mmsi = document["MMSI"]
+                lat, lon = document["Position"]["coordinates"][:2]
+                candidates = self._cells.get(self._cell(lat, lon), ())
+                by_mmsi = self._by_mmsi.get(mmsi, ())
+                update = None
+                for group in (candidates, by_mmsi, self._everywhere):
+                    for subscription in group:
+                        if subscription.matches(mmsi, lat, lon):
+                            if update is None:
+                                update = position_update(document)
+                            subscription.offer(update)
+                            delivered += 1
+            self.published += len(documents)
+        return delivered
+
+    def follow_ingest(self):
+        """publishes every document stored through main, for servers without change streams"""
+
+        main.add_ingest_listener(self.publish)
+        self._following_ingest = True
+
+    def follow_change_stream(self, collection=None):
+        """tails the inserts of the AIS collection on a background thread
+
+        the change stream resumes after the last seen event when it is interrupted.
+        :param collection: AIS collection
+        :type collection: pymongo.collection.Collection
+        :return: the change stream reader thread
+        :rtype: threading.Thread
+        """
+
+        collection = collection if collection is not None else main.myCollection
+        # opening the stream here surfaces servers without change streams to the caller
+        stream = collection.watch(CHANGE_STREAM_PIPELINE, resume_after=self.resume_token)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._tail, args=(collection, stream), daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def _tail(self, collection, stream):
+        while not self._stop.is_set():
+            try:
+                # reopening fails too while the server is down, the loop retries until stopped
+                if stream is None:
+                    stream = collection.watch(CHANGE_STREAM_PIPELINE, resume_after=self.resume_token)
+                with stream:
+                    while stream.alive and not self._stop.is_set():
+                        change = stream.try_next()
+                        self.resume_token = stream.resume_token
+                        if change is not None:
+                            self.publish([change["fullDocument"]])
+            except PyMongoError:
+                if self._stop.wait(1.0):
+                    return
+            stream = None
+
+    def start(self, collection=None):
+        """follows the change stream, or the ingest path when the server has no change streams
+
+        :param collection: AIS collection
+        :type collection: pymongo.collection.Collection
+        :return: 'change_stream' or 'ingest'
+        :rtype: str
+        """
+
+        try:
+            self.follow_change_stream(collection)
+            return "change_stream"
+        except OperationFailure:
+            self.follow_ingest()
+            return "ingest"
+
+    def stop(self):
+        """stops following updates and closes every subscription"""
+
+        self._stop.set()
+        if self._following_ingest:
+            main.remove_ingest_listener(self.publish)
+            self._following_ingest = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            subscriptions = set(self._everywhere)
+            for index in (self._cells, self._by_mmsi):
+                for group in index.values():
+                    subscriptions.update(group)
+            self._cells.clear()
+            self._by_mmsi.clear()
+            self._everywhere.clear()
+        for subscription in subscriptions:
+            subscription.close()
@@ -7,14 +7,1622 @@
 
 import pymongo
 import json
-from datetime import datetime, timedelta
+import logging
+import math
+import queue
+import re
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+from cache import LRUCache
+from dedup import DEDUP_KEYS, DUPLICATE_KEY_ERROR, ReportWindow
+import metrics
+import tiles
+from metrics import plan_stages
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
 
-myClient = pymongo.MongoClient("mongodb://localhost:27017")
-myDataBase = myClient["AISTestData"]
-myCollection = myDataBase["aisdk_20201118"]
-myPorts = myDataBase["ports"]
-myMapViews = myDataBase["mapviews"]
-vessels = myDataBase["vessels"]
+tileCache = LRUCache(maxsize=20000)
+portTileCache = LRUCache(maxsize=20000)
+childTileCache = LRUCache(maxsize=20000)
+vesselCache = LRUCache(maxsize=100000)
+ingestLog = logging.getLogger("tmb.ingest")
+uniqueMMSILock = threading.Lock()
+
+DEFAULT_SETTINGS = {
+    "uri": "mongodb://localhost:27017",
+    "database": "AISTestData",
+    "collection": "aisdk_20201118",
+    "ports": "ports",
+    "mapviews": "mapviews",
+    "vessels": "vessels",
+    "latest": "latest_positions",
+    "min_pool_size": 0,
+    "max_pool_size": 100,
+    "connect_timeout_ms": 20000,
+    "server_selection_timeout_ms": 30000,
+    "read_preference": "primary",
+    "ingest_w": 1,
+    "ingest_j": None,
+    "deduplicate": False,
+    "dedup_window": 100000,
+    "reference_ttl": None,
+}
+READ_PREFERENCES = {
+    "primary": pymongo.ReadPreference.PRIMARY,
+    "primaryPreferred": pymongo.ReadPreference.PRIMARY_PREFERRED,
+    "secondary": pymongo.ReadPreference.SECONDARY,
+    "secondaryPreferred": pymongo.ReadPreference.SECONDARY_PREFERRED,
+    "nearest": pymongo.ReadPreference.NEAREST,
+}
+backendSettings = dict(DEFAULT_SETTINGS)
+# the settings the client built by configure depends on
+CLIENT_SETTINGS = ("uri", "min_pool_size", "max_pool_size", "connect_timeout_ms", "server_selection_timeout_ms")
+myClient = None
+# CLIENT_SETTINGS values of myClient when configure built it, None for a client that was given
+ownClientSettings = None
+
+
+def configure(client=None, **settings):
+    """binds the backend to a mongo deployment, the client only connects on its first operation
+
+    the queries read with the configured read preference, the AIS messages are
+    inserted through ingestCollection with the ingest write concern (w=0 for
+    unacknowledged ingest). With deduplicate, copies of recently stored reports
+    are dropped through a window of dedup_window keys and ensure_indexes adds a
+    unique (MMSI, Timestamp, MsgType) index. The cached ports, mapviews and
+    vessels expire after reference_ttl seconds, None keeps them until they are
+    evicted or invalidated. Settings that are not given keep
+    their current value. The client configure built is reused while the
+    CLIENT_SETTINGS do not change and closed once it is replaced, a given client
+    is left to its owner.
+    :param client: an existing client to be used instead of one built from the uri and pool settings
+    :type client: pymongo.MongoClient
+    :param settings: keys of DEFAULT_SETTINGS
+    :type settings: dict
+    :return: the settings in effect
+    :rtype: dict
+    """
+
+    global myClient, myDataBase, myCollection, myPorts, myMapViews, vessels, latestPositions, ingestCollection
+    global tileStore, reportWindow, portCodes, uniqueMMSIReady, ownClientSettings
+    unknown = set(settings) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise TypeError("unknown backend settings: " + ", ".join(sorted(unknown)))
+    if settings.get("read_preference", backendSettings["read_preference"]) not in READ_PREFERENCES:
+        raise ValueError("read_preference must be one of " + ", ".join(READ_PREFERENCES))
+    backendSettings.update(settings)
+
+    previous = myClient if ownClientSettings is not None else None
+    client_settings = tuple(backendSettings[key] for key in CLIENT_SETTINGS)
+    if client is None and client_settings == ownClientSettings:
+        client = myClient
+    elif client is None:
+        client = pymongo.MongoClient(backendSettings["uri"], connect=False,
+                                     minPoolSize=backendSettings["min_pool_size"],
+                                     maxPoolSize=backendSettings["max_pool_size"],
+                                     connectTimeoutMS=backendSettings["connect_timeout_ms"],
+                                     serverSelectionTimeoutMS=backendSettings["server_selection_timeout_ms"],
+                                     event_listeners=[metrics.commandListener])
+    else:
+        client_settings = None
+    if previous is not None and previous is not client:
+        previous.close()
+    myClient = client
+    ownClientSettings = client_settings
+    myDataBase = client.get_database(backendSettings["database"],
+                                     read_preference=READ_PREFERENCES[backendSettings["read_preference"]])
+    myCollection = myDataBase[backendSettings["collection"]]
+    myPorts = myDataBase[backendSettings["ports"]]
+    myMapViews = myDataBase[backendSettings["mapviews"]]
+    vessels = myDataBase[backendSettings["vessels"]]
+    latestPositions = myDataBase[backendSettings["latest"]]
+    ingestCollection = myDataBase.get_collection(
+        backendSettings["collection"],
+        write_concern=WriteConcern(w=backendSettings["ingest_w"], j=backendSettings["ingest_j"]))
+    tileStore = tiles.GridFSTileStore(myDataBase)
+    portCodes = None
+    reportWindow = ReportWindow(backendSettings["dedup_window"]) if backendSettings["deduplicate"] else None
+    uniqueMMSIReady = set()
+    for reference_cache in (tileCache, portTileCache, childTileCache, vesselCache):
+        reference_cache.ttl = backendSettings["reference_ttl"]
+        reference_cache.invalidate()
+    return dict(backendSettings)
+
+
+configure()
+
+DEFAULT_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 1 << 16
+
+
+# a decoding error this close to the end of the buffer may come from a record cut by the chunk
+TRUNCATION_SLACK = 8
+ARRAY_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{},]')
+
+
+class MalformedRecord:
+    """stands for a record of an AIS file that is not valid json, iter_ais_file yields it instead of raising
+
+    the store functions count it as a failed message.
+    :param error: the decoding error
+    :type error: ValueError
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+    def __repr__(self):
+        return "MalformedRecord(" + repr(self.error) + ")"
+
+
+def iter_ais_file(ais_data, chunk_size=READ_CHUNK_SIZE):
+    """lazily yields the AIS documents stored in a file, one at a time
+
+    the file may either be a json array of documents or newline delimited json
+    (one document per line). The file is read in chunks so only the document
+    currently being decoded is held in memory. A record that is not valid json
+    is skipped and yielded as a MalformedRecord.
+    :param ais_data: path of the file that stores the AIS data
+    :type ais_data: str
+    :param chunk_size: number of characters read from the file at a time
+    :type chunk_size: int
+    :return: generator of AIS documents
+    :rtype: generator
+    """
+
+    decoder = json.JSONDecoder()
+    with open(ais_data) as file:
+        buffer = file.read(chunk_size)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                break
+            buffer = file.read(chunk_size)
+            position = 0
+            if not buffer:
+                return
+
+        if buffer[position] != "[":
+            # newline delimited json
+            buffer = buffer[position:]
+            while True:
+                lines = buffer.split("\n")
+                buffer = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        yield decode_record(line)
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                buffer += chunk
+            if buffer.strip():
+                yield decode_record(buffer)
+            return
+
+        position += 1
+        end_of_file = False
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ","):
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            if position == len(buffer) and end_of_file:
+                return
+            try:
+                document, end = decoder.raw_decode(buffer, position)
+                # a value ending exactly at the end of the buffer may be truncated
+                complete = end < len(buffer) or end_of_file
+            except ValueError as error:
+                if end_of_file or not may_be_truncated(error, buffer):
+                    end = element_end(buffer, position)
+                    if end is not None or end_of_file:
+                        yield MalformedRecord(error)
+                        position = len(buffer) if end is None else end
+                        continue
+                complete = False
+            if not complete:
+                chunk = file.read(chunk_size)
+                buffer = buffer[position:] + chunk
+                position = 0
+                end_of_file = not chunk
+                continue
+            yield document
+            position = end
+            if position > chunk_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+def decode_record(line):
+    """decodes one line of newline delimited json
+
+    :param line: the line
+    :type line: str or bytes
+    :return: the document, or a MalformedRecord if the line is not valid json
+    :rtype: dict
+    """
+
+    try:
+        return json.loads(line)
+    except ValueError as error:
+        return MalformedRecord(error)
+
+
+def may_be_truncated(error, buffer):
+    """tells if a decoding error of a json array element can come from the buffer ending inside it
+
+    :param error: error raised by JSONDecoder.raw_decode
+    :type error: json.JSONDecodeError
+    :param buffer: the decoded text
+    :type buffer: str
+    :rtype: bool
+    """
+
+    if not isinstance(error, json.JSONDecodeError):
+        return False
+    return len(buffer) - error.pos <= TRUNCATION_SLACK or error.msg.startswith("Unterminated string")
+
+
+def element_end(buffer, position):
+    """finds where the json array element starting at position ends, without decoding it
+
+    strings are skipped and brackets matched, so a malformed element is passed over
+    up to the comma or bracket closing it. A bracket closing an outer bracket also
+    closes the ones left open inside it.
+    :param buffer: text of the array
+    :type buffer: str
+    :param position: index of the first character of the element
+    :type position: int
+    :return: index of the comma or closing bracket after the element, None if the buffer ends first
+    :rtype: int
+    """
+
+    opened = []
+    for match in ARRAY_TOKENS.finditer(buffer, position):
+        token = match.group()
+        if token in ("{", "["):
+            opened.append(token)
+        elif token in ("}", "]"):
+            if not opened:
+                return match.start()
+            opener = "{" if token == "}" else "["
+            if opener in opened:
+                del opened[len(opened) - 1 - opened[::-1].index(opener):]
+        elif token == "," and not opened:
+            return match.start()
+    return None
+
+
+def iter_batches(documents, batch_size=DEFAULT_BATCH_SIZE):
+    """groups an iterable of documents into lists of at most batch_size documents
+
+    :param documents: iterable of documents
+    :type documents: iterable
+    :param batch_size: maximum number of documents in a batch
+    :type batch_size: int
+    :return: generator of document lists
+    :rtype: generator
+    """
+
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def timestamp_date(timestamp):
+    """parses an AIS Timestamp (UTC ISO ending in Z) into a timezone aware datetime
+
+    :param timestamp: UTC ISO timestamp
+    :type timestamp: str
+    :return: the timestamp as a date
+    :rtype: datetime
+    """
+
+    date = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def iso_timestamp(value):
+    """formats a time the way AIS Timestamps are stored
+
+    ISO strings are parsed and formatted again, so '2020-11-19T09:00:00Z' compares
+    with the stored '2020-11-19T09:00:00.000Z' as the same time.
+    :param value: a datetime or an ISO timestamp, naive ones are UTC
+    :type value: datetime or str
+    :return: UTC ISO timestamp with milliseconds ending in Z
+    :rtype: str
+    """
+
+    if isinstance(value, str):
+        value = timestamp_date(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="milliseconds") + "Z"
+
+
+def add_dates(documents):
+    """stores the Timestamp of every AIS document as a real date in its Date field
+
+    Timestamp keeps its string form, ISO strings still sort chronologically and
+    existing callers compare them. Documents with a malformed Timestamp are left alone.
+    :param documents: AIS documents about to be inserted
+    :type documents: list
+    :return: the same documents
+    :rtype: list
+    """
+
+    for document in documents:
+        if isinstance(document, dict) and isinstance(document.get("Timestamp"), str) and "Date" not in document:
+            try:
+                document["Date"] = timestamp_date(document["Timestamp"])
+            except ValueError:
+                pass
+    return documents
+
+
+def insert_documents(collection, documents):
+    """inserts a list of documents unordered and reports how many were written
+
+    a failing document does not stop the remaining documents of the list from
+    being inserted. When deduplication is on, copies of recently stored reports
+    are not sent and copies rejected by the unique index are not failures, both
+    are counted by reportWindow.
+    :param collection: collection the documents are inserted into
+    :type collection: pymongo.collection.Collection
+    :param documents: documents to be inserted
+    :type documents: list
+    :return: number of inserted documents and number of failed documents
+    :rtype: tuple
+    """
+
+    stored, failed = insert_stored_documents(collection, documents)
+    return len(stored), failed
+
+
+def insert_stored_documents(collection, documents):
+    """inserts a list of documents like insert_documents and tells which of them were stored
+
+    :param collection: collection the documents are inserted into
+    :type collection: pymongo.collection.Collection
+    :param documents: documents to be inserted
+    :type documents: list
+    :return: the inserted documents, without failures and copies, and number of failed documents
+    :rtype: tuple
+    """
+
+    window = reportWindow
+    if window is not None:
+        documents = window.filter(documents)
+        if not documents:
+            return [], 0
+    try:
+        collection.insert_many(add_dates(documents), ordered=False)
+        return documents, 0
+    except BulkWriteError as error:
+        return stored_despite(error, documents, window)
+    except Exception:
+        if window is not None:
+            window.forget(documents)
+        raise
+
+
+def stored_despite(error, documents, window):
+    """sorts the documents of an unordered insert_many that raised into stored and failed ones
+
+    with a window, copies rejected by the unique index are counted as rejected
+    and are no failures, the failed documents are forgotten so they can be sent again.
+    :param error: the error raised by insert_many
+    :type error: pymongo.errors.BulkWriteError
+    :param documents: the documents passed to insert_many
+    :type documents: list
+    :param window: the deduplication window, None when deduplication is off
+    :type window: dedup.ReportWindow
+    :return: the inserted documents and number of failed documents
+    :rtype: tuple
+    """
+
+    write_errors = error.details.get("writeErrors", [])
+    rejected = {write_error["index"] for write_error in write_errors}
+    stored = [document for index, document in enumerate(documents) if index not in rejected]
+    if window is None:
+        return stored, len(write_errors)
+    failed = [documents[write_error["index"]] for write_error in write_errors
+              if write_error.get("code") != DUPLICATE_KEY_ERROR]
+    window.count_rejected(len(write_errors) - len(failed))
+    window.forget(failed)
+    return stored, len(failed)
+
+
+def dedup_stats():
+    """reports the reports checked for copies and the copies dropped by the window and the unique index
+
+    :return: statistics of the deduplication window, None when deduplication is off
+    :rtype: dict
+    """
+
+    return reportWindow.stats() if reportWindow is not None else None
+
+
+portCodes = None
+LOCODE_PATTERN = re.compile(r"^[A-Z]{2}[A-Z2-9]{3}$")
+
+
+def port_codes():
+    """gets the UN/LOCODE lookup tables of the ports, loaded once
+
+    :return: the known codes, and the code of every port id, (port_location, country) and normalized port name
+    :rtype: dict
+    """
+
+    global portCodes
+    if portCodes is None:
+        codes = {"codes": set(), "ids": {}, "locations": {}, "names": {}}
+        for port in myPorts.find({"un/locode": {"$exists": True}},
+                                 {"_id": 0, "id": 1, "port_location": 1, "country": 1, "un/locode": 1}):
+            code = re.sub(r"[^A-Z0-9]", "", str(port["un/locode"]).upper())
+            codes["codes"].add(code)
+            codes["ids"][port.get("id")] = code
+            codes["locations"][(port.get("port_location"), port.get("country"))] = code
+            codes["names"].setdefault(re.sub(r"[^A-Z0-9]", "", str(port.get("port_location")).upper()), code)
+        portCodes = codes
+    return portCodes
+
+
+def destination_code(destination):
+    """normalizes the free text Destination of static data into a UN/LOCODE
+
+    'DK AAR', 'dk-aar' and 'DKAAR' all give DKAAR, a route like 'SEGOT>DKAAR' gives
+    its last port, and a port name such as 'Aarhus' is looked up in the ports.
+    Other text shaped like a UN/LOCODE is kept as is.
+    :param destination: Destination as sent by the vessel
+    :type destination: str
+    :return: UN/LOCODE or None if the destination is not recognized
+    :rtype: str
+    """
+
+    if not isinstance(destination, str):
+        return None
+    destination = re.split(r">|=>|->", destination.upper())[-1]
+    compact = re.sub(r"[^A-Z0-9]", "", destination)
+    if not compact:
+        return None
+    codes = port_codes()
+    if compact in codes["codes"]:
+        return compact
+    if compact in codes["names"]:
+        return codes["names"][compact]
+    return compact if LOCODE_PATTERN.match(compact) else None
+
+
+STATIC_FIELDS = ["Class", "IMO", "CallSign", "Name", "VesselType", "CargoTye", "Length", "Breadth", "Draught",
+                 "Destination", "ETA", "A", "B", "C", "D"]
+# static fields a position report can do without, its Class is kept
+SLIMMED_FIELDS = frozenset(STATIC_FIELDS) - {"Class"}
+VESSEL_STATIC_PROJECTION = dict({field: 1 for field in STATIC_FIELDS}, _id=0, MMSI=1, Timestamp=1)
+
+
+def slim_position(document):
+    """copies a position report without the static fields it carries, other documents are returned as is"""
+
+    if isinstance(document, Mapping) and not SLIMMED_FIELDS.isdisjoint(document):
+        return {field: value for field, value in document.items() if field not in SLIMMED_FIELDS}
+    return document
+
+
+def split_messages(documents):
+    """sorts AIS messages into position reports for the AIS collection and static data for the vessels
+
+    position reports that carry static fields are slimmed down to a copy without them.
+    Anything that is not a static_data message counts as a position report.
+    :param documents: AIS documents
+    :type documents: list
+    :return: position reports and static_data messages
+    :rtype: tuple
+    """
+
+    positions = []
+    statics = []
+    for document in documents:
+        if isinstance(document, Mapping) and document.get("MsgType") == "static_data":
+            statics.append(document)
+        else:
+            positions.append(slim_position(document))
+    return positions, statics
+
+
+def vessel_updates(statics, known):
+    """builds the upserts bringing the vessels up to date with static data messages
+
+    only the newest message of every vessel is used, and a vessel whose stored
+    fields already match it, or that was updated by a newer message, is skipped.
+    A changed Destination also sets DestinationCode, its UN/LOCODE. Like the latest
+    positions, an upsert only matches an older vessel document, so a newer message
+    written since known was read makes it fail on the unique MMSI index, see stale_vessels.
+    :param statics: static_data messages
+    :type statics: list
+    :param known: stored static fields and Timestamp per MMSI, empty for new vessels
+    :type known: dict
+    :return: one UpdateOne per changed vessel and the static fields now stored per MMSI, in the same order
+    :rtype: tuple
+    """
+
+    newest = {}
+    for message in statics:
+        mmsi = message.get("MMSI")
+        if isinstance(mmsi, int) and (mmsi not in newest
+                                      or str(message.get("Timestamp")) > str(newest[mmsi].get("Timestamp"))):
+            newest[mmsi] = message
+    operations = []
+    changed = {}
+    for mmsi, message in newest.items():
+        current = known.get(mmsi) or {}
+        if current.get("Timestamp") and str(current["Timestamp"]) > str(message.get("Timestamp")):
+            continue
+        changes = {field: message[field] for field in STATIC_FIELDS
+                   if field in message and current.get(field) != message[field]}
+        if not changes:
+            continue
+        if "Destination" in changes:
+            changes["DestinationCode"] = destination_code(changes["Destination"])
+        changes["Timestamp"] = message.get("Timestamp")
+        operations.append(UpdateOne({"MMSI": mmsi, "$or": [{"Timestamp": {"$lt": changes["Timestamp"]}},
+                                                           {"Timestamp": {"$exists": False}}]},
+                                    {"$set": changes}, upsert=True))
+        changed[mmsi] = dict(current, **changes)
+    return operations, changed
+
+
+def update_vessels(statics, collection=None):
+    """upserts static data messages into the vessels collection, writing only the vessels that changed
+
+    the stored fields are looked up once per batch and kept in vesselCache, so a
+    vessel repeating the same static data costs neither a read nor a write.
+    :param statics: static_data messages
+    :type statics: list
+    :param collection: collection holding one document per MMSI
+    :type collection: pymongo.collection.Collection
+    :return: number of vessels written
+    :rtype: int
+    """
+
+    if collection is None:
+        collection = vessels
+    ensure_unique_mmsi(collection)
+    cached = collection is vessels
+    known, missing = cached_vessels(statics, cached)
+    if missing:
+        for vessel in collection.find({"MMSI": {"$in": missing}}, VESSEL_STATIC_PROJECTION):
+            known.setdefault(vessel.pop("MMSI"), vessel)
+    operations, changed = vessel_updates(statics, known)
+    stale = []
+    if operations:
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as error:
+            stale = stale_vessels(error, changed)
+    if cached:
+        cache_vessels(known, missing, changed, stale)
+    return len(operations) - len(stale)
+
+
+def stale_vessels(error, changed):
+    """accepts a bulk error of vessel upserts if it only holds stale static data
+
+    a duplicate key means the stored vessel was updated by a message at least as
+    recent, any other write error is raised again.
+    :param error: error raised by bulk_write
+    :type error: pymongo.errors.BulkWriteError
+    :param changed: static fields per MMSI, returned by vessel_updates with the operations
+    :type changed: dict
+    :return: MMSIs of the vessels that were not written
+    :rtype: list
+    """
+
+    stale_upserts_only(error)
+    mmsis = list(changed)
+    return [mmsis[write_error["index"]] for write_error in error.details.get("writeErrors", [])]
+
+
+def cached_vessels(statics, cached=True):
+    """looks up the stored static fields of the vessels of static data messages in vesselCache
+
+    :param statics: static_data messages
+    :type statics: list
+    :param cached: False to skip the cache, for a collection other than the vessels
+    :type cached: bool
+    :return: the cached fields per MMSI and the MMSIs that must be read from the vessels
+    :rtype: tuple
+    """
+
+    mmsis = {message.get("MMSI") for message in statics if isinstance(message.get("MMSI"), int)}
+    known = {}
+    if cached:
+        for mmsi in mmsis:
+            fields = vesselCache.get(mmsi)
+            if fields is not None:
+                known[mmsi] = fields
+    return known, [mmsi for mmsi in mmsis if mmsi not in known]
+
+
+def cache_vessels(known, missing, changed, stale=()):
+    """remembers in vesselCache the vessels read from the collection and the ones just written
+
+    :param known: stored static fields per MMSI
+    :type known: dict
+    :param missing: MMSIs that were read from the collection
+    :type missing: list
+    :param changed: static fields written per MMSI, returned by vessel_updates
+    :type changed: dict
+    :param stale: MMSIs whose write lost against newer static data, they are read again next time
+    :type stale: list
+    """
+
+    for mmsi in missing:
+        vesselCache.put(mmsi, known.get(mmsi, {}))
+    for mmsi, fields in changed.items():
+        vesselCache.put(mmsi, fields)
+    for mmsi in stale:
+        vesselCache.invalidate(mmsi)
+
+
+def store_statics(statics):
+    """upserts static data messages into the vessels, a failure only fails the static data
+
+    a message is stored once its vessel is up to date, whether or not it had to be written.
+    :param statics: static_data messages
+    :type statics: list
+    :return: number of stored messages and number of failed messages
+    :rtype: tuple
+    """
+
+    if not statics:
+        return 0, 0
+    try:
+        update_vessels(statics)
+        return len(statics), 0
+    except Exception:
+        ingestLog.exception("static data of %d messages not stored", len(statics))
+        return 0, len(statics)
+
+
+def store_messages(collection, documents):
+    """stores AIS messages by type, position reports into the collection and static data into the vessels
+
+    anything that is not a document, such as a MalformedRecord, counts as failed.
+
+    :param collection: collection the position reports are inserted into
+    :type collection: pymongo.collection.Collection
+    :param documents: AIS documents
+    :type documents: list
+    :return: number of stored messages (static data included), number of failed messages
+        and the stored position reports, for update_latest_positions
+    :rtype: tuple
+    """
+
+    messages = [document for document in documents if isinstance(document, Mapping)]
+    positions, statics = split_messages(messages)
+    stored, failed = insert_stored_documents(collection, positions) if positions else ([], 0)
+    written, failed_statics = store_statics(statics)
+    return len(stored) + written, failed + failed_statics + len(documents) - len(messages), stored
+
+
+INDEXES = {
+    "ais": [
+        ([("MMSI", pymongo.ASCENDING), ("Timestamp", pymongo.DESCENDING)], {}),
+        ([("Timestamp", pymongo.ASCENDING)], {}),
+        ([("Date", pymongo.ASCENDING)], {}),
+    ],
+    "latest": [
+        ([("MMSI", pymongo.ASCENDING)], {"unique": True}),
+        ([("Timestamp", pymongo.DESCENDING)], {}),
+        ([("Location", pymongo.GEOSPHERE)], {}),
+    ],
+    "ports": [
+        ([("port_location", pymongo.ASCENDING), ("country", pymongo.ASCENDING)], {}),
+        ([("id", pymongo.ASCENDING)], {}),
+    ],
+    "mapviews": [
+        ([("id", pymongo.ASCENDING)], {}),
+        ([("contained_by", pymongo.ASCENDING)], {}),
+    ],
+    "vessels": [
+        ([("MMSI", pymongo.ASCENDING)], {"unique": True}),
+        ([("DestinationCode", pymongo.ASCENDING), ("ETA", pymongo.ASCENDING)], {}),
+    ],
+}
+
+
+# indexes of older versions that no query uses any more, ensure_indexes drops them
+OBSOLETE_INDEXES = {
+    # the latitude first coordinates of Position made the index reject reports with
+    # a longitude beyond 90 degrees, the tile queries use Location of the latest positions
+    "ais": [[("Position", pymongo.GEOSPHERE)]],
+    "latest": [[("Position", pymongo.GEOSPHERE)]],
+}
+
+
+def ensure_indexes():
+    """creates the indexes every TMB query relies on
+
+    an index on the same keys that already exists is kept as is, even with other
+    options, e.g. the Date index turned into a TTL index by the retention module,
+    unless it must be unique and is not, then it is built again.
+    With deduplication on, stored copies must be removed first with
+    dedup.remove_duplicate_reports or the unique index cannot be built. The
+    OBSOLETE_INDEXES are dropped.
+    :return: names of the indexes per collection
+    :rtype: dict
+    """
+
+    collections = {"ais": myCollection, "latest": latestPositions, "ports": myPorts, "mapviews": myMapViews,
+                   "vessels": vessels}
+    indexes = dict(INDEXES)
+    if backendSettings["deduplicate"]:
+        indexes["ais"] = INDEXES["ais"] + [(DEDUP_KEYS, {"unique": True})]
+    created = {}
+    for key, collection in collections.items():
+        information = collection.index_information()
+        existing = {tuple(tuple(field) for field in index["key"]): name for name, index in information.items()}
+        for keys in OBSOLETE_INDEXES.get(key, []):
+            if tuple(keys) in existing:
+                collection.drop_index(existing.pop(tuple(keys)))
+        for keys, options in indexes[key]:
+            name = existing.get(tuple(keys))
+            if name is not None and options.get("unique") and not information[name].get("unique"):
+                collection.drop_index(existing.pop(tuple(keys)))
+        created[key] = [existing.get(tuple(keys)) or collection.create_index(keys, **options)
+                        for keys, options in indexes[key]]
+    return created
+
+
+def ensure_unique_mmsi(collection):
+    """creates the unique MMSI index of a collection holding one document per vessel, once per configure
+
+    the guarded upserts of the latest positions and the vessels rely on it to
+    reject stale reports. A non unique MMSI index is built again.
+    :param collection: latest positions or vessels collection
+    :type collection: pymongo.collection.Collection
+    """
+
+    if collection.full_name in uniqueMMSIReady:
+        return
+    with uniqueMMSILock:
+        if collection.full_name in uniqueMMSIReady:
+            return
+        for name, index in collection.index_information().items():
+            if [tuple(field) for field in index["key"]] == [("MMSI", pymongo.ASCENDING)] \
+                    and not index.get("unique"):
+                collection.drop_index(name)
+        collection.create_index([("MMSI", pymongo.ASCENDING)], unique=True)
+        uniqueMMSIReady.add(collection.full_name)
+
+
+ingestListeners = []
+
+
+def add_ingest_listener(listener):
+    """registers a function called with every list of freshly stored AIS documents
+
+    :param listener: function taking a list of documents
+    :type listener: function
+    """
+
+    ingestListeners.append(listener)
+
+
+def remove_ingest_listener(listener):
+    """unregisters a function added with add_ingest_listener
+
+    :param listener: the registered function
+    :type listener: function
+    """
+
+    if listener in ingestListeners:
+        ingestListeners.remove(listener)
+
+
+def notify_ingest(documents):
+    """hands freshly stored AIS documents to every ingest listener
+
+    :param documents: AIS documents that were just stored
+    :type documents: list
+    """
+
+    for listener in list(ingestListeners):
+        try:
+            listener(documents)
+        except Exception:
+            ingestLog.exception("ingest listener %r failed", listener)
+
+
+def update_latest_positions(documents, latest=None):
+    """upserts the newest position report of every vessel into the latest positions collection
+
+    a vessel's document is only replaced when the incoming Timestamp is newer than
+    the stored one. Messages without a Position in range are ignored. The ingest listeners
+    are notified afterwards, a failing listener does not stop the update.
+    :param documents: AIS documents that were just stored
+    :type documents: list
+    :param latest: collection holding one position document per MMSI
+    :type latest: pymongo.collection.Collection
+    :return: number of vessels whose latest position changed
+    :rtype: int
+    """
+
+    if latest is None:
+        latest = latestPositions
+    try:
+        ensure_unique_mmsi(latest)
+        operations = latest_position_updates(documents)
+        if not operations:
+            return 0
+        try:
+            result = latest.bulk_write(operations, ordered=False)
+            return result.upserted_count + result.modified_count
+        except BulkWriteError as error:
+            return stale_upserts_only(error)
+    finally:
+        notify_ingest(documents)
+
+
+def position_location(document):
+    """converts the latitude first Position of a report into a GeoJSON point the 2dsphere index accepts
+
+    :param document: AIS document
+    :type document: dict
+    :return: longitude first GeoJSON point, None when the report has no position in range,
+        e.g. the 91/181 AIS sends when the position is not available
+    :rtype: dict
+    """
+
+    try:
+        lat, lon = document["Position"]["coordinates"][:2]
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not all(isinstance(value, (int, float)) for value in (lat, lon)) or not (-90 <= lat <= 90) \
+            or not (-180 <= lon <= 180):
+        return None
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+
+def newest_positions(documents):
+    """picks the newest position report of every vessel
+
+    reports whose position is not available or out of range are left out, they
+    do not move the latest position of their vessel.
+    :param documents: AIS documents
+    :type documents: list
+    :return: one position report per MMSI
+    :rtype: list
+    """
+
+    newest = {}
+    for document in documents:
+        if not isinstance(document, Mapping) or "MMSI" not in document or "Timestamp" not in document \
+                or position_location(document) is None:
+            continue
+        current = newest.get(document["MMSI"])
+        if current is None or document["Timestamp"] > current["Timestamp"]:
+            newest[document["MMSI"]] = document
+    return list(newest.values())
+
+
+def latest_position_updates(documents):
+    """builds the upserts moving each vessel's latest position forward
+
+    :param documents: AIS documents that were just stored
+    :type documents: list
+    :return: one UpdateOne per vessel carrying a position report, with its Location for the 2dsphere index
+    :rtype: list
+    """
+
+    operations = []
+    for document in newest_positions(documents):
+        mmsi = document["MMSI"]
+        position = {key: value for key, value in document.items() if key != "_id"}
+        position["Location"] = position_location(document)
+        operations.append(UpdateOne({"MMSI": mmsi, "Timestamp": {"$lt": document["Timestamp"]}},
+                                    {"$set": position}, upsert=True))
+    return operations
+
+
+def stale_upserts_only(error):
+    """accepts a bulk error of latest position upserts if it only holds stale reports
+
+    a duplicate key means the stored position is at least as recent, any other
+    write error is raised again.
+    :param error: error raised by bulk_write
+    :type error: pymongo.errors.BulkWriteError
+    :return: number of vessels whose latest position changed
+    :rtype: int
+    """
+
+    if any(write_error["code"] != 11000 for write_error in error.details.get("writeErrors", [])):
+        raise error
+    return error.details.get("nUpserted", 0) + error.details.get("nModified", 0)
+
+
+def rebuild_latest_positions():
+    """recomputes the latest positions collection from the whole AIS collection
+
+    :return: number of vessels in the latest positions collection
+    :rtype: int
+    """
+
+    ensure_unique_mmsi(latestPositions)
+    myCollection.aggregate([
+        {"$match": {"Position.coordinates.0": {"$gte": -90, "$lte": 90},
+                    "Position.coordinates.1": {"$gte": -180, "$lte": 180}}},
+        {"$sort": {"MMSI": pymongo.ASCENDING, "Timestamp": pymongo.DESCENDING}},
+        {"$group": {"_id": "$MMSI", "document": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$document"}},
+        {"$unset": "_id"},
+        {"$set": {"Location": {"type": "Point", "coordinates": [{"$arrayElemAt": ["$Position.coordinates", 1]},
+                                                                {"$arrayElemAt": ["$Position.coordinates", 0]}]}}},
+        {"$merge": {"into": latestPositions.name, "on": "MMSI", "whenMatched": "replace",
+                    "whenNotMatched": "insert"}},
+    ])
+    return latestPositions.count_documents({})
+
+
+TILE_BOUNDS = {"_id": 0, "west": 1, "south": 1, "east": 1, "north": 1}
+POSITION_PROJECTION = {"_id": 0, "MMSI": 1, "Position.coordinates": 1}
+PORT_LISTING_PROJECTION = {"_id": 0, "un/locode": 0, "website": 0}
+VESSEL_PROJECTION = {"_id": 0, "MMSI": 1, "Name": 1, "IMO": 1}
+CHILD_TILE_PROJECTION = {"_id": 0, "id": 1, "west": 1, "south": 1, "east": 1, "north": 1, "filename": 1}
+
+
+# degrees the polygon reaches past the tile, so no position on an edge is lost to rounding
+TILE_EDGE_MARGIN = 1e-6
+
+
+def padded_latitude(latitude, west, east):
+    """moves a parallel edge of a tile towards the equator until its great circle no longer cuts into the tile
+
+    a GeoJSON edge between two corners at the same latitude is the great circle
+    through them, which bows towards the pole. Starting from the returned
+    latitude instead, the bow peaks at latitude, midway between west and east.
+    :param latitude: latitude of the edge
+    :type latitude: float
+    :param west: western longitude of the edge
+    :type west: float
+    :param east: eastern longitude of the edge
+    :type east: float
+    :rtype: float
+    """
+
+    half_width = math.radians(east - west) / 2
+    return math.degrees(math.atan(math.tan(math.radians(latitude)) * math.cos(half_width)))
+
+
+def tile_polygon(tile):
+    """converts the bounds of a mapview tile into a GeoJSON polygon, longitude first like Location
+
+    the polygon covers the whole tile: its edge nearer to the equator is padded
+    by padded_latitude and every edge is pushed out by TILE_EDGE_MARGIN. It is
+    therefore slightly larger than the tile, see tile_filter.
+    :param tile: mapview document with west, south, east and north
+    :type tile: dict
+    :return: GeoJSON polygon
+    :rtype: dict
+    """
+
+    west, south, east, north = tile["west"], tile["south"], tile["east"], tile["north"]
+    if south > 0:
+        south = padded_latitude(south, west, east)
+    if north < 0:
+        north = padded_latitude(north, west, east)
+    west, east = west - TILE_EDGE_MARGIN, east + TILE_EDGE_MARGIN
+    south, north = max(south - TILE_EDGE_MARGIN, -90), min(north + TILE_EDGE_MARGIN, 90)
+    return {"type": "Polygon", "coordinates": [[
+        [west, south], [west, north], [east, north], [east, south], [west, south]]]}
+
+
+def tile_filter(tile):
+    """builds the $geoWithin filter matching the positions inside a mapview tile
+
+    the 2dsphere index on Location finds the positions inside tile_polygon, the
+    longitude and latitude bounds then keep those inside the tile itself, edges
+    included like partition_by_tile.
+    :param tile: mapview document with west, south, east and north
+    :type tile: dict
+    :return: filter for the latest positions, whose 2dsphere index is on Location
+    :rtype: dict
+    """
+
+    return {"Location": {"$geoWithin": {"$geometry": tile_polygon(tile)}},
+            "Location.coordinates.0": {"$gte": tile["west"], "$lte": tile["east"]},
+            "Location.coordinates.1": {"$gte": tile["south"], "$lte": tile["north"]}}
+
+
+def vessel_filter(mmsi, imo=None, name=None):
+    """builds the filter matching a vessel by MMSI and optional IMO and/or name
+
+    :param mmsi: MMSI of the vessel
+    :type mmsi: int
+    :param imo: IMO of the vessel
+    :type imo: int
+    :param name: name of the vessel
+    :type name: str
+    :return: filter for the vessels collection
+    :rtype: dict
+    """
+
+    if isinstance(mmsi, int):
+        if imo or name is not None:
+            if imo is None:
+                if isinstance(name, str):
+                    return {"MMSI": {"$eq": mmsi}, "Name": {"$eq": name}}
+                else:
+                    raise TypeError('name must be a string')
+
+            elif name is None:
+                if isinstance(imo, int):
+                    return {"MMSI": {"$eq": mmsi}, "IMO": {"$eq": imo}}
+                else:
+                    raise TypeError('imo must be an int')
+            else:
+                if isinstance(imo, int) and isinstance(name, str):
+                    return {"MMSI": {"$eq": mmsi}, "IMO": {"$eq": imo}, "Name": {"$eq": name}}
+                else:
+                    raise TypeError('incorrect datatype(s)')
+        else:
+            return {"MMSI": {"$eq": mmsi}}
+    else:
+        raise TypeError('MMSI must be an integer')
+
+
+def deletion_cutoff(current_time):
+    """computes the ISO timestamp 5 minutes before the given time
+
+    :param current_time: current time formatted as %Y-%m-%d %H:%M:%S.%f
+    :type current_time: str
+    :return: UTC ISO timestamp ending in Z
+    :rtype: str
+    """
+
+    date_format = "%Y-%m-%d %H:%M:%S.%f"
+    given_time = datetime.strptime(current_time, date_format)
+
+    subtracted_current_time = given_time - timedelta(minutes=5)
+    return subtracted_current_time.isoformat()[:-3] + 'Z'
+
+
+def expired_filter(cutoff):
+    """builds the filter matching the AIS messages older than a cutoff
+
+    documents stored before the Date field existed are matched on their Timestamp string.
+    :param cutoff: UTC ISO timestamp ending in Z
+    :type cutoff: str
+    :return: filter for the AIS collection
+    :rtype: dict
+    """
+
+    return {"$or": [{"Date": {"$lt": timestamp_date(cutoff)}},
+                    {"Date": {"$exists": False}, "Timestamp": {"$lt": cutoff}}]}
+
+
+def find_tile(mapview_id):
+    """gets the bounds of a mapview tile, cached after the first lookup
+
+    :param mapview_id: id of the mapview tile
+    :type mapview_id: int
+    :return: west, south, east and north of the tile or None
+    :rtype: dict
+    """
+
+    return tileCache.get_or_load(mapview_id, lambda: myMapViews.find_one({"id": mapview_id}, TILE_BOUNDS))
+
+
+def port_key(port_filter):
+    """turns a port filter into a hashable cache key"""
+
+    return tuple(sorted(port_filter.items()))
+
+
+def find_port_tile(port_filter):
+    """gets the bounds of the mapview tile of scale 3 containing a port, cached after the first lookup
+
+    :param port_filter: filter selecting the port
+    :type port_filter: dict
+    :return: west, south, east and north of the tile or None if the port has no tile
+    :rtype: dict
+    """
+
+    def load():
+        port = myPorts.find_one(port_filter, {"mapview_3": 1, "_id": 0})
+        if not port or port.get("mapview_3") is None:
+            return None
+        return find_tile(port["mapview_3"])
+
+    return portTileCache.get_or_load(port_key(port_filter), load)
+
+
+def find_child_tiles(mapview_id):
+    """gets the tiles contained in a mapview tile, cached after the first lookup
+
+    :param mapview_id: id of the parent mapview tile
+    :type mapview_id: int
+    :return: mapview documents with id, bounds and filename
+    :rtype: list
+    """
+
+    return childTileCache.get_or_load(mapview_id, lambda: list(
+        myMapViews.find({"contained_by": mapview_id}, CHILD_TILE_PROJECTION)))
+
+
+def preload_reference_data(ttl=None):
+    """loads every port and mapview into the caches so tile resolution needs no query
+
+    :param ttl: seconds the cached ports and mapviews stay valid, None keeps the configured reference_ttl
+    :type ttl: float
+    :return: number of cached mapviews and ports
+    :rtype: dict
+    """
+
+    if ttl is not None:
+        backendSettings["reference_ttl"] = ttl
+        for reference_cache in (tileCache, portTileCache, childTileCache, vesselCache):
+            reference_cache.ttl = ttl
+    mapviews = list(myMapViews.find({}, {"_id": 0}))
+    children = {}
+    for mapview in mapviews:
+        tileCache.put(mapview["id"], {key: mapview[key] for key in ("west", "south", "east", "north")})
+        if mapview.get("contained_by") is not None:
+            children.setdefault(mapview["contained_by"], []).append(
+                {key: mapview[key] for key in CHILD_TILE_PROJECTION if key in mapview})
+    for mapview in mapviews:
+        childTileCache.put(mapview["id"], children.get(mapview["id"], []))
+
+    ports = list(myPorts.find({}, {"_id": 0, "id": 1, "port_location": 1, "country": 1, "mapview_3": 1}))
+    for port in ports:
+        tile = tileCache.get(port["mapview_3"]) if port.get("mapview_3") is not None else None
+        portTileCache.put(port_key({"id": port["id"]}), tile)
+        portTileCache.put(port_key({"port_location": port["port_location"], "country": port["country"]}), tile)
+    return {"mapviews": len(mapviews), "ports": len(ports)}
+
+
+def invalidate_reference_cache():
+    """drops every cached port and mapview lookup, to be called after they change"""
+
+    global portCodes
+    for reference_cache in (tileCache, portTileCache, childTileCache):
+        reference_cache.invalidate()
+    portCodes = None
+
+
+def reference_cache_stats():
+    """reports hits, misses and size of the reference data caches
+
+    :return: statistics per cache
+    :rtype: dict
+    """
+
+    return {"tiles": tileCache.stats(), "port_tiles": portTileCache.stats(), "child_tiles": childTileCache.stats()}
+
+
+def find_results(collection, query, projection, key, batch_size=None, limit=None, after=None):
+    """runs a query whose results can be streamed, capped and paged by a key
+
+    a capped or resumed query is sorted by key, which must be unique, and only
+    returns documents whose key is greater than after. The key of the last
+    document of a page is the resume token of the next one.
+    :param collection: collection to be searched
+    :type collection: pymongo.collection.Collection
+    :param query: filter of the query
+    :type query: dict
+    :param projection: fields returned, must include key to page
+    :type projection: dict
+    :param key: unique field the results are paged by
+    :type key: str
+    :param batch_size: number of documents fetched per round trip
+    :type batch_size: int
+    :param limit: maximum number of documents returned
+    :type limit: int
+    :param after: resume token, the key of the last document already seen
+    :return: cursor over the documents
+    :rtype: pymongo.cursor.Cursor
+    """
+
+    if after is not None:
+        query = {"$and": [query, {key: {"$gt": after}}]}
+    cursor = collection.find(query, projection)
+    if after is not None or limit is not None:
+        cursor = cursor.sort(key, pymongo.ASCENDING)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    if batch_size is not None:
+        cursor = cursor.batch_size(batch_size)
+    return cursor
+
+
+def iter_results(cursor):
+    """yields the documents of a cursor one batch at a time and closes it afterwards
+
+    :param cursor: cursor returned by find_results
+    :type cursor: pymongo.cursor.Cursor
+    :return: generator of documents
+    :rtype: generator
+    """
+
+    try:
+        for document in cursor:
+            yield document
+    finally:
+        cursor.close()
+
+
+def results(cursor, stream=False):
+    """returns the documents of a cursor as a generator or as a list
+
+    :param cursor: cursor returned by find_results
+    :type cursor: pymongo.cursor.Cursor
+    :param stream: True for a generator, False for a list
+    :type stream: bool
+    :return: the documents
+    :rtype: generator or array
+    """
+
+    if stream:
+        return iter_results(cursor)
+    return list(cursor)
+
+
+VESSEL_CARD_FIELDS = ["IMO", "Name", "CallSign", "VesselType", "Length", "Breadth", "Draught", "Destination", "ETA"]
+
+
+def vessel_card_pipeline(match):
+    """builds the aggregation joining latest positions with the static vessel data
+
+    :param match: filter selecting the vessels in the latest positions collection
+    :type match: dict
+    :return: aggregation pipeline for the latest positions collection
+    :rtype: list
+    """
+
+    card = {"_id": 0, "MMSI": 1, "Timestamp": 1, "Position.coordinates": 1, "Status": 1, "SoG": 1, "CoG": 1,
+            "Heading": 1}
+    for field in VESSEL_CARD_FIELDS:
+        card[field] = "$vessel." + field
+    return [
+        {"$match": match},
+        {"$lookup": {"from": vessels.name, "localField": "MMSI", "foreignField": "MMSI", "as": "vessel"}},
+        {"$set": {"vessel": {"$arrayElemAt": ["$vessel", 0]}}},
+        {"$project": card},
+    ]
+
+
+def vessels_in_tile(tile, projection=None, batch_size=None, limit=None, after=None):
+    """finds the most recent position report of every vessel inside a tile
+
+    results are paged by MMSI.
+    :param tile: mapview document with west, south, east and north
+    :type tile: dict
+    :param projection: fields returned for each vessel
+    :type projection: dict
+    :param batch_size: number of documents fetched per round trip
+    :type batch_size: int
+    :param limit: maximum number of vessels returned
+    :type limit: int
+    :param after: MMSI of the last vessel already seen
+    :type after: int
+    :return: cursor over the latest position documents
+    :rtype: pymongo.cursor.Cursor
+    """
+
+    return find_results(latestPositions, tile_filter(tile), projection or POSITION_PROJECTION, "MMSI",
+                        batch_size, limit, after)
+
+
+def viewport_tiles(tiles):
+    """resolves a viewport into its tiles and the filter covering all of them
+
+    a parent mapview id gives its child tiles, read from the cache, and the
+    parent's own bounds as the filter. A list of tile ids gives those tiles and
+    one $or of their bounds, so no position between distant tiles is fetched.
+    Each bound is the planar one of tile_filter, the positions fetched are the
+    ones partition_by_tile hands to the tiles.
+    :param tiles: id of the parent mapview tile or list of mapview tile ids
+    :type tiles: int or list
+    :return: tile documents with id and bounds, and the filter for the latest positions
+    :rtype: tuple
+    """
+
+    if isinstance(tiles, int):
+        parent = find_tile(tiles)
+        children = [dict(tile) for tile in find_child_tiles(tiles)]
+        if parent is None or not children:
+            return [], None
+        return children, tile_filter(parent)
+    tile_ids = list(tiles)
+    if not all(isinstance(tile_id, int) for tile_id in tile_ids):
+        raise TypeError("mapview_id must be an integer")
+    found = [dict(find_tile(tile_id), id=tile_id) for tile_id in tile_ids if find_tile(tile_id) is not None]
+    if not found:
+        return [], None
+    if len(found) == 1:
+        return found, tile_filter(found[0])
+    return found, {"$or": [tile_filter(tile) for tile in found]}
+
+
+def partition_by_tile(tiles, positions):
+    """hands every position to the tiles whose bounds contain it, edges included like $geoWithin
+
+    :param tiles: tile documents with west, south, east and north
+    :type tiles: list
+    :param positions: position documents, coordinates latitude first
+    :type positions: iterable
+    :return: the tile documents, each with a vessels array
+    :rtype: list
+    """
+
+    for tile in tiles:
+        tile["vessels"] = []
+    for position in positions:
+        lat, lon = position["Position"]["coordinates"][:2]
+        for tile in tiles:
+            if tile["south"] <= lat <= tile["north"] and tile["west"] <= lon <= tile["east"]:
+                tile["vessels"].append(position)
+    return tiles
+
+
+def ports_or_positions(port_filter, batch_size=None, limit=None, after=None, stream=False):
+    """returns the positions in the tile of scale 3 of a port, or every port if it has none
+
+    positions are paged by MMSI, the port listing by port id.
+    :param port_filter: filter selecting the port
+    :type port_filter: dict
+    :return: position documents or port documents
+    :rtype: generator or array
+    """
+
+    tile = find_port_tile(port_filter)
+    if tile is None:
+        return results(find_results(myPorts, {}, PORT_LISTING_PROJECTION, "id", batch_size, limit, after), stream)
+    return results(vessels_in_tile(tile, None, batch_size, limit, after), stream)
+
+
+INBOUND_FIELDS = ["MMSI", "IMO", "Name", "CallSign", "VesselType", "Destination", "DestinationCode", "ETA"]
+
+
+def find_port_code(port_filter):
+    """gets the UN/LOCODE of a port from the cached port tables
+
+    :param port_filter: {'id': ...}, {'port_location': ..., 'country': ...} or {'un/locode': ...}
+    :type port_filter: dict
+    :return: UN/LOCODE or None if the port is unknown
+    :rtype: str
+    """
+
+    codes = port_codes()
+    if "un/locode" in port_filter:
+        code = re.sub(r"[^A-Z0-9]", "", str(port_filter["un/locode"]).upper())
+        return code if code in codes["codes"] else None
+    if "id" in port_filter:
+        return codes["ids"].get(port_filter["id"])
+    return codes["locations"].get((port_filter.get("port_location"), port_filter.get("country")))
+
+
+def inbound_traffic_pipeline(code, eta_from=None, eta_to=None):
+    """builds the aggregation finding the vessels headed to a port joined with their latest position
+
+    :param code: UN/LOCODE of the port
+    :type code: str
+    :param eta_from: earliest ETA, None for no lower bound
+    :type eta_from: datetime or str
+    :param eta_to: latest ETA, None for no upper bound
+    :type eta_to: datetime or str
+    :return: aggregation pipeline for the vessels collection, sorted by ETA
+    :rtype: list
+    """
+
+    match = {"DestinationCode": code}
+    if eta_from is not None or eta_to is not None:
+        match["ETA"] = {}
+        if eta_from is not None:
+            match["ETA"]["$gte"] = iso_timestamp(eta_from)
+        if eta_to is not None:
+            match["ETA"]["$lte"] = iso_timestamp(eta_to)
+    inbound = {"_id": 0, "Timestamp": "$latest.Timestamp", "Position.coordinates": "$latest.Position.coordinates",
+               "SoG": "$latest.SoG", "CoG": "$latest.CoG"}
+    for field in INBOUND_FIELDS:
+        inbound[field] = 1
+    return [
+        {"$match": match},
+        {"$sort": {"ETA": pymongo.ASCENDING}},
+        {"$lookup": {"from": latestPositions.name, "localField": "MMSI", "foreignField": "MMSI", "as": "latest"}},
+        {"$set": {"latest": {"$arrayElemAt": ["$latest", 0]}}},
+        {"$project": inbound},
+    ]
+
+
+class BufferedAISWriter:
+    """buffers single AIS reports and writes them to mongoDB with insert_many
+
+    reports are flushed when max_batch of them are waiting or the oldest one has
+    waited max_delay seconds. write blocks while max_pending reports are
+    buffered. Every write returns a future that resolves to the same
+    'Success: 1' / 'Failure: 0' strings insert_single_ais returns, a report whose
+    future is cancelled before its batch is sent is not written.
+    :param collection: collection the reports are inserted into
+    :type collection: pymongo.collection.Collection
+    :param max_batch: maximum number of reports sent in one insert_many
+    :type max_batch: int
+    :param max_delay: maximum number of seconds a report waits before being sent
+    :type max_delay: float
+    :param max_pending: maximum number of buffered reports
+    :type max_pending: int
+    :param latest: collection holding the latest position of every vessel
+    :type latest: pymongo.collection.Collection
+    """
+
+    def __init__(self, collection=None, max_batch=500, max_delay=0.05, max_pending=10000, latest=None):
+        self.collection = collection if collection is not None else ingestCollection
+        self.latest = latest if latest is not None else latestPositions
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max(max_pending, max_batch)
+        self.written = 0
+        self.failed = 0
+        # (enqueue time, report, future) of every buffered report, oldest first
+        self._pending = []
+        self._in_flight = 0
+        self._flushing = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, ais_data):
+        """buffers an AIS report (static data or position)
+
+        :param ais_data: the AIS document to be inserted
+        :type ais_data: dict
+        :return: future resolving to 'Success: 1' or 'Failure: 0'
+        :rtype: concurrent.futures.Future
+        """
+
+        future = Future()
+        if not isinstance(ais_data, Mapping):
+            with self._condition:
+                self.failed += 1
+            future.set_result("Failure: 0")
+            return future
+        with self._condition:
+            if self._closed:
+                raise ValueError("writer is closed")
+            while len(self._pending) >= self.max_pending:
+                self._condition.wait()
+            self._pending.append((time.monotonic(), ais_data, future))
+            if len(self._pending) >= self.max_batch:
+                self._condition.notify_all()
+            elif len(self._pending) == 1:
+                # wake the flusher so it starts waiting on the new deadline
+                self._condition.notify_all()
+        return future
+
+    def flush(self):
+        """sends every buffered report and waits until they are written"""
+
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            while self._pending or self._in_flight:
+                self._condition.wait()
+            self._flushing -= 1
+
+    def close(self):
+        """flushes the buffered reports and stops the writer thread"""
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._pending:
+                        if self._closed or self._flushing or len(self._pending) >= self.max_batch:
+                            break
+                        # the reports left by a full batch keep their own enqueue time
+                        remaining = self._pending[0][0] + self.max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    elif self._closed:
+                        return
+                    else:
+                        self._condition.wait()
+                batch = [(document, future) for _, document, future in self._pending[:self.max_batch]]
+                del self._pending[:self.max_batch]
+                self._in_flight += 1
+                self._condition.notify_all()
+            try:
+                batch = [(document, future) for document, future in batch if future.set_running_or_notify_cancel()]
+                if batch:
+                    self._write(batch)
+            except Exception:
+                # the thread must outlive a failed batch or flush and close wait forever
+                ingestLog.exception("batch of %d reports not written", len(batch))
+                unresolved = [future for _, future in batch if not future.done()]
+                with self._condition:
+                    self.failed += len(unresolved)
+                for future in unresolved:
+                    future.set_result("Failure: 0")
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _write(self, batch):
+        statics = [(document, future) for document, future in batch if document.get("MsgType") == "static_data"]
+        if statics:
+            batch = [(document, future) for document, future in batch if document.get("MsgType") != "static_data"]
+            written = 0
+            try:
+                update_vessels([document for document, _ in statics])
+                result = "Success: 1"
+                written = len(statics)
+            except Exception:
+                result = "Failure: 0"
+            with self._condition:
+                self.written += written
+                self.failed += len(statics) - written
+            for _, future in statics:
+                future.set_result(result)
+        batch = [(slim_position(document), future) for document, future in batch]
+        window = reportWindow
+        documents = [document for document, _ in batch]
+        duplicates = set()
+        if window is not None:
+            duplicates = {index for index, document in enumerate(documents) if window.is_duplicate(document)}
+        positions = [index for index in range(len(documents)) if index not in duplicates]
+        failed = set()
+        try:
+            if positions:
+                self.collection.insert_many(add_dates([documents[index] for index in positions]), ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details.get("writeErrors", []):
+                if window is not None and write_error.get("code") == DUPLICATE_KEY_ERROR:
+                    window.count_rejected(1)
+                    duplicates.add(positions[write_error["index"]])
+                else:
+                    failed.add(positions[write_error["index"]])
+        except Exception:
+            failed = set(positions)
+        if window is not None:
+            window.forget([documents[index] for index in failed])
+        with self._condition:
+            self.written += len(batch) - len(failed) - len(duplicates)
+            self.failed += len(failed)
+        try:
+            update_latest_positions([document for index, document in enumerate(documents)
+                                     if index not in failed and index not in duplicates], self.latest)
+        except Exception:
+            ingestLog.exception("latest positions of %d reports not updated", len(documents))
+        for index, (_, future) in enumerate(batch):
+            future.set_result("Failure: 0" if index in failed else "Success: 1")
 
 
 class TrafficMonitoringBackEnd:
@@ -29,30 +1637,112 @@ class TrafficMonitoringBackEnd:
         :rtype: str
         """
 
-        insertion_number = 0
+        report = TrafficMonitoringBackEnd.stream_batch_of_ais(ais_data)
+        insertion_number = report["inserted"]
 
-        with open(ais_data) as file:
-            file_data = json.load(file)
+        return "Number of Insertions: " + str(insertion_number)
 
-        myCollection.insert_many(file_data)
-        insertion_number += len(list(file_data))
+    def stream_batch_of_ais(ais_data, batch_size=DEFAULT_BATCH_SIZE, queue_size=2):
+        """streams an AIS file (json array or newline delimited json) into mongoDB
 
-        return "Number of Insertions: " + str(insertion_number)
+        the file is parsed incrementally and the documents are inserted in unordered
+        batches of batch_size. Parsing runs on the calling thread while a writer
+        thread sends the previous batches, at most queue_size batches wait for the
+        writer so memory stays bounded regardless of the file size.
+        :param ais_data: path of the file that stores the to be inserted AIS data
+        :type ais_data: str
+        :param batch_size: maximum number of documents sent in one insert_many
+        :type batch_size: int
+        :param queue_size: maximum number of parsed batches waiting to be written
+        :type queue_size: int
+        :return: totals and a report (size, inserted, failed, duplicates, seconds, docs_per_sec) per batch
+        :rtype: dict
+        """
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+
+        pending = queue.Queue(maxsize=queue_size)
+        batches = []
+        errors = []
+
+        def write_batches():
+            while True:
+                batch = pending.get()
+                if batch is None:
+                    return
+                start = time.perf_counter()
+                try:
+                    inserted, failed, stored = store_messages(ingestCollection, batch)
+                except Exception as error:
+                    errors.append(error)
+                    inserted, failed, stored = 0, len(batch), []
+                try:
+                    update_latest_positions(stored)
+                except Exception as error:
+                    errors.append(error)
+                seconds = time.perf_counter() - start
+                batches.append({"batch": len(batches), "size": len(batch), "inserted": inserted,
+                                "failed": failed, "duplicates": len(batch) - inserted - failed, "seconds": seconds,
+                                "docs_per_sec": inserted / seconds if seconds else 0.0})
+
+        writer = threading.Thread(target=write_batches, daemon=True)
+        writer.start()
+        start = time.perf_counter()
+        try:
+            for batch in iter_batches(iter_ais_file(ais_data), batch_size):
+                pending.put(batch)
+        finally:
+            pending.put(None)
+            writer.join()
+        seconds = time.perf_counter() - start
+
+        inserted = sum(batch["inserted"] for batch in batches)
+        return {"inserted": inserted,
+                "failed": sum(batch["failed"] for batch in batches),
+                "duplicates": sum(batch["duplicates"] for batch in batches),
+                "seconds": seconds,
+                "docs_per_sec": inserted / seconds if seconds else 0.0,
+                "batches": batches,
+                "errors": [str(error) for error in errors]}
 
     def insert_single_ais(ais_data):
         """inserts an AIS report (static data or position) into the collection.
 
+        static data goes to the vessels collection, see update_vessels.
         param ais_data: a json formatted string that is to be inserted
         :type ais_data: str
-        :return: 'Success: 1' for successful insertion or 'Failure: 0' for failure
+        :return: 'Success: 1' for successful insertion or 'Failure: 0' for failure, a copy of a stored
+            report is a success when deduplication is on
         :rtype: str
         """
 
+        if isinstance(ais_data, Mapping) and ais_data.get("MsgType") == "static_data":
+            try:
+                update_vessels([ais_data])
+            except Exception:
+                return "Failure: 0"
+            return "Success: 1"
+        ais_data = slim_position(ais_data)
+        window = reportWindow
+        if window is not None and window.is_duplicate(ais_data):
+            return "Success: 1"
         try:
-            myCollection.insert_one(ais_data)
+            ingestCollection.insert_one(add_dates([ais_data])[0])
+        except DuplicateKeyError:
+            if window is None:
+                return "Failure: 0"
+            window.count_rejected(1)
             return "Success: 1"
         except:
+            if window is not None:
+                window.forget([ais_data])
             return "Failure: 0"
+        try:
+            update_latest_positions([ais_data])
+        except Exception:
+            ingestLog.exception("latest position of MMSI %s not updated", ais_data.get("MMSI"))
+        return "Success: 1"
 
     def delete_ais_by_timestamp(current_time):
         """deletes all AIS messages whose timestamp is 5 min older than current time
@@ -62,23 +1752,19 @@ class TrafficMonitoringBackEnd:
         :return: numbers of deletions
         """
 
-        date_format = "%Y-%m-%d %H:%M:%S.%f"
-        given_time = datetime.strptime(current_time, date_format)
-
-        subtracted_current_time = given_time - timedelta(minutes=5)
-        subtracted_current_time = subtracted_current_time.isoformat()[:-3] + 'Z'
+        subtracted_current_time = deletion_cutoff(current_time)
 
         return "Number of Deletions: " + str(
-            myCollection.delete_many({"Timestamp": {"$lt": subtracted_current_time}}).deleted_count)
+            myCollection.delete_many(expired_filter(subtracted_current_time)).deleted_count)
 
     def get_recent_vessel_positions(self):
         """get recent vessel information
-            searches for most recent vessel position reports and
+            reads the latest position report of every vessel, maintained on ingest, and
             retrieves the corresponding vessel documents for the position reports
                                         :return: array of vessel documents
                                         :rtype: array
                                         """
-        vessel_positions = myCollection.find({}, {"_id": 0, "MMSI": 1, "Position.coordinates": 1}) \
+        vessel_positions = latestPositions.find({}, {"_id": 0, "MMSI": 1, "Position.coordinates": 1}) \
             .sort('Timestamp', pymongo.DESCENDING)
         return vessel_positions
 
@@ -91,12 +1777,12 @@ class TrafficMonitoringBackEnd:
                                 :rtype: vessel object
                                 """
         if isinstance(mmsi, int):
-            return myCollection.find({"MMSI": {"$eq": mmsi}}, {"_id": 0, "MMSI": 1, "Position.coordinates": 1}) \
-                .sort('Timestamp', pymongo.DESCENDING).limit(1)
+            return latestPositions.find({"MMSI": {"$eq": mmsi}}, {"_id": 0, "MMSI": 1, "Position.coordinates": 1}) \
+                .limit(1)
         else:
             raise TypeError('MMSI must be an integer')
 
-    def find_all_ports(port_name, country=None):
+    def find_all_ports(port_name, country=None, batch_size=None, limit=None, after=None, stream=False):
         """finds all ports with the given param: port_name and country(optional).
 
         if no country is given, then a search with find all ports with the given country,
@@ -107,21 +1793,22 @@ class TrafficMonitoringBackEnd:
         :type port_name: str
         :param country: country of port to be searched
         :type country: str
+        :param batch_size: number of documents fetched per round trip
+        :type batch_size: int
+        :param limit: maximum number of ports returned, the ports are then sorted by id
+        :type limit: int
+        :param after: resume token, id of the last port already seen
+        :type after: str
+        :param stream: True to get a generator instead of a list
+        :type stream: bool
         :return: an array that contains all documents that fit the criteria
         :rtype: array
         """
 
-        ports_list = []
-
+        port_filter = {"port_location": port_name}
         if country is not None:
-            port = myPorts.find({"port_location": port_name, "country": country}, {"_id": 0})
-            for doc in port:
-                ports_list.append(doc)
-        else:
-            port = myPorts.find({"port_location": port_name}, {"_id": 0})
-            for doc in port:
-                ports_list.append(doc)
-        return ports_list
+            port_filter["country"] = country
+        return results(find_results(myPorts, port_filter, {"_id": 0}, "id", batch_size, limit, after), stream)
 
     def get_permanent_vessel_information(mmsi, imo=None, name=None):
         """given an MMSI and optional IMO and name values, get permanent vessel information
@@ -132,36 +1819,9 @@ class TrafficMonitoringBackEnd:
                         :return: vessel object
                         :rtype: vessel object
                         """
-        if isinstance(mmsi, int):
-            if imo or name is not None:
-                if imo is None:
-                    if isinstance(name, str):
-                        return vessels.find({"MMSI": {"$eq": mmsi}, "Name": {"$eq": name}},
-                                            {"_id": 0, "MMSI": 1, "Name": 1, "IMO": 1})
-                    else:
-                        raise TypeError('name must be a string')
+        return vessels.find(vessel_filter(mmsi, imo, name), VESSEL_PROJECTION)
 
-                elif name is None:
-                    if isinstance(imo, int):
-                        return vessels.find({"MMSI": {"$eq": mmsi}, "IMO": {"$eq": imo}},
-                                            {"_id": 0, "MMSI": 1, "Name": 1, "IMO": 1})
-                    else:
-                        raise TypeError('imo must be an int')
-                else:
-                    if isinstance(imo, int) and isinstance(name, str):
-                        return vessels.find({"MMSI": {"$eq": mmsi}, "IMO": {"$eq": imo}, "Name": {"$eq": name}},
-                                            {"_id": 0, "MMSI": 1, "Name": 1, "IMO": 1})
-                    else:
-                        raise TypeError('incorrect datatype(s)')
-            else:
-                return vessels.find({"MMSI": {"$eq": mmsi}}, {"_id": 0, "MMSI": 1, "Name": 1, "IMO": 1})
-        else:
-            raise TypeError('MMSI must be an integer')
-
-
-
-
-    def read_all_ship_positions(port_name, country):
+    def read_all_ship_positions(port_name, country, batch_size=None, limit=None, after=None, stream=False):
         """read all ship positions in the tile of scale 3 containing given port
 
         takes the port name and country to find port, takes the mapview_3 id
@@ -171,39 +1831,48 @@ class TrafficMonitoringBackEnd:
         :type port_name: str
         :param country: country of port to be searched
         :type country: str
+        :param batch_size: number of documents fetched per round trip
+        :type batch_size: int
+        :param limit: maximum number of documents returned, they are then sorted by MMSI (port id for ports)
+        :type limit: int
+        :param after: resume token, MMSI (port id for ports) of the last document already seen
+        :param stream: True to get a generator instead of a list
+        :type stream: bool
         :return: array of position reports, otherwise, an array or port docs
         :rtype: array
         """
 
-        tile_id = myPorts.find({"port_location": port_name, "country": country}
-                               , {"mapview_3": 1, "_id": 0})
-        tile_id_list = []
-        for doc in tile_id:
-            tile_id_list.append(doc)
-
-        if not tile_id_list or tile_id_list[0]["mapview_3"] is None:
-            port_documents = myPorts.find({}, {"_id": 0, "un/locode": 0, "website": 0})
-            ports_list = []
-            for doc in port_documents:
-                ports_list.append(doc)
-            return ports_list
+        return ports_or_positions({"port_location": port_name, "country": country}, batch_size, limit, after,
+                                  stream)
+
+    def get_inbound_traffic(port_id=None, port_name=None, country=None, eta_from=None, eta_to=None):
+        """given a port id, or a port name and country, gets the vessels headed to the port
+
+        the vessels are found through the DestinationCode precomputed from their
+        static data at ingest, so no free text is matched at query time.
+        :param port_id: id of the port
+        :type port_id: str
+        :param port_name: the port name
+        :type port_name: str
+        :param country: country of the port
+        :type country: str
+        :param eta_from: earliest ETA, None for no lower bound
+        :type eta_from: datetime or str
+        :param eta_to: latest ETA, None for no upper bound
+        :type eta_to: datetime or str
+        :return: array of vessel documents with their latest Position (missing when unknown), sorted by ETA
+        :rtype: array
+        """
+
+        if port_id is not None:
+            code = find_port_code({"id": port_id})
+        elif isinstance(port_name, str) and isinstance(country, str):
+            code = find_port_code({"port_location": port_name, "country": country})
         else:
-            mapview_tile = list(
-                myMapViews.find({"id": tile_id_list[0]["mapview_3"]},
-                                {"west": 1, "south": 1, "east": 1, "north": 1, "_id": 0}))
-
-            cardinal_directions = []
-            for doc in mapview_tile:
-                cardinal_directions.append(doc)
-            ship_positions = myCollection.find({"Position.coordinates.0": {"$gte": cardinal_directions[0]["south"],
-                                                                           "$lte": cardinal_directions[0]["north"]},
-                                                "Position.coordinates.1": {"$gte": cardinal_directions[0]["west"],
-                                                                           "$lte": cardinal_directions[0]["east"]}},
-                                               {"Position.coordinates": 1, "_id": 0})
-            ship_positions_list = []
-            for doc in ship_positions:
-                ship_positions_list.append(doc)
-            return ship_positions_list
+            raise TypeError("a port id or a port name and country are required")
+        if code is None:
+            return []
+        return list(vessels.aggregate(inbound_traffic_pipeline(code, eta_from, eta_to)))
 
     def get_recent_vessel_position_tile(tileId):
         """given a tile id, get the recent vessel positions within the tile
@@ -215,68 +1884,90 @@ class TrafficMonitoringBackEnd:
                 :rtype: array
                 """
         if isinstance(tileId, int):
-            map_view_coordinates = myMapViews.find({"id": tileId},
-                                                   {"_id": 0, "west": 1, "east": 1, "north": 1, "south": 1})
-            ship_positions = myCollection.find({"Position.coordinates.0": {"$gte": map_view_coordinates[0]["south"],
-                                                                           "$lte": map_view_coordinates[0]["north"]},
-                                                "Position.coordinates.1": {"$gte": map_view_coordinates[0]["west"],
-                                                                           "$lte": map_view_coordinates[0]["east"]}},
-                                               {"_id": 0, "Position.coordinates": 1, "MMSI": 1, "Name": 1, "IMO": 1})
-            return ship_positions
+            tile = find_tile(tileId)
+            if tile is None:
+                return []
+            return vessels_in_tile(tile)
         else:
             raise TypeError('tileId must be an integer')
 
-    def read_positions_with_id(port_id):
-        """read most recent positions of ships headed to port with port id
+    def get_viewport(tiles):
+        """given a parent mapview id or a list of tile ids, gets every tile with the vessels inside it
+
+        one spatial query on the latest positions replaces get_tiles_of_map_tile
+        followed by get_recent_vessel_position_tile for every child, the vessels
+        are then split up by the tile bounds. The latest positions hold no static
+        data, names come from get_vessel_cards.
+        :param tiles: id of the parent mapview tile or list of mapview tile ids
+        :type tiles: int or list
+        :return: array of mapview documents, each with a vessels array of MMSI and Position documents
+        :rtype: array
+        """
+
+        tiles, query = viewport_tiles(tiles)
+        if query is None:
+            return []
+        return partition_by_tile(tiles, latestPositions.find(query, POSITION_PROJECTION)
+                                 .batch_size(DEFAULT_BATCH_SIZE))
+
+    def read_positions_with_id(port_id, batch_size=None, limit=None, after=None, stream=False):
+        """read most recent positions of ships in the map tile of port with port id
 
         takes the parameter of port id to search for port, then takes the
         mapview id to do another search that retrieves the tile size.
         After retrieving the measurements a search is done to find all
-        positions within that area, and returned in an array
+        positions within that area, and returned in an array.
+        Ships headed to the port are found by get_inbound_traffic.
         :param port_id:
         :type port_id:
+        :param batch_size: number of documents fetched per round trip
+        :type batch_size: int
+        :param limit: maximum number of documents returned, they are then sorted by MMSI (port id for ports)
+        :type limit: int
+        :param after: resume token, MMSI (port id for ports) of the last document already seen
+        :param stream: True to get a generator instead of a list
+        :type stream: bool
         :return: array containing all the ship positions found within the searched port
         :rtype: array
         """
-        tile_id = myPorts.find({"id": port_id}
-                               , {"mapview_3": 1, "_id": 0})
-        tile_id_list = []
-        for doc in tile_id:
-            tile_id_list.append(doc)
-
-        mapview_tile = list(
-            myMapViews.find({"id": tile_id_list[0]["mapview_3"]},
-                            {"west": 1, "south": 1, "east": 1, "north": 1, "_id": 0}))
-        cardinal_directions = []
-        for doc in mapview_tile:
-            cardinal_directions.append(doc)
-        ship_positions = myCollection.find({"Position.coordinates.0": {"$gte": cardinal_directions[0]["south"],
-                                                                       "$lte": cardinal_directions[0]["north"]},
-                                            "Position.coordinates.1": {"$gte": cardinal_directions[0]["west"],
-                                                                       "$lte": cardinal_directions[0]["east"]}},
-                                           {"Position.coordinates": 1, "_id": 0})
-        ship_positions_list = []
-        for doc in ship_positions:
-            ship_positions_list.append(doc)
-        return ship_positions_list
+        tile = find_port_tile({"id": port_id})
+        if tile is None:
+            return iter([]) if stream else []
+        return results(vessels_in_tile(tile, None, batch_size, limit, after), stream)
 
     def get_tile_png(mapview_id):
-        """given a tile id, gets the actual tile data in binary
+        """given a tile id, gets the PNG data of the tile
 
-        searches for mapview tile with id, then converts the png
-        into binary data to return to user
-        :param mapview_id:
-        :type mapview_id:
-        :return: binary data of png file
-        :rtype: str
+        the data comes from the tile store, recently served tiles from memory.
+        :param mapview_id: id of the mapview tile
+        :type mapview_id: int
+        :return: PNG data or None if no PNG is stored for the tile
+        :rtype: bytes
         """
-        get_filename = myMapViews.find({"id": mapview_id}, {"_id": 0, "filename": 1})\
-            .sort('Timestamp', pymongo.DESCENDING)
-        filename = []
-        for doc in get_filename:
-            filename.append(doc)
-        to_binary = " ".join(format(ord(c), "b") for c in filename[0]["filename"])
-        return to_binary
+
+        if isinstance(mapview_id, int):
+            tile = tileStore.get(mapview_id)
+            return tile.data if tile is not None else None
+        else:
+            raise TypeError("mapview_id must be an integer")
+
+    def get_tile(mapview_id, etag=None, modified_since=None):
+        """given a tile id and what the client already has, gets the tile unless the client's copy is current
+
+        :param mapview_id: id of the mapview tile
+        :type mapview_id: int
+        :param etag: ETag of the client's copy
+        :type etag: str
+        :param modified_since: last modified time of the client's copy
+        :type modified_since: datetime
+        :return: PNG data, ETag and last modified time, None when not modified or not stored
+        :rtype: tiles.Tile
+        """
+
+        if isinstance(mapview_id, int):
+            return tileStore.get_if_modified(mapview_id, etag, modified_since)
+        else:
+            raise TypeError("mapview_id must be an integer")
 
     def get_last_five_positions_mmsi(mmsi):
         """given an MMSI and or IMO/name values, it will get the permanent vessel information and
@@ -290,6 +1981,38 @@ class TrafficMonitoringBackEnd:
         return myCollection.find({"MMSI": {"$eq": mmsi}}, {"_id": 0, "MMSI": 1, "Position.coordinates": 1}) \
             .sort('Timestamp', pymongo.DESCENDING).limit(5)
 
+    def get_vessel_card(mmsi):
+        """given an MMSI, gets the latest position of the vessel joined with its permanent information
+
+        one aggregation replaces get_recent_vessel_position_mmsi plus get_permanent_vessel_information.
+        :param mmsi: MMSI of the vessel
+        :type mmsi: int
+        :return: vessel card or None if the vessel has no position
+        :rtype: dict
+        """
+
+        if isinstance(mmsi, int):
+            cards = list(latestPositions.aggregate(vessel_card_pipeline({"MMSI": mmsi})))
+            return cards[0] if cards else None
+        else:
+            raise TypeError('MMSI must be an integer')
+
+    def get_vessel_cards(mmsis):
+        """given a list of MMSIs, gets the vessel cards of all of them in one request
+
+        :param mmsis: MMSIs of the vessels
+        :type mmsis: list
+        :return: array of vessel cards in the order of mmsis, vessels without position are left out
+        :rtype: array
+        """
+
+        mmsis = list(mmsis)
+        if not all(isinstance(mmsi, int) for mmsi in mmsis):
+            raise TypeError('MMSI must be an integer')
+        cards = {card["MMSI"]: card for card in latestPositions.aggregate(
+            vessel_card_pipeline({"MMSI": {"$in": mmsis}}))}
+        return [cards[mmsi] for mmsi in mmsis if mmsi in cards]
+
     def get_tiles_of_map_tile(mapview_id):
         """given a mapview id of zoom level 1, gets the 4 tiles contained in the mapview id's map tile
                 :param mapview_id:
@@ -298,54 +2021,113 @@ class TrafficMonitoringBackEnd:
                 :rtype: array
                 """
         if isinstance(mapview_id, int):
-            return myMapViews.find({"contained_by": mapview_id}, {"_id": 0, "id": 1, "west": 1, "south": 1,
-                                                              "east": 1, "north": 1, "filename": 1})
+            return [dict(tile) for tile in find_child_tiles(mapview_id)]
         else:
             raise TypeError("mapview_id must be an integer")
 
-    def read_positions_with_port_name(port_name, country):
-        """read the recent positions of ships headed to port with port name and country
+    def read_positions_with_port_name(port_name, country, batch_size=None, limit=None, after=None, stream=False):
+        """read the recent positions of ships in the map tile of port with port name and country
         takes the port name and country to find port,
         takes the mapview id to search again for the tile size,
         and return all ship positions within that given area and return it in
-        an array in position documents form.
+        an array in position documents form. Ships headed to the port are found by get_inbound_traffic.
             param port_name: the port name
             :type port_name: str
             :param country: country of port
             :type country: str
+            :param batch_size: number of documents fetched per round trip
+            :type batch_size: int
+            :param limit: maximum number of documents returned, they are then sorted by MMSI (port id for ports)
+            :type limit: int
+            :param after: resume token, MMSI (port id for ports) of the last document already seen
+            :param stream: True to get a generator instead of a list
+            :type stream: bool
             :return: array with all the ship positions found within the given port
             :rtype: array
             """
 
-        tile_id = myPorts.find({"port_location": port_name, "country": country}, {"mapview_3": 1, "_id": 0})
+        return ports_or_positions({"port_location": port_name, "country": country}, batch_size, limit, after,
+                                  stream)
 
-        tile_id_list = []
-        for doc in tile_id:
-            tile_id_list.append(doc)
 
-        if not tile_id_list or tile_id_list[0]["mapview_3"] is None:
-            port_documents = myPorts.find({}, {"_id": 0, "un/locode": 0, "website": 0})
-            ports_list = []
-            for doc in port_documents:
-                ports_list.append(doc)
-            return ports_list
-        else:
-            mapview_tile = list(
-                myMapViews.find({"id": tile_id_list[0]["mapview_3"]},
-                                {"west": 1, "south": 1, "east": 1, "north": 1, "_id": 0}))
-
-        cardinal_directions = []
-        for doc in mapview_tile:
-            cardinal_directions.append(doc)
-        ship_positions = myCollection.find({"Position.coordinates.0": {"$gte": cardinal_directions[0]["south"],
-                                                                       "$lte": cardinal_directions[0]["north"]},
-                                            "Position.coordinates.1": {"$gte": cardinal_directions[0]["west"],
-                                                                       "$lte": cardinal_directions[0]["east"]}},
-                                           {"Position.coordinates": 1, "_id": 0})
-        ship_positions_list = []
-        for doc in ship_positions:
-            ship_positions_list.append(doc)
-        return ship_positions_list
+metrics.instrument(TrafficMonitoringBackEnd, metrics.queryMetrics)
+
+
+def aggregate_plan(collection, pipeline):
+    """explains an aggregation and returns the winning plan of the query feeding it
+
+    :param collection: collection the aggregation runs on
+    :type collection: pymongo.collection.Collection
+    :param pipeline: aggregation pipeline
+    :type pipeline: list
+    :return: winning plan
+    :rtype: dict
+    """
+
+    explained = collection.database.command("aggregate", collection.name, pipeline=pipeline, explain=True)
+    planner = explained.get("queryPlanner") or explained["stages"][0]["$cursor"]["queryPlanner"]
+    return planner["winningPlan"]
+
+
+def find_collection_scans():
+    """explains the query of every public TMB method and reports the collection scans
+
+    sample arguments are taken from the stored data, so the collections must not
+    be empty. The full port listing returned when a port has no tile is a
+    deliberate full read and is not checked. The $lookup of an aggregation is
+    checked through the equivalent find on the joined collection. The track
+    queries must also be read in index order, so a blocking SORT is reported for
+    them too.
+    :return: winning plan stages of every query that performs a COLLSCAN or a track query that sorts
+    :rtype: dict
+    """
+
+    # tracks builds on this module
+    import tracks
+
+    tmb = TrafficMonitoringBackEnd
+    position = myCollection.find_one({"MsgType": "position_report"}, {"MMSI": 1, "Timestamp": 1})
+    port = myPorts.find_one({"mapview_3": {"$ne": None}}, {"port_location": 1, "country": 1, "id": 1,
+                                                           "mapview_3": 1})
+    tile = myMapViews.find_one({}, {"id": 1, "west": 1, "south": 1, "east": 1, "north": 1, "contained_by": 1})
+    tile_ids = [mapview["id"] for mapview in myMapViews.find({}, {"id": 1}).limit(2)]
+    mmsi = position["MMSI"]
+    start = timestamp_date(position["Timestamp"]) - timedelta(hours=1)
+    end = start + timedelta(hours=2)
+
+    queries = {
+        "get_recent_vessel_positions": tmb.get_recent_vessel_positions(None),
+        "get_recent_vessel_position_mmsi": tmb.get_recent_vessel_position_mmsi(mmsi),
+        "get_last_five_positions_mmsi": tmb.get_last_five_positions_mmsi(mmsi),
+        "get_permanent_vessel_information": tmb.get_permanent_vessel_information(mmsi),
+        "find_all_ports": myPorts.find({"port_location": port["port_location"], "country": port["country"]}),
+        "read_positions_with_id": myPorts.find({"id": port["id"]}),
+        "mapview_by_id": myMapViews.find({"id": tile["id"]}),
+        "get_tiles_of_map_tile": myMapViews.find({"contained_by": tile["id"]}),
+        "tile_positions": vessels_in_tile(tile),
+        "get_viewport": latestPositions.find(viewport_tiles(tile_ids)[1], POSITION_PROJECTION),
+        "vessel_card_lookup": vessels.find({"MMSI": mmsi}, VESSEL_STATIC_PROJECTION),
+        "inbound_traffic_lookup": latestPositions.find({"MMSI": mmsi}),
+        "get_vessel_track": tracks.find_tracks(mmsi, start, end),
+        "get_vessel_tracks": tracks.find_tracks({"$in": [mmsi, mmsi + 1]}, start, end),
+    }
+    plans = {name: cursor.explain()["queryPlanner"]["winningPlan"] for name, cursor in queries.items()}
+    plans["get_vessel_card"] = aggregate_plan(latestPositions, vessel_card_pipeline({"MMSI": mmsi}))
+    plans["get_inbound_traffic"] = aggregate_plan(vessels, inbound_traffic_pipeline(
+        find_port_code({"id": port["id"]}) or "", start, end + timedelta(days=30)))
+    plans["get_vessel_track_buckets"] = aggregate_plan(myCollection, tracks.track_pipeline(
+        tracks.track_match(mmsi, start, end), 600))
+    plans["get_vessel_tracks_buckets"] = aggregate_plan(myCollection, tracks.track_pipeline(
+        tracks.track_match({"$in": [mmsi, mmsi + 1]}, start, end), 600))
+    ordered = {"get_vessel_track", "get_vessel_tracks", "get_vessel_track_buckets", "get_vessel_tracks_buckets"}
+
+    scans = {}
+    for name, plan in plans.items():
+        stages = plan_stages(plan)
+        if "COLLSCAN" in stages or (name in ordered and "SORT" in stages):
+            scans[name] = stages
+    return scans
+
 
 def main():
     x = TrafficMonitoringBackEnd
@@ -0,0 +1,400 @@
+"""Instrumentation of the TMB (Traffic Monitoring Backend)
+
+   Records call counts, latency histograms and returned documents of every
+   TrafficMonitoringBackEnd method, and of every command the mongo client sends
+   (documents returned, estimated reply bytes, documents examined by slow queries). The
+   statistics are exported as a dict or in the Prometheus text format. Queries
+   slower than a threshold are logged with their filter and an explain summary.
+
+   Everything is off until enable is called, the hooks then cost a clock read
+   and a dict update per call so the insert paths are not slowed down.
+"""
+
+import bisect
+import functools
+import logging
+import queue
+import threading
+import time
+
+import bson
+from pymongo import monitoring
+
+# upper bounds in seconds of the latency histogram buckets, like the prometheus client defaults
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EXPLAINED_COMMANDS = ("find", "aggregate", "count", "distinct")
+# command fields that belong to the session or the wire protocol, they are left out of explain
+SESSION_FIELDS = ("lsid", "txnNumber", "$clusterTime", "$db", "$readPreference", "readConcern", "cursor")
+
+slowQueryLog = logging.getLogger("tmb.slow_queries")
+
+
+class Histogram:
+    """cumulative latency histogram with fixed buckets
+
+    :param buckets: upper bounds of the buckets in seconds
+    :type buckets: tuple
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        """(upper bound, number of observations at most that long) pairs, the last bound is +Inf"""
+
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, fraction):
+        """estimates a quantile as the upper bound of the bucket it falls into"""
+
+        if not self.count:
+            return 0.0
+        for bound, total in self.cumulative():
+            if total >= fraction * self.count:
+                return bound if bound != float("inf") else self.buckets[-1]
+        return self.buckets[-1]
+
+
+class Metrics:
+    """thread safe registry of the statistics of backend methods and mongo commands
+
+    :param slow_query_seconds: commands at least this slow are logged, None disables the log
+    :type slow_query_seconds: float
+    :param explain_client: client used to explain slow queries, None logs them without a plan
+    :type explain_client: pymongo.MongoClient
+    """
+
+    def __init__(self, slow_query_seconds=None, explain_client=None):
+        self.enabled = False
+        self.slow_query_seconds = slow_query_seconds
+        self.explain_client = explain_client
+        self._lock = threading.Lock()
+        self._explain_queue = None
+        self.reset()
+
+    def reset(self):
+        """forgets every recorded statistic"""
+
+        with self._lock:
+            self.calls = {}
+            self.commands = {}
+
+    def record_call(self, method, seconds, documents=None, failed=False):
+        """records one call of a backend method
+
+        :param method: name of the method
+        :type method: str
+        :param seconds: time spent in the call
+        :type seconds: float
+        :param documents: number of documents returned, None when the result is a cursor
+        :type documents: int
+        :param failed: whether the call raised
+        :type failed: bool
+        """
+
+        with self._lock:
+            stats = self.calls.get(method)
+            if stats is None:
+                stats = self.calls[method] = {"calls": 0, "errors": 0, "documents": 0, "latency": Histogram()}
+            stats["calls"] += 1
+            stats["latency"].observe(seconds)
+            if failed:
+                stats["errors"] += 1
+            if documents:
+                stats["documents"] += documents
+
+    def record_command(self, command, collection, seconds, documents=0, reply_bytes=0, examined=0, failed=False):
+        """records one command sent to mongo
+
+        :param command: command name such as find, insert or getMore
+        :type command: str
+        :param collection: name of the collection the command ran on
+        :type collection: str
+        :param seconds: round trip time of the command
+        :type seconds: float
+        :param documents: number of documents returned or written
+        :type documents: int
+        :param reply_bytes: size of the reply in bytes
+        :type reply_bytes: int
+        :param examined: number of documents examined, known for explained slow queries
+        :type examined: int
+        :param failed: whether the command failed
+        :type failed: bool
+        """
+
+        with self._lock:
+            key = (command, collection)
+            stats = self.commands.get(key)
+            if stats is None:
+                stats = self.commands[key] = {"calls": 0, "errors": 0, "documents": 0, "bytes": 0,
+                                              "examined": 0, "latency": Histogram()}
+            if seconds is not None:
+                stats["calls"] += 1
+                stats["latency"].observe(seconds)
+            if failed:
+                stats["errors"] += 1
+            stats["documents"] += documents
+            stats["bytes"] += reply_bytes
+            stats["examined"] += examined
+
+    def stats(self):
+        """summarizes the statistics
+
+        :return: per method and per command/collection counts, latency mean/p50/p99 and totals
+        :rtype: dict
+        """
+
+        def summary(stats):
+            histogram = stats["latency"]
+            result = {name: value for name, value in stats.items() if name != "latency"}
+            result["seconds"] = histogram.sum
+            result["mean_ms"] = histogram.sum / histogram.count * 1000 if histogram.count else 0.0
+            result["p50_ms"] = histogram.quantile(0.5) * 1000
+            result["p99_ms"] = histogram.quantile(0.99) * 1000
+            return result
+
+        with self._lock:
+            return {"methods": {method: summary(stats) for method, stats in self.calls.items()},
+                    "commands": {command + " " + collection: summary(stats)
+                                 for (command, collection), stats in self.commands.items()}}
+
+    def prometheus(self):
+        """exports the statistics in the Prometheus text exposition format
+
+        :rtype: str
+        """
+
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " histogram")
+            for labels, stats in series:
+                for bound, total in stats["latency"].cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(name + "_bucket{" + labels + ',le="' + le + '"} ' + str(total))
+                lines.append(name + "_sum{" + labels + "} " + repr(stats["latency"].sum))
+                lines.append(name + "_count{" + labels + "} " + str(stats["latency"].count))
+
+        def counter(name, help_text, field, series):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " counter")
+            for labels, stats in series:
+                lines.append(name + "{" + labels + "} " + str(stats[field]))
+
+        with self._lock:
+            methods = [('method="' + method + '"', stats) for method, stats in sorted(self.calls.items())]
+            commands = [('command="' + command + '",collection="' + collection + '"', stats)
+                        for (command, collection), stats in sorted(self.commands.items())]
+            histogram("tmb_method_seconds", "Latency of TrafficMonitoringBackEnd methods.", methods)
+            counter("tmb_method_errors_total", "Calls that raised.", "errors", methods)
+            counter("tmb_method_documents_total", "Documents returned as lists.", "documents", methods)
+            histogram("tmb_mongo_command_seconds", "Round trip time of mongo commands.", commands)
+            counter("tmb_mongo_command_errors_total", "Failed mongo commands.", "errors", commands)
+            counter("tmb_mongo_documents_total", "Documents returned or written by mongo commands.", "documents",
+                    commands)
+            counter("tmb_mongo_reply_bytes_total", "Bytes of mongo replies, cursor batches estimated.", "bytes",
+                    commands)
+            counter("tmb_mongo_documents_examined_total", "Documents examined by explained slow queries.",
+                    "examined", commands)
+        return "\n".join(lines) + "\n"
+
+    def log_slow_query(self, database, command_name, collection, command, seconds):
+        """logs a slow query, the explain runs on a background thread so the caller is not held up"""
+
+        if self.explain_client is None or command_name not in EXPLAINED_COMMANDS:
+            slowQueryLog.warning("slow %s on %s.%s took %.1f ms filter=%s", command_name, database, collection,
+                                 seconds * 1000, command.get("filter", command.get("pipeline", command.get("query"))))
+            return
+        if self._explain_queue is None:
+            with self._lock:
+                if self._explain_queue is None:
+                    self._explain_queue = queue.Queue(maxsize=100)
+                    threading.Thread(target=self._explain_slow_queries, daemon=True).start()
+        try:
+            self._explain_queue.put_nowait((database, command_name, collection, command, seconds))
+        except queue.Full:
+            slowQueryLog.warning("slow %s on %s.%s took %.1f ms, explain queue full", command_name, database,
+                                 collection, seconds * 1000)
+
+    def _explain_slow_queries(self):
+        while True:
+            database, command_name, collection, command, seconds = self._explain_queue.get()
+            explained = {name: value for name, value in command.items() if name not in SESSION_FIELDS}
+            try:
+                plan = self.explain_client[database].command("explain", explained, verbosity="executionStats")
+                execution = plan.get("executionStats", {})
+                summary = {"stages": plan_stages(plan.get("queryPlanner", {}).get("winningPlan", {})),
+                           "docsExamined": execution.get("totalDocsExamined"),
+                           "keysExamined": execution.get("totalKeysExamined"),
+                           "returned": execution.get("nReturned")}
+                self.record_command(command_name, collection, None, examined=summary["docsExamined"] or 0)
+            except Exception as error:
+                summary = {"error": str(error)}
+            slowQueryLog.warning("slow %s on %s.%s took %.1f ms filter=%s plan=%s", command_name, database,
+                                 collection, seconds * 1000,
+                                 command.get("filter", command.get("pipeline", command.get("query"))), summary)
+
+
+def plan_stages(plan):
+    """lists every stage name found in an explain plan
+
+    :param plan: explain output or part of it
+    :type plan: dict
+    :return: names of the stages
+    :rtype: list
+    """
+
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def reply_documents(reply):
+    """number of documents carried by a command reply: a cursor batch or the n of a write"""
+
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    n = reply.get("n")
+    return n if isinstance(n, int) else 0
+
+
+def reply_size(reply):
+    """size of a command reply in bytes, estimated for a cursor batch from its first document
+
+    encoding a whole find or getMore batch again would cost more than the query it measures.
+    """
+
+    raw = getattr(reply, "raw", None)
+    if raw is not None:
+        return len(raw)
+    cursor = reply.get("cursor")
+    batch = cursor.get("firstBatch", cursor.get("nextBatch")) if cursor is not None else None
+    if not batch:
+        return len(bson.encode(reply))
+    return len(bson.encode(batch[0])) * len(batch)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """pymongo command listener feeding a Metrics registry
+
+    it is passed to the client with event_listeners and does nothing while the
+    registry is disabled.
+    :param registry: where the commands are recorded
+    :type registry: Metrics
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._pending = {}
+
+    def started(self, event):
+        if not self.registry.enabled:
+            return
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" \
+            else command.get(event.command_name)
+        self._pending[(event.request_id, event.connection_id)] = (collection if isinstance(collection, str)
+                                                                  else "", command)
+
+    def succeeded(self, event):
+        pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is None:
+            return
+        collection, command = pending
+        seconds = event.duration_micros / 1e6
+        reply = event.reply
+        self.registry.record_command(event.command_name, collection, seconds, reply_documents(reply),
+                                     reply_size(reply))
+        slow = self.registry.slow_query_seconds
+        if slow is not None and seconds >= slow and event.command_name != "explain":
+            self.registry.log_slow_query(event.database_name, event.command_name, collection, command, seconds)
+
+    def failed(self, event):
+        pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is not None:
+            self.registry.record_command(event.command_name, pending[0], event.duration_micros / 1e6, failed=True)
+
+
+def instrument(backend, registry):
+    """wraps every public method of a backend class so its calls are recorded
+
+    cursors are returned untouched, their documents are counted by the command listener.
+    :param backend: class whose methods are called on the class itself, like TrafficMonitoringBackEnd
+    :type backend: type
+    :param registry: where the calls are recorded
+    :type registry: Metrics
+    :return: the same class
+    :rtype: type
+    """
+
+    for name, method in list(vars(backend).items()):
+        if name.startswith("_") or not callable(method) or getattr(method, "__wrapped__", None):
+            continue
+        setattr(backend, name, timed(method, name, registry))
+    return backend
+
+
+def timed(method, name, registry):
+    """wraps one method so its calls are recorded while the registry is enabled"""
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not registry.enabled:
+            return method(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            registry.record_call(name, time.perf_counter() - start, failed=True)
+            raise
+        registry.record_call(name, time.perf_counter() - start,
+                             len(result) if isinstance(result, list) else None)
+        return result
+
+    return wrapper
+
+
+queryMetrics = Metrics()
+commandListener = CommandMetrics(queryMetrics)
+
+
+def enable(slow_query_seconds=None, explain_client=None):
+    """starts recording
+
+    :param slow_query_seconds: commands at least this slow are logged, None disables the log
+    :type slow_query_seconds: float
+    :param explain_client: client used to explain slow queries
+    :type explain_client: pymongo.MongoClient
+    """
+
+    queryMetrics.slow_query_seconds = slow_query_seconds
+    queryMetrics.explain_client = explain_client
+    queryMetrics.enabled = True
+
+
+def disable():
+    """stops recording, the statistics are kept"""
+
+    queryMetrics.enabled = False
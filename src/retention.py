@@ -0,0 +1,279 @@
+"""Retention of AIS history for the TMB (Traffic Monitoring Backend)
+
+   Three ways to get rid of expired AIS messages without scanning the collection:
+   a TTL index on the Date field that mongo expires by itself, time bucketed
+   collections (one per hour or day) that are dropped whole, and a throttled
+   background purger deleting through the Date index in small batches so it
+   does not compete with ingest.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+
+import main
+
+BUCKET_FORMATS = {"hour": "%Y%m%d%H", "day": "%Y%m%d"}
+BUCKET_LENGTHS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+# seconds the purger waits after a first failed round, doubled for every further failure up to its interval
+RETRY_DELAY = 1.0
+
+retentionLog = logging.getLogger("tmb.retention")
+
+
+def enable_ttl(retention, collection=None):
+    """lets mongo expire AIS messages whose Date is older than the retention
+
+    the Date index is created as a TTL index, or converted when it already exists.
+    :param retention: how long messages are kept
+    :type retention: timedelta
+    :param collection: AIS collection
+    :type collection: pymongo.collection.Collection
+    :return: name of the TTL index
+    :rtype: str
+    """
+
+    collection = collection if collection is not None else main.myCollection
+    seconds = int(retention.total_seconds())
+    for name, index in collection.index_information().items():
+        if [tuple(field) for field in index["key"]] == [("Date", pymongo.ASCENDING)]:
+            collection.database.command("collMod", collection.name,
+                                        index={"name": name, "expireAfterSeconds": seconds})
+            return name
+    return collection.create_index([("Date", pymongo.ASCENDING)], expireAfterSeconds=seconds)
+
+
+def disable_ttl(collection=None):
+    """stops mongo from expiring AIS messages, the Date index becomes a plain index
+
+    :param collection: AIS collection
+    :type collection: pymongo.collection.Collection
+    """
+
+    collection = collection if collection is not None else main.myCollection
+    for name, index in collection.index_information().items():
+        if "expireAfterSeconds" in index and [tuple(field) for field in index["key"]] == [("Date", 1)]:
+            collection.drop_index(name)
+            collection.create_index([("Date", pymongo.ASCENDING)])
+
+
+class BucketedStore:
+    """stores AIS messages in one collection per hour or day so expired data is dropped whole
+
+    :param database: database holding the bucket collections
+    :type database: pymongo.database.Database
+    :param prefix: prefix of the bucket collection names
+    :type prefix: str
+    :param bucket: 'hour' or 'day'
+    :type bucket: str
+    """
+
+    def __init__(self, database=None, prefix="ais_", bucket="day"):
+        if bucket not in BUCKET_FORMATS:
+            raise ValueError("bucket must be 'hour' or 'day'")
+        self.database = database if database is not None else main.myDataBase
+        self.prefix = prefix
+        self.bucket = bucket
+
+    def bucket_name(self, date):
+        """name of the collection holding the messages of a date
+
+        :param date: date of a message
+        :type date: datetime
+        :rtype: str
+        """
+
+        return self.prefix + date.strftime(BUCKET_FORMATS[self.bucket])
+
+    def bucket_start(self, name):
+        """start of the period stored in a bucket collection, None for other collections
+
+        :param name: collection name
+        :type name: str
+        :rtype: datetime
+        """
+
+        if not name.startswith(self.prefix):
+            return None
+        try:
+            return datetime.strptime(name[len(self.prefix):], BUCKET_FORMATS[self.bucket]) \
+                .replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+
+    def buckets(self):
+        """lists the bucket collections, oldest first
+
+        :return: (start, name) pairs
+        :rtype: list
+        """
+
+        found = []
+        for name in self.database.list_collection_names():
+            start = self.bucket_start(name)
+            if start is not None:
+                found.append((start, name))
+        return sorted(found)
+
+    def insert(self, documents):
+        """routes AIS position reports into the bucket of their Date, static data into the vessels
+
+        :param documents: AIS documents
+        :type documents: list
+        :return: number of inserted documents and number of failed documents
+        :rtype: tuple
+        """
+
+        documents, statics = main.split_messages(list(documents))
+        documents = main.add_dates(documents)
+        inserted, failed = main.store_statics(statics)
+        routed = {}
+        for document in documents:
+            if "Date" not in document:
+                failed += 1
+                continue
+            routed.setdefault(self.bucket_name(document["Date"]), []).append(document)
+        stored = []
+        for name, bucket_documents in routed.items():
+            collection = self.database[name]
+            collection.create_index([("MMSI", pymongo.ASCENDING), ("Timestamp", pymongo.DESCENDING)])
+            bucket_stored, bucket_failed = main.insert_stored_documents(collection, bucket_documents)
+            stored.extend(bucket_stored)
+            inserted += len(bucket_stored)
+            failed += bucket_failed
+        main.update_latest_positions(stored)
+        return inserted, failed
+
+    def collections_between(self, start, end):
+        """gets the bucket collections overlapping a period
+
+        :param start: start of the period
+        :type start: datetime
+        :param end: end of the period
+        :type end: datetime
+        :return: collections, oldest first
+        :rtype: list
+        """
+
+        length = BUCKET_LENGTHS[self.bucket]
+        return [self.database[name] for bucket_start, name in self.buckets()
+                if bucket_start < end and bucket_start + length > start]
+
+    def drop_expired(self, cutoff):
+        """drops every bucket whose whole period is older than the cutoff
+
+        :param cutoff: messages older than this date are expired
+        :type cutoff: datetime
+        :return: names of the dropped collections
+        :rtype: list
+        """
+
+        length = BUCKET_LENGTHS[self.bucket]
+        dropped = []
+        for bucket_start, name in self.buckets():
+            if bucket_start + length <= cutoff:
+                self.database.drop_collection(name)
+                dropped.append(name)
+        return dropped
+
+
+class Purger:
+    """deletes expired AIS messages in the background, a few at a time
+
+    every round deletes at most batch_size messages found through the Date index
+    and then sleeps pause seconds, so the purge never holds up ingest for long.
+    A failed round, e.g. while mongo is unreachable, is logged and retried with
+    a growing delay.
+    :param retention: how long messages are kept
+    :type retention: timedelta
+    :param collection: AIS collection
+    :type collection: pymongo.collection.Collection
+    :param batch_size: maximum number of messages deleted per round
+    :type batch_size: int
+    :param pause: seconds slept between rounds
+    :type pause: float
+    :param interval: seconds slept once nothing is left to delete
+    :type interval: float
+    :param on_progress: function called with the progress after every round
+    :type on_progress: function
+    """
+
+    def __init__(self, retention, collection=None, batch_size=1000, pause=0.1, interval=60.0, on_progress=None):
+        self.retention = retention
+        self.collection = collection if collection is not None else main.myCollection
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.on_progress = on_progress
+        self.deleted = 0
+        self.rounds = 0
+        self.last_cutoff = None
+        self.errors = 0
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def purge_round(self, now=None):
+        """deletes one batch of expired messages
+
+        :param now: current time, defaults to the clock
+        :type now: datetime
+        :return: number of deleted messages
+        :rtype: int
+        """
+
+        now = now or datetime.now(timezone.utc)
+        cutoff = now - self.retention
+        self.last_cutoff = cutoff
+        expired = main.expired_filter(main.iso_timestamp(cutoff))
+        ids = [document["_id"] for document in self.collection.find(expired, {"_id": 1}).limit(self.batch_size)]
+        deleted = self.collection.delete_many({"_id": {"$in": ids}}).deleted_count if ids else 0
+        self.deleted += deleted
+        self.rounds += 1
+        if self.on_progress is not None:
+            self.on_progress(self.progress())
+        return deleted
+
+    def progress(self):
+        """reports how much has been purged so far
+
+        :return: deleted count, rounds, last cutoff, failed rounds, last error and whether the purger runs
+        :rtype: dict
+        """
+
+        return {"deleted": self.deleted, "rounds": self.rounds, "cutoff": self.last_cutoff,
+                "errors": self.errors, "last_error": self.last_error,
+                "running": self._thread is not None and self._thread.is_alive()}
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                deleted = self.purge_round()
+            except Exception as error:
+                # the thread must outlive a failed round or the purge silently stops
+                retentionLog.exception("purge round failed")
+                self.errors += 1
+                self.last_error = str(error)
+                failures += 1
+                self._stop.wait(min(self.interval, RETRY_DELAY * 2 ** (failures - 1)))
+                continue
+            failures = 0
+            self._stop.wait(self.pause if deleted >= self.batch_size else self.interval)
+
+    def start(self):
+        """starts purging in a background thread"""
+
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """stops the background thread after its current round"""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
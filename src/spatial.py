@@ -0,0 +1,247 @@
+"""An in-memory snapshot of the current vessel positions for the TMB (Traffic Monitoring Backend)
+
+   The latest report of every vessel is kept in contiguous NumPy arrays
+   (MMSI, lat, lon, timestamp, SoG, CoG) together with a grid index whose cells
+   line up with the mapview tiles of scale 3, so tile and bounding box queries
+   are answered without querying mongo. numpy is an optional dependency.
+"""
+
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import main
+
+CELL_LAT = 0.25
+CELL_LON = 0.5
+
+
+def iso_to_millis(timestamps):
+    """converts ISO timestamps ending in Z into milliseconds since the epoch
+
+    :param timestamps: UTC ISO timestamps
+    :type timestamps: list
+    :return: int64 array of milliseconds
+    :rtype: numpy.ndarray
+    """
+
+    return np.array([timestamp.rstrip("Z") for timestamp in timestamps], dtype="datetime64[ms]").astype(np.int64)
+
+
+class PositionSnapshot:
+    """vectorized store of the latest position of every vessel with a grid index
+
+    every vessel costs 36 bytes: uint32 MMSI, float64 lat/lon, int64 timestamp
+    and float32 SoG/CoG. The arrays are kept sorted by MMSI so updates locate
+    vessels with a binary search instead of a dict.
+    :param cell_lat: height of a grid cell in degrees
+    :type cell_lat: float
+    :param cell_lon: width of a grid cell in degrees
+    :type cell_lon: float
+    """
+
+    def __init__(self, cell_lat=CELL_LAT, cell_lon=CELL_LON):
+        if np is None:
+            raise ImportError("numpy is required for the in-memory position snapshot")
+        self.cell_lat = cell_lat
+        self.cell_lon = cell_lon
+        self._columns = int(np.ceil(360 / cell_lon))
+        self.mmsi = np.empty(0, dtype=np.uint32)
+        self.lat = np.empty(0, dtype=np.float64)
+        self.lon = np.empty(0, dtype=np.float64)
+        self.timestamp = np.empty(0, dtype=np.int64)
+        self.sog = np.empty(0, dtype=np.float32)
+        self.cog = np.empty(0, dtype=np.float32)
+        self._order = None
+        self._sorted_cells = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mmsi)
+
+    @property
+    def nbytes(self):
+        """number of bytes held by the column arrays"""
+
+        return sum(column.nbytes for column in (self.mmsi, self.lat, self.lon, self.timestamp, self.sog, self.cog))
+
+    def _cells(self, lat, lon):
+        rows = np.floor((lat + 90) / self.cell_lat).astype(np.int64)
+        columns = np.floor((lon + 180) / self.cell_lon).astype(np.int64)
+        return rows * self._columns + columns
+
+    def update(self, documents):
+        """merges AIS documents into the snapshot, keeping the newest report per vessel
+
+        documents without a Position in range are ignored like in main.newest_positions,
+        e.g. the 91/181 AIS sends when the position is not available. Positions are
+        stored latitude first.
+        :param documents: AIS documents
+        :type documents: list
+        :return: number of vessels added or moved
+        :rtype: int
+        """
+
+        reports = [document for document in documents
+                   if "MMSI" in document and "Timestamp" in document and main.position_location(document) is not None]
+        if not reports:
+            return 0
+        coordinates = np.array([report["Position"]["coordinates"] for report in reports], dtype=np.float64)
+        return self.update_arrays(np.array([report["MMSI"] for report in reports], dtype=np.uint32),
+                                  coordinates[:, 0], coordinates[:, 1],
+                                  iso_to_millis([report["Timestamp"] for report in reports]),
+                                  np.array([report.get("SoG", np.nan) for report in reports], dtype=np.float32),
+                                  np.array([report.get("CoG", np.nan) for report in reports], dtype=np.float32))
+
+    def update_arrays(self, mmsi, lat, lon, timestamp, sog, cog):
+        """merges position columns into the snapshot, keeping the newest report per vessel
+
+        :param mmsi: MMSI of every report
+        :type mmsi: numpy.ndarray
+        :param lat: latitude of every report
+        :type lat: numpy.ndarray
+        :param lon: longitude of every report
+        :type lon: numpy.ndarray
+        :param timestamp: milliseconds since the epoch of every report
+        :type timestamp: numpy.ndarray
+        :param sog: speed over ground of every report, NaN when missing
+        :type sog: numpy.ndarray
+        :param cog: course over ground of every report, NaN when missing
+        :type cog: numpy.ndarray
+        :return: number of vessels added or moved
+        :rtype: int
+        """
+
+        mmsi = np.asarray(mmsi, dtype=np.uint32)
+        timestamp = np.asarray(timestamp, dtype=np.int64)
+        if not len(mmsi):
+            return 0
+
+        # keep the newest report of each vessel inside the batch
+        order = np.lexsort((-timestamp, mmsi))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = mmsi[order][1:] != mmsi[order][:-1]
+        newest = order[first]
+        mmsi, timestamp = mmsi[newest], timestamp[newest]
+        lat = np.asarray(lat, dtype=np.float64)[newest]
+        lon = np.asarray(lon, dtype=np.float64)[newest]
+        sog = np.asarray(sog, dtype=np.float32)[newest]
+        cog = np.asarray(cog, dtype=np.float32)[newest]
+
+        with self._lock:
+            slots = np.searchsorted(self.mmsi, mmsi)
+            known = slots < len(self.mmsi)
+            known[known] = self.mmsi[slots[known]] == mmsi[known]
+
+            moved = known.copy()
+            moved[known] = timestamp[known] > self.timestamp[slots[known]]
+            targets = slots[moved]
+            self.lat[targets] = lat[moved]
+            self.lon[targets] = lon[moved]
+            self.timestamp[targets] = timestamp[moved]
+            self.sog[targets] = sog[moved]
+            self.cog[targets] = cog[moved]
+
+            new = ~known
+            if new.any():
+                self.mmsi = np.concatenate((self.mmsi, mmsi[new]))
+                self.lat = np.concatenate((self.lat, lat[new]))
+                self.lon = np.concatenate((self.lon, lon[new]))
+                self.timestamp = np.concatenate((self.timestamp, timestamp[new]))
+                self.sog = np.concatenate((self.sog, sog[new]))
+                self.cog = np.concatenate((self.cog, cog[new]))
+                by_mmsi = np.argsort(self.mmsi, kind="stable")
+                for name in ("mmsi", "lat", "lon", "timestamp", "sog", "cog"):
+                    setattr(self, name, getattr(self, name)[by_mmsi])
+
+            if moved.any() or new.any():
+                self._order = None
+            return int(moved.sum() + new.sum())
+
+    def load(self, collection=None):
+        """fills the snapshot from the latest positions collection
+
+        :param collection: collection holding one position document per MMSI
+        :type collection: pymongo.collection.Collection
+        :return: number of vessels in the snapshot
+        :rtype: int
+        """
+
+        collection = collection if collection is not None else main.latestPositions
+        projection = {"_id": 0, "MMSI": 1, "Position": 1, "Timestamp": 1, "SoG": 1, "CoG": 1}
+        for batch in main.iter_batches(collection.find({}, projection), main.DEFAULT_BATCH_SIZE):
+            self.update(batch)
+        return len(self)
+
+    def follow_ingest(self):
+        """keeps the snapshot up to date with every document stored through main"""
+
+        main.add_ingest_listener(self.update)
+
+    def stop_following(self):
+        """stops the updates started by follow_ingest"""
+
+        main.remove_ingest_listener(self.update)
+
+    def _index(self):
+        # the caller holds the lock
+        if self._order is None:
+            cells = self._cells(self.lat, self.lon)
+            self._order = np.argsort(cells, kind="stable")
+            self._sorted_cells = cells[self._order]
+        return self._order, self._sorted_cells
+
+    def query_bbox(self, west, south, east, north):
+        """finds the vessels inside a bounding box, edges included
+
+        the columns are read under the lock, an update arriving meanwhile cannot
+        mix other vessels into the result.
+        :param west: smallest longitude
+        :type west: float
+        :param south: smallest latitude
+        :type south: float
+        :param east: largest longitude
+        :type east: float
+        :param north: largest latitude
+        :type north: float
+        :return: array of MMSI and Position documents shaped like the mongo ones
+        :rtype: array
+        """
+
+        first_row = int(np.floor((south + 90) / self.cell_lat))
+        last_row = int(np.floor((north + 90) / self.cell_lat))
+        first_column = int(np.floor((west + 180) / self.cell_lon))
+        last_column = int(np.floor((east + 180) / self.cell_lon))
+        rows = np.arange(first_row, last_row + 1) * self._columns
+        if not len(rows):
+            return []
+        with self._lock:
+            order, sorted_cells = self._index()
+            starts = np.searchsorted(sorted_cells, rows + first_column, side="left")
+            ends = np.searchsorted(sorted_cells, rows + last_column, side="right")
+            candidates = order[np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])]
+            lat, lon = self.lat[candidates], self.lon[candidates]
+            inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+            mmsi = self.mmsi[candidates[inside]]
+            lat, lon = lat[inside], lon[inside]
+        return [{"MMSI": int(mmsi[index]), "Position": {"coordinates": [float(lat[index]), float(lon[index])]}}
+                for index in range(len(mmsi))]
+
+    def query_tile(self, tileId):
+        """finds the vessels inside a mapview tile, the bounds come from the reference cache
+
+        :param tileId: id of the mapview tile
+        :type tileId: int
+        :return: array of MMSI and Position documents, empty for an unknown tile
+        :rtype: array
+        """
+
+        if not isinstance(tileId, int):
+            raise TypeError('tileId must be an integer')
+        tile = main.find_tile(tileId)
+        if tile is None:
+            return []
+        return self.query_bbox(tile["west"], tile["south"], tile["east"], tile["north"])
@@ -1,6 +1,25 @@
+import json
+import queue
 import unittest
+import bson
 import pymongo
 import main
+import ingest
+import cache
+import asyncio
+import async_backend
+import spatial
+import retention
+import archive
+import tracks
+import benchmark
+import metrics
+import live
+import tiles
+import dedup
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
 
 myClient = pymongo.MongoClient("mongodb://localhost:27017")
 myDataBase = myClient["AISTestData"]
@@ -79,7 +98,7 @@ class TestStringMethods(unittest.TestCase):
         tmb = main.TrafficMonitoringBackEnd
         tmb.insert_batch_of_ais("AISMessages_2.json")
         result = tmb.delete_ais_by_timestamp(test_timestamp_one)
-        self.assertEqual("Number of Deletions: 3", result)
+        self.assertEqual("Number of Deletions: 2", result)
 
     def test_find_ports_with_name(self):
         tmb = main.TrafficMonitoringBackEnd
@@ -177,17 +196,35 @@ class TestStringMethods(unittest.TestCase):
         port = tmb.read_positions_with_id('2977')
         self.assertEqual({'coordinates': [56.493048, 8.598582]}, port[0]['Position'])
 
-    def test_get_png_to_binary(self):
+    def test_get_tile_png(self):
         tmb = main.TrafficMonitoringBackEnd
-        binary = tmb.get_tile_png(50371)
-        self.assertEqual('110011 111001 1000110 110111 110001 101110 1110000 1101110 1100111'
-                         , str(binary))
+        main.tileStore.put(50371, b"\x89PNG 50371", "43F91.png")
+        self.assertEqual(b"\x89PNG 50371", bytes(tmb.get_tile_png(50371)))
 
-    def test_get_png_to_binary(self):
+    def test_get_tile_not_modified(self):
         tmb = main.TrafficMonitoringBackEnd
-        binary = tmb.get_tile_png(53333)
-        self.assertEqual('110100 110001 1000111 110000 110011 101110 1110000 1101110 1100111'
-                         , str(binary))
+        etag = main.tileStore.put(53333, b"\x89PNG 53333")
+        self.assertIsNone(tmb.get_tile(53333, etag=etag))
+        self.assertEqual(etag, tmb.get_tile(53333, etag='"stale"').etag)
+
+    def test_not_modified_treats_naive_times_as_utc(self):
+        tile = tiles.Tile(1, b"", '"etag"', datetime(2020, 11, 18, 12, 0, 0, 500, tzinfo=timezone.utc))
+        self.assertTrue(tiles.not_modified(tile, modified_since=datetime(2020, 11, 18, 12, 0, 0)))
+        self.assertFalse(tiles.not_modified(tile, modified_since=datetime(2020, 11, 18, 11, 59, 59)))
+        self.assertTrue(tiles.not_modified(tile, modified_since=datetime(2020, 11, 18, 13, 0, 0,
+                                                                        tzinfo=timezone(timedelta(hours=1)))))
+
+    def test_disk_tile_store_maps_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = tiles.DiskTileStore(directory)
+            store.put(5237, b"\x89PNG 5237")
+            tile = store.get(5237)
+            self.assertIsInstance(tile.data, memoryview)
+            self.assertEqual(b"\x89PNG 5237", bytes(tile.data))
+            tile.data.release()
+            again = store.get(5237)
+            self.assertEqual(b"\x89PNG 5237", bytes(again.data))
+            again.data.release()
 
     def test_get_recent_vessel_position_tile(self):
         x = main.TrafficMonitoringBackEnd
@@ -231,3 +268,655 @@ class TestStringMethods(unittest.TestCase):
         tmb = main.TrafficMonitoringBackEnd
         ship_positions = tmb.read_positions_with_port_name("Struer", "Denmark")
         self.assertEqual({'coordinates': [56.493048, 8.598582]}, ship_positions[0]['Position'])
+
+    def test_stream_batch_of_ais(self):
+        tmb = main.TrafficMonitoringBackEnd
+        report = tmb.stream_batch_of_ais("AISMessages3.json", batch_size=4)
+        self.assertEqual(6, report["inserted"])
+        self.assertEqual([4, 2], [batch["size"] for batch in report["batches"]])
+
+    def test_iter_ais_file_matches_json_load(self):
+        with open("AISMessages.json") as file:
+            expected = json.load(file)
+        self.assertEqual(expected, list(main.iter_ais_file("AISMessages.json", chunk_size=16)))
+
+    def test_malformed_records_are_failures(self):
+        with open("AISMessages3.json") as file:
+            documents = json.load(file)[:2]
+        records = [json.dumps(documents[0]), '{"MMSI": 1, "Timestamp": tru, "Position": {"coordinates": [1, 2]}}',
+                   json.dumps(documents[1])]
+        with tempfile.TemporaryDirectory() as directory:
+            for name, text in (("array.json", "[" + ",\n".join(records) + "]"), ("lines.ndjson", "\n".join(records))):
+                with open(directory + "/" + name, "w") as file:
+                    file.write(text)
+                parsed = list(main.iter_ais_file(directory + "/" + name, chunk_size=16))
+                self.assertEqual(documents, [parsed[0], parsed[2]])
+                self.assertIsInstance(parsed[1], main.MalformedRecord)
+            report = main.TrafficMonitoringBackEnd.stream_batch_of_ais(directory + "/array.json")
+        self.assertEqual(2, report["inserted"])
+        self.assertEqual(1, report["failed"])
+        self.assertEqual([], report["errors"])
+
+    def test_ingest_pipeline_parallel_files(self):
+        pipeline = ingest.IngestPipeline(workers=2, writers=2, batch_size=2)
+        report = pipeline.run(["AISMessages.json", "AISMessages3.json"])
+        self.assertEqual(9, report["inserted"])
+        self.assertEqual(0, report["invalid"])
+
+    def test_parse_task_puts_batches_as_they_fill(self):
+        results = queue.Queue()
+        ingest.init_worker(results)
+        try:
+            put, invalid, error = ingest.parse_task(("AISMessages3.json", 0, None), 2)
+        finally:
+            ingest.init_worker(None)
+        self.assertEqual((3, 0, None), (put, invalid, error))
+        self.assertEqual(3, results.qsize())
+
+    def test_ingest_pipeline_truncated_array(self):
+        with open("AISMessages3.json") as file:
+            documents = json.load(file)
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + "/truncated.json"
+            with open(path, "w") as file:
+                file.write(json.dumps(documents)[:-40])
+            report = ingest.IngestPipeline(workers=2, batch_size=2).run([path, "AISMessages.json"])
+        self.assertEqual(len(documents) - 1 + 3, report["inserted"])
+        self.assertEqual(1, report["invalid"])
+        self.assertEqual([], report["errors"])
+
+    def test_ingest_pipeline_ndjson_ranges(self):
+        with open("AISMessages3.json") as file:
+            documents = json.load(file)
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + "/AISMessages3.ndjson"
+            with open(path, "w") as file:
+                file.writelines(json.dumps(dict(document, Timestamp="1903-01-01T00:00:0" + str(index) + ".000Z"))
+                                + "\n" for index, document in enumerate(documents))
+            report = ingest.IngestPipeline(workers=2, batch_size=2, range_size=256).run(path)
+        self.assertEqual(len(documents), report["inserted"])
+        self.assertEqual(0, report["failed"])
+
+    def test_buffered_single_ais_insertion(self):
+        with main.BufferedAISWriter(max_batch=2, max_delay=0.01) as writer:
+            results = [writer.write(dict(test_ais)), writer.write(dict(test_ais_two)), writer.write("")]
+        self.assertEqual(["Success: 1", "Success: 1", "Failure: 0"], [result.result() for result in results])
+
+    def test_buffered_writer_survives_cancelled_futures(self):
+        with main.BufferedAISWriter(max_batch=10, max_delay=60) as writer:
+            cancelled = writer.write(dict(test_ais_two))
+            self.assertTrue(cancelled.cancel())
+            writer.flush()
+            result = writer.write(dict(test_ais_two))
+            writer.flush()
+            self.assertEqual("Success: 1", result.result(timeout=5))
+
+    def test_no_query_uses_collection_scan(self):
+        main.ensure_indexes()
+        self.assertEqual({}, main.find_collection_scans())
+
+    def test_position_not_available_is_stored(self):
+        main.ensure_indexes()
+        report = {"Timestamp": "2020-11-18T00:02:00.000Z", "Class": "Class A", "MMSI": 219999997,
+                  "MsgType": "position_report", "Position": {"type": "Point", "coordinates": [56.0, 120.5]},
+                  "Status": "Under way using engine", "SoG": 0.0, "CoG": 360.0, "Heading": 511}
+        not_available = dict(report, Timestamp="2020-11-18T00:03:00.000Z",
+                             Position={"type": "Point", "coordinates": [91.0, 181.0]})
+        try:
+            self.assertEqual("Success: 1", main.TrafficMonitoringBackEnd.insert_single_ais(report))
+            self.assertEqual("Success: 1", main.TrafficMonitoringBackEnd.insert_single_ais(not_available))
+            self.assertEqual(2, main.myCollection.count_documents({"MMSI": 219999997}))
+            latest = main.latestPositions.find_one({"MMSI": 219999997}, {"_id": 0, "Timestamp": 1, "Location": 1})
+            self.assertEqual({"Timestamp": "2020-11-18T00:02:00.000Z",
+                              "Location": {"type": "Point", "coordinates": [120.5, 56.0]}}, latest)
+        finally:
+            main.myCollection.delete_many({"MMSI": 219999997})
+            main.latestPositions.delete_many({"MMSI": 219999997})
+
+    def test_plan_stages(self):
+        plan = {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}
+        self.assertEqual(["LIMIT", "FETCH", "IXSCAN"], main.plan_stages(plan))
+
+    def test_latest_position_only_moves_forward(self):
+        tmb = main.TrafficMonitoringBackEnd
+        tmb.insert_single_ais(dict(test_ais_three))
+        tmb.insert_single_ais(dict(test_ais_two))
+        latest = main.latestPositions.find_one({"MMSI": 244265000}, {"_id": 0, "Timestamp": 1})
+        self.assertEqual({"Timestamp": "2040-11-18T00:02:00.000Z"}, latest)
+
+    def test_tile_filter_uses_geo_within(self):
+        tile = {'west': 9.0, 'south': 57.25, 'east': 9.5, 'north': 57.5}
+        query = main.tile_filter(tile)
+        polygon = query["Location"]["$geoWithin"]["$geometry"]
+        self.assertEqual("Polygon", polygon["type"])
+        (west, south), (_, north), (east, _) = polygon["coordinates"][0][:3]
+        # the southern great circle edge bows about 28 m north, the polygon starts below it
+        self.assertLess(south, 57.25 - 0.0002)
+        self.assertTrue(west < 9.0 and east > 9.5 and north > 57.5)
+        self.assertEqual({"$gte": 9.0, "$lte": 9.5}, query["Location.coordinates.0"])
+        self.assertEqual({"$gte": 57.25, "$lte": 57.5}, query["Location.coordinates.1"])
+
+    def test_get_recent_vessel_position_tile_unknown_tile(self):
+        self.assertEqual([], main.TrafficMonitoringBackEnd.get_recent_vessel_position_tile(-1))
+
+        async def fetch():
+            backend = async_backend.AsyncTrafficMonitoringBackEnd()
+            try:
+                return await backend.get_recent_vessel_position_tile(-1)
+            finally:
+                await backend.close()
+
+        self.assertEqual([], asyncio.run(fetch()))
+
+    def test_reference_cache_hits_after_first_lookup(self):
+        main.invalidate_reference_cache()
+        x = main.TrafficMonitoringBackEnd
+        first = x.get_tiles_of_map_tile(5237)
+        hits = main.reference_cache_stats()["child_tiles"]["hits"]
+        second = x.get_tiles_of_map_tile(5237)
+        self.assertEqual(first, second)
+        self.assertEqual(hits + 1, main.reference_cache_stats()["child_tiles"]["hits"])
+
+    def test_reference_cache_expires_after_configured_ttl(self):
+        mapview_id = main.myMapViews.find_one({}, {"id": 1})["id"]
+        try:
+            main.configure(reference_ttl=0.05)
+            main.preload_reference_data()
+            self.assertIsNotNone(main.tileCache.get(mapview_id))
+            time.sleep(0.1)
+            self.assertIsNone(main.tileCache.get(mapview_id))
+            main.configure(**main.DEFAULT_SETTINGS)
+            main.preload_reference_data(ttl=0.05)
+            self.assertIsNotNone(main.tileCache.get(mapview_id))
+            time.sleep(0.1)
+            self.assertIsNone(main.tileCache.get(mapview_id))
+        finally:
+            main.configure(**main.DEFAULT_SETTINGS)
+        self.assertIsNone(main.tileCache.ttl)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.put(1, "a")
+        lru.put(2, "b")
+        lru.get(1)
+        lru.put(3, "c")
+        self.assertIsNone(lru.get(2))
+        self.assertEqual("a", lru.get(1))
+
+    def test_async_backend_matches_sync_tiles(self):
+        async def fetch():
+            backend = async_backend.AsyncTrafficMonitoringBackEnd()
+            try:
+                return await backend.get_tiles_of_map_tile(5237)
+            finally:
+                await backend.close()
+
+        self.assertEqual(main.TrafficMonitoringBackEnd.get_tiles_of_map_tile(5237), asyncio.run(fetch()))
+
+    def test_async_backend_invalid_tile_data_type(self):
+        backend = async_backend.AsyncTrafficMonitoringBackEnd()
+        with self.assertRaises(TypeError):
+            asyncio.run(backend.get_recent_vessel_position_tile("5237"))
+
+    def test_position_snapshot_keeps_newest_report(self):
+        snapshot = spatial.PositionSnapshot()
+        snapshot.update([test_ais_three, test_ais_two, test_recent_postions[1]])
+        self.assertEqual(2, len(snapshot))
+        found = snapshot.query_bbox(15.0, 55.5, 15.5, 55.75)
+        self.assertEqual([{'MMSI': 244265000, 'Position': {'coordinates': [55.522592, 15.068637]}}], found)
+
+    def test_position_snapshot_ignores_position_not_available(self):
+        snapshot = spatial.PositionSnapshot()
+        snapshot.update([test_ais_two])
+        snapshot.update([dict(test_ais_three, Position={"type": "Point", "coordinates": [91, 181]})])
+        found = snapshot.query_bbox(15.0, 55.5, 15.5, 55.75)
+        self.assertEqual([{'MMSI': 244265000, 'Position': {'coordinates': [55.522592, 15.068637]}}], found)
+
+    def test_position_snapshot_unknown_tile(self):
+        snapshot = spatial.PositionSnapshot()
+        snapshot.update([test_ais_two])
+        self.assertEqual([], snapshot.query_tile(-1))
+
+    def test_position_snapshot_query_survives_updates(self):
+        snapshot = spatial.PositionSnapshot()
+        snapshot.update([dict(test_ais_three, MMSI=500)])
+        found = snapshot.query_bbox(15.0, 55.5, 15.5, 55.75)
+        snapshot.update([dict(test_ais_three, MMSI=100, Position={"coordinates": [10.0, 10.0]})])
+        self.assertEqual([500], [vessel["MMSI"] for vessel in found])
+        self.assertEqual([500], [vessel["MMSI"] for vessel in snapshot.query_bbox(15.0, 55.5, 15.5, 55.75)])
+
+    def test_read_positions_pages_resume_after_last_mmsi(self):
+        tmb = main.TrafficMonitoringBackEnd
+        everything = tmb.read_all_ship_positions("Struer", "Denmark", limit=1000)
+        first = tmb.read_all_ship_positions("Struer", "Denmark", limit=1)
+        rest = tmb.read_all_ship_positions("Struer", "Denmark", after=first[-1]["MMSI"], stream=True)
+        self.assertEqual(everything, first + list(rest))
+
+    def test_find_all_ports_stream(self):
+        tmb = main.TrafficMonitoringBackEnd
+        ports = tmb.find_all_ports("Struer", "Denmark", batch_size=10, stream=True)
+        self.assertEqual(tmb.find_all_ports("Struer", "Denmark"), list(ports))
+
+    def test_bucketed_store_drops_expired_days(self):
+        store = retention.BucketedStore(prefix="test_ais_", bucket="day")
+        with open("AISMessages_2.json") as file:
+            store.insert(json.load(file))
+        dropped = store.drop_expired(datetime(1801, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(["test_ais_18001118"], dropped)
+
+    def test_purger_deletes_expired_messages(self):
+        tmb = main.TrafficMonitoringBackEnd
+        tmb.insert_batch_of_ais("AISMessages_2.json")
+        purger = retention.Purger(timedelta(days=30))
+        deleted = purger.purge_round(now=datetime(1801, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(2, deleted)
+
+    def test_purger_survives_failed_rounds(self):
+        class Collection:
+            def find(self, *args, **kwargs):
+                raise pymongo.errors.AutoReconnect("server down")
+
+        purger = retention.Purger(timedelta(days=30), collection=Collection(), interval=0.01)
+        purger.start()
+        try:
+            for _ in range(100):
+                if purger.progress()["errors"] >= 2:
+                    break
+                time.sleep(0.01)
+            progress = purger.progress()
+        finally:
+            purger.stop()
+        self.assertGreaterEqual(progress["errors"], 2)
+        self.assertEqual("server down", progress["last_error"])
+        self.assertTrue(progress["running"])
+
+    def test_purger_cutoff_in_other_time_zone(self):
+        collection = main.myDataBase["purge_scratch"]
+        collection.insert_one({"Timestamp": "1800-12-01T00:30:00.000Z", "MMSI": 1, "MsgType": "position_report"})
+        try:
+            purger = retention.Purger(timedelta(days=30), collection=collection)
+            deleted = purger.purge_round(now=datetime(1801, 1, 1, tzinfo=timezone(timedelta(hours=1))))
+        finally:
+            collection.drop()
+        self.assertEqual(1, deleted)
+
+    def test_archive_table_round_trip(self):
+        table = archive.to_table([test_ais], "position_report")
+        documents = archive.to_documents(table.to_batches()[0], "position_report")
+        self.assertEqual(test_ais["Position"], documents[0]["Position"])
+        self.assertEqual(test_ais["Timestamp"], documents[0]["Timestamp"])
+
+    def test_archive_exports_static_data_from_vessels(self):
+        tmb = main.TrafficMonitoringBackEnd
+        tmb.insert_batch_of_ais("AISMessages.json")
+        with tempfile.TemporaryDirectory() as directory:
+            exported = archive.export_archive(directory, "static_data", {"MMSI": 210169000})
+            documents = [document for batch in archive.iter_archive(directory, "static_data") for document in batch]
+        self.assertEqual(1, exported)
+        self.assertEqual(("KATHARINA SCHEPERS", "static_data"), (documents[0]["Name"], documents[0]["MsgType"]))
+
+    def test_archive_table_nulls_values_of_another_type(self):
+        statics = [dict(test_recent_postions[2], IMO="Unknown"), test_recent_postions[2]]
+        table = archive.to_table(statics, "static_data")
+        self.assertEqual([None, 9584865], table.column("IMO").to_pylist())
+        self.assertEqual(["KATHARINA SCHEPERS"] * 2, table.column("Name").to_pylist())
+
+    def test_archive_exports_vessels_without_timestamp(self):
+        main.vessels.delete_one({"MMSI": 219999992})
+        main.vessels.insert_one({"MMSI": 219999992, "Name": "UNDATED"})
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                exported = archive.export_archive(directory, "static_data", {"MMSI": 219999992})
+                documents = [document for batch in archive.iter_archive(directory, "static_data")
+                             for document in batch]
+        finally:
+            main.vessels.delete_one({"MMSI": 219999992})
+        self.assertEqual(1, exported)
+        self.assertEqual([{"MMSI": 219999992, "MsgType": "static_data", "Name": "UNDATED"}], documents)
+
+    def test_get_vessel_track_in_time_order(self):
+        tmb = main.TrafficMonitoringBackEnd
+        tmb.insert_single_ais(dict(test_ais_two))
+        tmb.insert_single_ais(dict(test_ais_three))
+        track = tracks.get_vessel_track(244265000, "1900-01-01T00:00:00.000Z", "2050-01-01T00:00:00.000Z")
+        timestamps = [position["Timestamp"] for position in track]
+        self.assertEqual(sorted(timestamps), timestamps)
+
+    def test_get_vessel_track_buckets_before_1970(self):
+        reports = [{"MMSI": 219999993, "MsgType": "position_report", "Timestamp": timestamp,
+                    "Position": {"type": "Point", "coordinates": [55.0, 12.0]}}
+                   for timestamp in ("1902-11-18T00:00:00.000Z", "1902-11-18T00:00:30.000Z")]
+        main.myCollection.insert_many(reports)
+        try:
+            track = tracks.get_vessel_track(219999993, "1902-11-17T00:00:00.000Z", "1902-11-19T00:00:00.000Z",
+                                            bucket_seconds=60)
+        finally:
+            main.myCollection.delete_many({"MMSI": 219999993})
+        self.assertEqual(["1902-11-18T00:00:30.000Z"], [position["Timestamp"] for position in track])
+
+    def test_simplify_track_drops_collinear_points(self):
+        track = [{"Position": {"coordinates": [55.0 + index * 0.01, 10.0 + index * 0.01]}} for index in range(10)]
+        self.assertEqual([track[0], track[-1]], tracks.simplify_track(track, 0.0001))
+
+    def test_get_vessel_cards_in_requested_order(self):
+        tmb = main.TrafficMonitoringBackEnd
+        tmb.insert_single_ais(dict(test_ais))
+        tmb.insert_single_ais(dict(test_recent_postions[1]))
+        cards = tmb.get_vessel_cards([220490000, 244265000])
+        self.assertEqual([220490000, 244265000], [card["MMSI"] for card in cards])
+
+    def test_get_vessel_card_invalid_data_type(self):
+        tmb = main.TrafficMonitoringBackEnd
+        with self.assertRaises(TypeError):
+            tmb.get_vessel_card("244265000")
+
+    def test_benchmark_tiles_have_four_children(self):
+        tiles = benchmark.generate_tiles()
+        for parent in [tile["id"] for tile in tiles if tile["contained_by"] == 1]:
+            self.assertEqual(4, len([tile for tile in tiles if tile["contained_by"] == parent]))
+
+    def test_benchmark_refuses_default_database(self):
+        with self.assertRaises(ValueError):
+            benchmark.run(vessel_count=1, minutes=1, rate=1, iterations=1)
+        self.assertGreater(main.myMapViews.count_documents({}), 0)
+
+    def test_benchmark_compare_flags_slower_queries(self):
+        baseline = {"queries": {"find_all_ports": benchmark.percentiles([0.001, 0.001])}}
+        current = {"queries": {"find_all_ports": benchmark.percentiles([0.002, 0.002])}}
+        self.assertEqual({"p50_ms", "p99_ms"}, {metric for _, metric, _, _ in benchmark.compare(baseline, current)})
+
+    def test_metrics_records_backend_calls(self):
+        tmb = main.TrafficMonitoringBackEnd
+        metrics.queryMetrics.reset()
+        metrics.enable()
+        try:
+            tmb.get_tiles_of_map_tile(5237)
+            with self.assertRaises(TypeError):
+                tmb.get_recent_vessel_position_mmsi("244265000")
+        finally:
+            metrics.disable()
+        methods = metrics.queryMetrics.stats()["methods"]
+        self.assertEqual(1, methods["get_tiles_of_map_tile"]["calls"])
+        self.assertEqual(1, methods["get_recent_vessel_position_mmsi"]["errors"])
+
+    def test_metrics_prometheus_histogram(self):
+        registry = metrics.Metrics()
+        registry.record_command("find", "ports", 0.003, documents=2, reply_bytes=100)
+        text = registry.prometheus()
+        self.assertIn('tmb_mongo_command_seconds_bucket{command="find",collection="ports",le="0.005"} 1', text)
+        self.assertIn('tmb_mongo_reply_bytes_total{command="find",collection="ports"} 100', text)
+
+    def test_reply_size_estimates_cursor_batches(self):
+        document = {"MMSI": 244265000, "Position": {"coordinates": [55.522592, 15.068637]}}
+        reply = {"cursor": {"firstBatch": [document] * 100, "id": 0, "ns": "AISTestData.latest_positions"}, "ok": 1}
+        self.assertEqual(100 * len(bson.encode(document)), metrics.reply_size(reply))
+        self.assertEqual(len(bson.encode({"n": 1, "ok": 1})), metrics.reply_size({"n": 1, "ok": 1}))
+
+    def test_live_subscription_coalesces_per_vessel(self):
+        hub = live.PositionHub()
+        subscription = hub.subscribe(mmsis=[244265000])
+        hub.publish([dict(test_ais_two), dict(test_ais_three), dict(test_ais)])
+        updates = subscription.get(timeout=0)
+        self.assertEqual(1, len(updates))
+        self.assertEqual(max(test_ais_two["Timestamp"], test_ais_three["Timestamp"]), updates[0]["Timestamp"])
+
+    def test_live_skips_position_not_available(self):
+        hub = live.PositionHub()
+        subscription = hub.subscribe(mmsis=[244265000])
+        hub.publish([dict(test_ais_three, Position={"type": "Point", "coordinates": [91, 181]})])
+        self.assertEqual([], subscription.get(timeout=0))
+
+    def test_live_change_stream_retries_reopening(self):
+        class Collection:
+            watches = 0
+
+            def watch(self, *args, **kwargs):
+                Collection.watches += 1
+                if Collection.watches == 2:
+                    hub.stop()
+                raise pymongo.errors.AutoReconnect("server down")
+
+        hub = live.PositionHub()
+        hub._tail(Collection(), None)
+        self.assertEqual(2, Collection.watches)
+
+    def test_live_subscribe_unknown_tile(self):
+        hub = live.PositionHub()
+        with self.assertRaises(ValueError):
+            hub.subscribe_tile(-1)
+        self.assertEqual(0, len(hub))
+
+    def test_live_bbox_subscription_follows_ingest(self):
+        hub = live.PositionHub()
+        inside = hub.subscribe((15.0, 55.0, 16.0, 56.0))
+        outside = hub.subscribe((0.0, 0.0, 1.0, 1.0))
+        hub.follow_ingest()
+        try:
+            main.notify_ingest([dict(test_recent_postions[0])])
+        finally:
+            hub.stop()
+        self.assertEqual([test_recent_postions[0]["MMSI"]], [update["MMSI"] for update in inside.get(timeout=0)])
+        self.assertEqual([], outside.get(timeout=0))
+
+    def test_failing_listener_gets_stored_reports_after_latest_update(self):
+        report = dict(test_ais, MMSI=219999998, Timestamp="2041-01-01T00:00:00.000Z")
+        seen = []
+
+        def listener(documents):
+            seen.append(main.latestPositions.find_one({"MMSI": 219999998}, {"_id": 0, "Timestamp": 1}))
+            raise ValueError("listener failure")
+
+        main.add_ingest_listener(listener)
+        try:
+            with self.assertLogs("tmb.ingest"):
+                self.assertEqual(1, main.update_latest_positions([report]))
+        finally:
+            main.remove_ingest_listener(listener)
+            main.latestPositions.delete_one({"MMSI": 219999998})
+        self.assertEqual([{"Timestamp": "2041-01-01T00:00:00.000Z"}], seen)
+
+    def test_configure_read_preference_and_ingest_write_concern(self):
+        try:
+            main.configure(read_preference="secondaryPreferred", ingest_w=0, max_pool_size=10)
+            self.assertEqual("secondaryPreferred", main.myCollection.read_preference.mongos_mode)
+            self.assertFalse(main.ingestCollection.write_concern.acknowledged)
+            self.assertEqual(10, main.myClient.options.pool_options.max_pool_size)
+        finally:
+            main.configure(**main.DEFAULT_SETTINGS)
+
+    def test_configure_reuses_or_closes_its_client(self):
+        client = main.myClient
+        try:
+            main.configure(deduplicate=False)
+            self.assertIs(client, main.myClient)
+            main.configure(max_pool_size=10)
+            self.assertIsNot(client, main.myClient)
+            with self.assertRaises(pymongo.errors.InvalidOperation):
+                client.admin.command("ping")
+        finally:
+            main.configure(**main.DEFAULT_SETTINGS)
+
+    def test_configure_unknown_setting(self):
+        with self.assertRaises(TypeError):
+            main.configure(pool_size=10)
+
+    def test_report_window_drops_copies(self):
+        window = dedup.ReportWindow(capacity=4)
+        reports = [dict(test_ais, MMSI=mmsi) for mmsi in range(6)]
+        self.assertEqual(6, len(window.filter(reports + reports[4:])))
+        self.assertEqual(2, window.stats()["dropped"])
+        self.assertLessEqual(len(window), 4)
+
+    def test_stream_batch_deduplicates(self):
+        tmb = main.TrafficMonitoringBackEnd
+        try:
+            main.configure(deduplicate=True)
+            tmb.stream_batch_of_ais("AISMessages.json")
+            report = tmb.stream_batch_of_ais("AISMessages.json")
+            # the repeated static data still brings its vessel up to date, only position reports are copies
+            self.assertEqual(1, report["inserted"])
+            self.assertEqual(2, report["duplicates"])
+        finally:
+            main.configure(**main.DEFAULT_SETTINGS)
+
+    def test_async_insert_deduplicates(self):
+        async def insert_twice():
+            backend = async_backend.AsyncTrafficMonitoringBackEnd()
+            try:
+                await backend.insert_batch_of_ais("AISMessages.json")
+                return await backend.insert_batch_of_ais("AISMessages.json"), \
+                    await backend.insert_single_ais(dict(test_recent_postions[0]))
+            finally:
+                await backend.close()
+
+        try:
+            main.configure(deduplicate=True)
+            main.reportWindow.is_duplicate(dict(test_recent_postions[0]))
+            batch, single = asyncio.run(insert_twice())
+            self.assertEqual("Number of Insertions: 1", batch)
+            self.assertEqual("Success: 1", single)
+            self.assertEqual(3, main.dedup_stats()["dropped"])
+        finally:
+            main.configure(**main.DEFAULT_SETTINGS)
+
+    def test_async_insert_goes_on_when_vessels_reject_static_data(self):
+        async def insert():
+            backend = async_backend.AsyncTrafficMonitoringBackEnd()
+            database = backend.vessels.database
+            try:
+                await database.drop_collection("rejecting_vessels")
+                await database.create_collection("rejecting_vessels", validator={"MMSI": {"$exists": False}})
+                backend.vessels = database["rejecting_vessels"]
+                return await backend.insert_batch_of_ais("AISMessages.json")
+            finally:
+                await database.drop_collection("rejecting_vessels")
+                await backend.close()
+
+        self.assertEqual("Number of Insertions: 2", asyncio.run(insert()))
+
+    def test_async_latest_positions_reject_stale_reports_on_fresh_database(self):
+        async def update_twice():
+            backend = async_backend.AsyncTrafficMonitoringBackEnd(database="AISTestScratch")
+            try:
+                await backend.client.drop_database("AISTestScratch")
+                report = dict(test_recent_postions[0])
+                await backend.update_latest_positions([report])
+                await backend.update_latest_positions([dict(report, Timestamp="2020-11-17T00:00:00.000Z")])
+                return await backend.latest.count_documents({"MMSI": test_recent_postions[0]["MMSI"]})
+            finally:
+                await backend.client.drop_database("AISTestScratch")
+                await backend.close()
+
+        self.assertEqual(1, asyncio.run(update_twice()))
+
+    def test_async_vessel_update_refreshes_cache(self):
+        static = {"Timestamp": "2020-01-01T00:00:00.000Z", "MMSI": 219999996, "MsgType": "static_data",
+                  "Destination": "DKAAR"}
+
+        async def update(message):
+            backend = async_backend.AsyncTrafficMonitoringBackEnd()
+            try:
+                return await backend.update_vessels([message])
+            finally:
+                await backend.close()
+
+        try:
+            main.update_vessels([static])
+            asyncio.run(update(dict(static, Timestamp="2020-01-02T00:00:00.000Z", Destination="DKSTR")))
+            self.assertEqual(1, main.update_vessels([dict(static, Timestamp="2020-01-03T00:00:00.000Z")]))
+        finally:
+            main.vessels.delete_one({"MMSI": 219999996})
+            main.vesselCache.invalidate(219999996)
+
+    def test_static_data_goes_to_vessels(self):
+        tmb = main.TrafficMonitoringBackEnd
+        stored = main.myCollection.count_documents({"MsgType": "static_data"})
+        tmb.insert_batch_of_ais("AISMessages.json")
+        self.assertEqual(stored, main.myCollection.count_documents({"MsgType": "static_data"}))
+        vessel = main.vessels.find_one({"MMSI": 210169000}, {"_id": 0, "Name": 1, "Destination": 1})
+        self.assertEqual({"Name": "KATHARINA SCHEPERS", "Destination": "NODRM"}, vessel)
+
+    def test_unchanged_static_data_is_not_written(self):
+        static = {"Timestamp": "2020-11-18T00:00:00.000Z", "MMSI": 210169000, "MsgType": "static_data",
+                  "IMO": 9584865, "Name": "KATHARINA SCHEPERS"}
+        operations, changed = main.vessel_updates([static], {})
+        self.assertEqual(1, len(operations))
+        self.assertEqual(([], {}), main.vessel_updates([dict(static, Timestamp="2020-11-18T01:00:00.000Z")], changed))
+
+    def test_stale_static_data_does_not_overwrite_vessel(self):
+        static = {"Timestamp": "2020-11-18T02:00:00.000Z", "MMSI": 219999995, "MsgType": "static_data",
+                  "Destination": "DKAAR"}
+        try:
+            main.update_vessels([static])
+            # a writer that read the vessel before the newer message was stored
+            operations, changed = main.vessel_updates(
+                [dict(static, Timestamp="2020-11-18T01:00:00.000Z", Destination="DKSTR")], {})
+            with self.assertRaises(pymongo.errors.BulkWriteError) as raised:
+                main.vessels.bulk_write(operations, ordered=False)
+            self.assertEqual([219999995], main.stale_vessels(raised.exception, changed))
+            self.assertEqual([{"Destination": "DKAAR"}],
+                             list(main.vessels.find({"MMSI": 219999995}, {"_id": 0, "Destination": 1})))
+        finally:
+            main.vessels.delete_one({"MMSI": 219999995})
+            main.vesselCache.invalidate(219999995)
+
+    def test_get_viewport_matches_tile_queries(self):
+        x = main.TrafficMonitoringBackEnd
+        viewport = x.get_viewport(5237)
+        self.assertEqual([52371, 52372, 52373, 52374], [tile["id"] for tile in viewport])
+        for tile in viewport:
+            expected = sorted(vessel["MMSI"] for vessel in x.get_recent_vessel_position_tile(tile["id"]))
+            self.assertEqual(expected, sorted(vessel["MMSI"] for vessel in tile["vessels"]))
+
+    def test_get_viewport_keeps_vessels_near_tile_edges(self):
+        x = main.TrafficMonitoringBackEnd
+        parent = main.find_tile(5237)
+        # inside the band the great circle edge of a parent polygon bows over
+        lat, lon = parent["south"] + 0.0005, parent["west"] + (parent["east"] - parent["west"]) / 4
+        report = dict(test_ais, MMSI=219999993, Timestamp="2040-11-18T00:02:00.000Z",
+                      Position={"type": "Point", "coordinates": [lat, lon]})
+        try:
+            main.update_latest_positions([report])
+            viewport = {tile["id"]: [vessel["MMSI"] for vessel in tile["vessels"]] for tile in x.get_viewport(5237)}
+            holding = [tile_id for tile_id, mmsis in viewport.items() if 219999993 in mmsis]
+            self.assertEqual(1, len(holding))
+            self.assertIn(219999993, [vessel["MMSI"] for vessel in x.get_recent_vessel_position_tile(holding[0])])
+        finally:
+            main.latestPositions.delete_one({"MMSI": 219999993})
+
+    def test_partition_by_tile_includes_edges(self):
+        tiles = [{"id": 1, "west": 9.0, "south": 57.25, "east": 9.5, "north": 57.5},
+                 {"id": 2, "west": 9.5, "south": 57.25, "east": 10.0, "north": 57.5}]
+        positions = [{"MMSI": 1, "Position": {"coordinates": [57.3, 9.2]}},
+                     {"MMSI": 2, "Position": {"coordinates": [57.3, 9.5]}}]
+        viewport = main.partition_by_tile(tiles, positions)
+        self.assertEqual([[1, 2], [2]], [[vessel["MMSI"] for vessel in tile["vessels"]] for tile in viewport])
+
+    def test_destination_code_normalizes_free_text(self):
+        code = main.find_port_code({"port_location": "Struer", "country": "Denmark"})
+        self.assertEqual(code, main.destination_code(code[:2].lower() + "-" + code[2:].lower()))
+        self.assertEqual(code, main.destination_code("SEGOT>" + code))
+        self.assertEqual(code, main.destination_code("Struer"))
+        self.assertIsNone(main.destination_code("FOR ORDERS"))
+
+    def test_get_inbound_traffic_finds_vessels_headed_to_port(self):
+        tmb = main.TrafficMonitoringBackEnd
+        code = main.find_port_code({"port_location": "Struer", "country": "Denmark"})
+        static = {"Timestamp": "2020-11-18T00:00:00.000Z", "MMSI": 219999999, "MsgType": "static_data",
+                  "Name": "INBOUND TEST", "Destination": code.lower(), "ETA": "2020-11-19T09:00:00.000Z"}
+        try:
+            main.update_vessels([static])
+            inbound = tmb.get_inbound_traffic(port_name="Struer", country="Denmark", eta_from="2020-11-19T00:00:00Z")
+            self.assertIn(219999999, [vessel["MMSI"] for vessel in inbound])
+            due = tmb.get_inbound_traffic(port_name="Struer", country="Denmark", eta_from="2020-11-19T09:00:00Z",
+                                          eta_to="2020-11-19T09:00:00Z")
+            self.assertIn(219999999, [vessel["MMSI"] for vessel in due])
+            early = tmb.get_inbound_traffic(port_name="Struer", country="Denmark", eta_to="2020-11-18T00:00:00Z")
+            self.assertNotIn(219999999, [vessel["MMSI"] for vessel in early])
+        finally:
+            main.vessels.delete_one({"MMSI": 219999999})
+            main.vesselCache.invalidate(219999999)
+
+    def test_iso_timestamp_normalizes_strings(self):
+        self.assertEqual("2020-11-19T09:00:00.000Z", main.iso_timestamp("2020-11-19T09:00:00Z"))
+        self.assertEqual("2020-11-19T08:00:00.000Z", main.iso_timestamp("2020-11-19T09:00:00+01:00"))
@@ -0,0 +1,237 @@
+"""Tile PNG store for the TMB (Traffic Monitoring Backend)
+
+   Keeps the PNG bytes of the mapview tiles either in GridFS or as files in a
+   local directory that are memory-mapped, so serving a tile returns the stored
+   bytes without a sort or any transformation. Every tile has an ETag and a
+   last modified time for conditional fetches, and recently served tiles are
+   kept in an in-memory LRU cache.
+"""
+
+import abc
+import hashlib
+import mmap
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import gridfs
+import pymongo
+
+from cache import LRUCache
+
+Tile = namedtuple("Tile", ["mapview_id", "data", "etag", "last_modified"])
+Tile.__doc__ = """PNG data of a mapview tile: bytes or a read-only memoryview, its ETag and its last modified time"""
+
+HOT_TILES = 1024
+
+
+def content_etag(data):
+    """strong ETag of tile data, a quoted sha1 of the bytes"""
+
+    return '"' + hashlib.sha1(data).hexdigest() + '"'
+
+
+def file_etag(status):
+    """ETag of a tile file built from its size and modification time, like static file servers"""
+
+    return '"' + format(status.st_size, "x") + "-" + format(status.st_mtime_ns, "x") + '"'
+
+
+def not_modified(tile, etag=None, modified_since=None):
+    """decides whether a client's copy of a tile is still current, like an HTTP conditional GET
+
+    :param tile: the stored tile
+    :type tile: Tile
+    :param etag: ETag of the client's copy (If-None-Match)
+    :type etag: str
+    :param modified_since: last modified time of the client's copy (If-Modified-Since), naive times are UTC
+    :type modified_since: datetime
+    :return: True when the client's copy can be used
+    :rtype: bool
+    """
+
+    if etag is not None:
+        return etag == tile.etag
+    if modified_since is not None:
+        if modified_since.tzinfo is None:
+            modified_since = modified_since.replace(tzinfo=timezone.utc)
+        return tile.last_modified.replace(microsecond=0) <= modified_since.astimezone(timezone.utc)
+    return False
+
+
+class TileStore(abc.ABC):
+    """the cache and conditional fetch logic shared by the tile stores
+
+    subclasses implement load and save.
+    :param hot_tiles: number of tiles kept in memory
+    :type hot_tiles: int
+    """
+
+    def __init__(self, hot_tiles=HOT_TILES):
+        self.cache = LRUCache(maxsize=hot_tiles)
+
+    @abc.abstractmethod
+    def load(self, mapview_id):
+        """reads a tile from the backing store, None when no PNG is stored for it"""
+
+    @abc.abstractmethod
+    def save(self, mapview_id, data, filename):
+        """writes the PNG bytes of a tile to the backing store and returns its ETag"""
+
+    def get(self, mapview_id):
+        """gets a tile, from memory when it was served recently
+
+        :param mapview_id: id of the mapview tile
+        :type mapview_id: int
+        :return: the tile or None when no PNG is stored for it
+        :rtype: Tile
+        """
+
+        return self.cache.get_or_load(mapview_id, lambda: self.load(mapview_id))
+
+    def get_if_modified(self, mapview_id, etag=None, modified_since=None):
+        """gets a tile unless the client's copy is still current
+
+        :param mapview_id: id of the mapview tile
+        :type mapview_id: int
+        :param etag: ETag of the client's copy
+        :type etag: str
+        :param modified_since: last modified time of the client's copy
+        :type modified_since: datetime
+        :return: the tile, None when it is not modified or not stored
+        :rtype: Tile
+        """
+
+        tile = self.get(mapview_id)
+        if tile is None or not_modified(tile, etag, modified_since):
+            return None
+        return tile
+
+    def put(self, mapview_id, data, filename=None):
+        """stores the PNG of a tile, replacing the previous one
+
+        :param mapview_id: id of the mapview tile
+        :type mapview_id: int
+        :param data: PNG bytes
+        :type data: bytes
+        :param filename: file name of the tile, defaults to the id
+        :type filename: str
+        :return: ETag of the stored tile
+        :rtype: str
+        """
+
+        if not isinstance(mapview_id, int):
+            raise TypeError("mapview_id must be an integer")
+        etag = self.save(mapview_id, bytes(data), filename or str(mapview_id) + ".png")
+        self.cache.invalidate(mapview_id)
+        return etag
+
+    def import_directory(self, directory, mapviews):
+        """stores the PNG files of a directory under the ids of the mapviews naming them
+
+        :param directory: directory holding the tile PNGs
+        :type directory: str
+        :param mapviews: mapview collection, its documents give the filename of every id
+        :type mapviews: pymongo.collection.Collection
+        :return: number of stored tiles
+        :rtype: int
+        """
+
+        stored = 0
+        for mapview in mapviews.find({"filename": {"$exists": True}}, {"_id": 0, "id": 1, "filename": 1}):
+            path = os.path.join(directory, mapview["filename"])
+            if os.path.isfile(path):
+                with open(path, "rb") as file:
+                    self.put(mapview["id"], file.read(), mapview["filename"])
+                stored += 1
+        return stored
+
+
+class GridFSTileStore(TileStore):
+    """keeps tile PNGs in a GridFS bucket, one file per mapview id
+
+    :param database: database holding the bucket
+    :type database: pymongo.database.Database
+    :param bucket: name of the GridFS bucket
+    :type bucket: str
+    :param hot_tiles: number of tiles kept in memory
+    :type hot_tiles: int
+    """
+
+    def __init__(self, database, bucket="tiles", hot_tiles=HOT_TILES):
+        super().__init__(hot_tiles)
+        self.database = database
+        self.bucket_name = bucket
+        self.files = database[bucket + ".files"]
+        self._bucket = None
+        self._index_ready = False
+
+    @property
+    def bucket(self):
+        """the GridFS bucket, created on first use"""
+
+        if self._bucket is None:
+            self._bucket = gridfs.GridFSBucket(self.database, bucket_name=self.bucket_name)
+        return self._bucket
+
+    def load(self, mapview_id):
+        file = self.files.find_one({"metadata.mapview_id": mapview_id}, sort=[("uploadDate", pymongo.DESCENDING)])
+        if file is None:
+            return None
+        data = self.bucket.open_download_stream(file["_id"]).read()
+        return Tile(mapview_id, data, file["metadata"]["etag"], file["uploadDate"].replace(tzinfo=timezone.utc))
+
+    def save(self, mapview_id, data, filename):
+        if not self._index_ready:
+            self.files.create_index([("metadata.mapview_id", pymongo.ASCENDING), ("uploadDate", pymongo.DESCENDING)])
+            self._index_ready = True
+        etag = content_etag(data)
+        previous = [file["_id"] for file in self.files.find({"metadata.mapview_id": mapview_id}, {"_id": 1})]
+        self.bucket.upload_from_stream(filename, data, metadata={"mapview_id": mapview_id, "etag": etag})
+        for file_id in previous:
+            self.bucket.delete(file_id)
+        return etag
+
+
+class DiskTileStore(TileStore):
+    """keeps tile PNGs as files named after the mapview id and serves them memory-mapped
+
+    the data of a tile is a read-only memoryview of the mapped file, nothing is
+    copied. Every get returns a view of its own, so a caller may release it.
+    :param directory: directory holding the tiles
+    :type directory: str
+    :param hot_tiles: number of tiles kept mapped
+    :type hot_tiles: int
+    """
+
+    def __init__(self, directory, hot_tiles=HOT_TILES):
+        super().__init__(hot_tiles)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, mapview_id):
+        return os.path.join(self.directory, str(mapview_id) + ".png")
+
+    def get(self, mapview_id):
+        tile = super().get(mapview_id)
+        return tile._replace(data=memoryview(tile.data)) if tile is not None else None
+
+    def load(self, mapview_id):
+        try:
+            with open(self.path(mapview_id), "rb") as file:
+                status = os.fstat(file.fileno())
+                if not status.st_size:
+                    return None
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        # the cache keeps the mapping, get hands out views of it
+        return Tile(mapview_id, mapped, file_etag(status), datetime.fromtimestamp(status.st_mtime, timezone.utc))
+
+    def save(self, mapview_id, data, filename):
+        # written aside and renamed so a tile being served keeps its old mapping
+        temporary = self.path(mapview_id) + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, self.path(mapview_id))
+        return file_etag(os.stat(self.path(mapview_id)))
@@ -0,0 +1,171 @@
+"""Vessel track queries for the TMB (Traffic Monitoring Backend)
+
+   Returns the positions of a vessel over an arbitrary time window, read through
+   the {MMSI, Timestamp} index. Long tracks can be thinned on the server by
+   keeping the last report of every time bucket, and simplified with the
+   Douglas-Peucker algorithm so a day of reports fits in a few hundred points.
+"""
+
+import math
+
+import pymongo
+
+import main
+
+TRACK_PROJECTION = {"_id": 0, "MMSI": 1, "Timestamp": 1, "Position.coordinates": 1}
+
+
+def track_pipeline(match, bucket_seconds):
+    """builds the aggregation keeping the last report of every vessel in every time bucket
+
+    :param match: filter selecting the position reports
+    :type match: dict
+    :param bucket_seconds: length of a time bucket in seconds
+    :type bucket_seconds: int
+    :return: aggregation pipeline
+    :rtype: list
+    """
+
+    millis = {"$toLong": {"$toDate": "$Timestamp"}}
+    size = int(bucket_seconds * 1000)
+    # $floor rounds pre-1970 (negative) millis down, $mod would round them towards zero
+    bucket = {"$toLong": {"$multiply": [{"$floor": {"$divide": [millis, size]}}, size]}}
+    # newest first within a vessel is the {MMSI: 1, Timestamp: -1} index order, so $first is the last report
+    return [
+        {"$match": match},
+        {"$sort": {"MMSI": pymongo.ASCENDING, "Timestamp": pymongo.DESCENDING}},
+        {"$group": {"_id": {"MMSI": "$MMSI", "bucket": bucket},
+                    "Timestamp": {"$first": "$Timestamp"},
+                    "coordinates": {"$first": "$Position.coordinates"}}},
+        {"$project": {"_id": 0, "MMSI": "$_id.MMSI", "Timestamp": 1, "Position": {"coordinates": "$coordinates"}}},
+        {"$sort": {"MMSI": pymongo.ASCENDING, "Timestamp": pymongo.DESCENDING}},
+    ]
+
+
+def segment_distance(point, start, end):
+    """distance between a point and a segment in a plane"""
+
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+    t = max(0.0, min(1.0, ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
+
+
+def simplify_track(track, tolerance):
+    """simplifies a track with the Douglas-Peucker algorithm
+
+    longitudes are scaled by the cosine of the latitude so the tolerance is
+    roughly the same distance in every direction.
+    :param track: position documents in time order, coordinates latitude first
+    :type track: list
+    :param tolerance: largest allowed deviation in degrees of latitude
+    :type tolerance: float
+    :return: the kept position documents, first and last always included
+    :rtype: list
+    """
+
+    if not tolerance or len(track) < 3:
+        return track
+    scale = math.cos(math.radians(track[0]["Position"]["coordinates"][0]))
+    points = [(document["Position"]["coordinates"][1] * scale, document["Position"]["coordinates"][0])
+              for document in track]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(points) - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        farthest, distance = None, tolerance
+        for index in range(first + 1, last):
+            candidate = segment_distance(points[index], points[first], points[last])
+            if candidate > distance:
+                farthest, distance = index, candidate
+        if farthest is not None:
+            keep[farthest] = True
+            ranges.append((first, farthest))
+            ranges.append((farthest, last))
+    return [document for document, kept in zip(track, keep) if kept]
+
+
+def track_match(mmsi_filter, start, end):
+    """builds the filter selecting the position reports of a track, served by the {MMSI, Timestamp} index
+
+    :param mmsi_filter: MMSI or MMSI condition
+    :return: filter for the AIS collection
+    :rtype: dict
+    """
+
+    return {"MMSI": mmsi_filter, "Timestamp": {"$gte": main.iso_timestamp(start), "$lte": main.iso_timestamp(end)},
+            "Position": {"$exists": True}}
+
+
+def find_tracks(mmsi_filter, start, end, bucket_seconds=None, collection=None):
+    """runs the track query, sorted by MMSI then newest first
+
+    the order is the one of the {MMSI: 1, Timestamp: -1} index, so an $in over
+    many vessels needs no blocking sort; callers reverse each track.
+    :param mmsi_filter: MMSI or MMSI condition
+    :return: cursor over MMSI, Timestamp and Position documents
+    :rtype: pymongo.cursor.Cursor
+    """
+
+    collection = collection if collection is not None else main.myCollection
+    match = track_match(mmsi_filter, start, end)
+    if bucket_seconds:
+        return collection.aggregate(track_pipeline(match, bucket_seconds))
+    return collection.find(match, TRACK_PROJECTION) \
+        .sort([("MMSI", pymongo.ASCENDING), ("Timestamp", pymongo.DESCENDING)])
+
+
+def get_vessel_track(mmsi, start, end, bucket_seconds=None, tolerance=None, collection=None):
+    """gets the positions of a vessel between two times, oldest first
+
+    :param mmsi: MMSI of the vessel
+    :type mmsi: int
+    :param start: start of the time window
+    :type start: datetime or str
+    :param end: end of the time window
+    :type end: datetime or str
+    :param bucket_seconds: keep only the last report of every bucket of this many seconds
+    :type bucket_seconds: int
+    :param tolerance: Douglas-Peucker tolerance in degrees, None keeps every point
+    :type tolerance: float
+    :param collection: AIS collection
+    :type collection: pymongo.collection.Collection
+    :return: array of MMSI, Timestamp and Position documents
+    :rtype: array
+    """
+
+    if not isinstance(mmsi, int):
+        raise TypeError('MMSI must be an integer')
+    track = list(find_tracks(mmsi, start, end, bucket_seconds, collection))
+    track.reverse()
+    return simplify_track(track, tolerance)
+
+
+def get_vessel_tracks(mmsis, start, end, bucket_seconds=None, tolerance=None, collection=None):
+    """gets the tracks of many vessels between two times with one query
+
+    :param mmsis: MMSIs of the vessels
+    :type mmsis: list
+    :param start: start of the time window
+    :type start: datetime or str
+    :param end: end of the time window
+    :type end: datetime or str
+    :param bucket_seconds: keep only the last report of every bucket of this many seconds
+    :type bucket_seconds: int
+    :param tolerance: Douglas-Peucker tolerance in degrees, None keeps every point
+    :type tolerance: float
+    :param collection: AIS collection
+    :type collection: pymongo.collection.Collection
+    :return: track of every MMSI, empty for vessels without reports
+    :rtype: dict
+    """
+
+    mmsis = list(mmsis)
+    if not all(isinstance(mmsi, int) for mmsi in mmsis):
+        raise TypeError('MMSI must be an integer')
+    tracks = {mmsi: [] for mmsi in mmsis}
+    for document in find_tracks({"$in": mmsis}, start, end, bucket_seconds, collection):
+        tracks[document["MMSI"]].append(document)
+    return {mmsi: simplify_track(track[::-1], tolerance) for mmsi, track in tracks.items()}